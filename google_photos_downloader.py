@@ -1,6 +1,6 @@
 import os
+import sys
 import json
-import ssl
 import time
 import argparse
 import logging
@@ -9,7 +9,10 @@ from datetime import datetime
 from dateutil.parser import parse
 from concurrent.futures import ThreadPoolExecutor
 import requests
+import httplib2
 from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from datetime import timezone
@@ -23,6 +26,19 @@ import threading
 import pytz
 import random
 from colorama import Fore, Style 
+from gpd_index import open_index_store, SqliteIndexStore, IndexJournal, INDEX_BACKENDS
+from gpd_records import MediaRecord, MediaIndex, format_creation_time
+from gpd_verify import check_content
+from gpd_download import stream_to_file, resume_offset, range_headers, BaseUrlResolver, MediaItemUnavailableError, BaseUrlLookupError, PooledSession, CONNECT_TIMEOUT, READ_TIMEOUT
+from gpd_async import AsyncDownloadEngine, ENGINES
+from gpd_ratelimit import RateLimiter, execute_with_limiter
+from gpd_schedule import DownloadScheduler, VIDEO_SHARE
+from gpd_metrics import MetricsRegistry, MetricsExporter, EXPORT_INTERVAL, METRICS_DIRNAME
+from gpd_profile import PhaseProfiler, PROFILES_DIRNAME
+from gpd_fetch import plan_shards, date_filter, shard_key, FetchProgress, SyncState, FETCH_WORKERS, SYNC_OVERLAP_DAYS
+from gpd_scan import plan_reconciliation, walk_repository, ScanCache, validate_snapshot, apply_extraneous_policy, EXTRANEOUS_POLICIES, QUARANTINE_DIRNAME
+
+PIPELINE_QUEUE_SIZE = 500  # --pipeline: most fetched items waiting for a download worker (about 5 search pages)
 
 def get_local_timezone():
     return pytz.timezone("America/Los_Angeles")  # Replace "Your_Local_Timezone" with your actual local time zone (e.g., "America/New_York")
@@ -31,52 +47,55 @@ def convert_utc_to_local(utc_time):
     local_tz = get_local_timezone()
     return local_tz.normalize(utc_time.replace(tzinfo=pytz.utc))
 
-class TokenBucket: #this class is used to limit the rate of requests to the Google Photos API.  It is based on the example at https://www.geeksforgeeks.org/token-bucket-algorithm-implementation/
-    def __init__(self, rate, capacity):
-        self.rate = rate
-        self.capacity = capacity
-        self.tokens = capacity
-        self.last_refill = time.monotonic()
-        self.lock = threading.Lock()
-
-    def refill(self):
-        now = time.monotonic()
-        elapsed = now - self.last_refill
-        tokens_to_add = self.rate * elapsed
-        self.tokens = min(self.tokens + tokens_to_add, self.capacity)
-        self.last_refill = now
-
-    def consume(self):
-        with self.lock:
-            self.refill()
-            if self.tokens >= 1:
-                self.tokens -= 1
-                return True
-            else:
-                return False
-
-
 class GooglePhotosDownloader:
     SCOPES = ['https://www.googleapis.com/auth/photoslibrary.readonly']
 
-    def __init__(self, start_date, end_date, backup_path, num_workers=5, checkpoint_interval=25, auth_code=None):
+    def __init__(self, start_date, end_date, backup_path, num_workers=5, checkpoint_interval=25, auth_code=None, index_backend=None, offline=False, scan_workers=8, full_rescan=False, extraneous_policy='ask', quarantine_dir=None,
+                 fetch_workers=FETCH_WORKERS, engine='threads', api_concurrency=2, transfer_concurrency=16, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, rate_limiter=None,
+                 video_share=VIDEO_SHARE, metrics=None, api_base_url=None, profiler=None):
 
         self.start_date = start_date if start_date else '1800-01-01'
         self.end_date = end_date if end_date else datetime.now(timezone.utc).strftime('%Y-%m-%d')
         self.backup_path = backup_path
         self.num_workers = num_workers
-        self.downloaded_count = 0
-        self.skipped_count = 0
-        self.failed_count = 0
-        self.total_file_size = 0
+        self.scan_workers = scan_workers  # threads listing the backup tree in walk_repository
+        self.full_rescan = full_rescan  # ignore the scan cache and list every folder again
+        self.extraneous_policy = extraneous_policy  # what the validator does with files that are not in the index
+        self.narrowed_by_date = False  # get_all_media_items dropped indexed items outside --start_date..--end_date
+        self.quarantine_dir = os.path.normpath(quarantine_dir or os.path.join(self.backup_path, QUARANTINE_DIRNAME))
+        # folders of the backup path that are not part of the library: never listed, so never extraneous or orphans
+        self.excluded_dirs = [self.quarantine_dir, os.path.join(self.backup_path, METRICS_DIRNAME), os.path.join(self.backup_path, PROFILES_DIRNAME)]
+        self.fetch_workers = fetch_workers  # date shards fetched at the same time, see gpd_fetch.py
+        self.fetch_lock = threading.Lock()  # fetch workers: check-and-add of new items, progress counters
+        self.engine = engine  # 'threads' (num_workers blocking workers) or 'async' (AsyncDownloadEngine)
+        self.api_concurrency = api_concurrency  # async engine: batchGet calls in flight
+        self.transfer_concurrency = transfer_concurrency  # async engine: downloads in flight
+        self.rate_limiter = rate_limiter or RateLimiter()  # api and content buckets, see gpd_ratelimit.py
+        self.video_share = video_share  # share of the workers (or async transfers) reserved for videos, see gpd_schedule.py
+        self.metrics = metrics or MetricsRegistry()  # counters and latency histograms, see gpd_metrics.py
+        self.downloaded_count = self.metrics.counter('gpd_downloads_total', 'Items finished, by result', result='downloaded')
+        self.failed_count = self.metrics.counter('gpd_downloads_total', 'Items finished, by result', result='failed')
+        self.total_file_size = self.metrics.counter('gpd_download_bytes_total', 'Bytes of finished downloads')
+        self.api_latency = {call: self.metrics.histogram('gpd_api_request_seconds', 'Library API calls, without rate limiter waits', call=call)
+                            for call in ('search', 'batchGet')}
+        self.ttfb_latency = self.metrics.histogram('gpd_download_ttfb_seconds', 'Download request sent to response headers received')
+        self.transfer_latency = self.metrics.histogram('gpd_download_transfer_seconds', 'Response headers to file in place, for finished downloads')
+        self.disk_write_latency = self.metrics.histogram('gpd_disk_write_seconds', 'Writes, fsyncs and rename of a finished download')
+        self.metrics.add_collector(self.collect_metrics)
+        self.last_collect = (time.monotonic(), 0)  # (time, downloaded bytes) at the previous collect_metrics
         self.failed_items = []
         self.skipped_items = []
         self.auth_code = auth_code  # New argument to store the authentication code
         self.MAX_RETRIES = 3  # Maximum number of retries for a download attempt       
         self.downloaded_items_path = os.path.normpath(os.path.join(self.backup_path, 'DownloadItems.json'))
-        self.download_counter = 0
+        self.download_counter = self.metrics.counter('gpd_download_responses_total', 'Download requests answered, retries included')
         self.progress_log_interval = 25
         self.all_media_items = {}  # Initialize all_media_items as an empty dictionary
+        self.media_index = MediaIndex(self.all_media_items)  # status/date/mime/filename lookups over all_media_items
+        self.index_store = open_index_store(self.backup_path, index_backend)  # json or sqlite, see gpd_index.py
+        self.dirty_item_ids = set()  # ids of items changed since the last save, so the sqlite backend only upserts those
+        self.journal = IndexJournal(self.backup_path)  # write-ahead log of item changes between index snapshots
+        self.index_lock = threading.Lock()
         self.script_dir = os.path.dirname(os.path.abspath(__file__))  
 
         console_handler = logging.StreamHandler()
@@ -86,8 +105,27 @@ class GooglePhotosDownloader:
         logging.getLogger().addHandler(console_handler)
         
         
-        self.session = requests.Session()
+        # one keep-alive connection pool per content host, one connection per worker, shared by all downloads
+        self.session = PooledSession(pool_maxsize=max(num_workers, 1), connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+        self.api_base_url = api_base_url  # e.g. a gpd_fakeserver.FakePhotosServer url: no OAuth, API and content served from there
+        self.photos_api = None
+        # baseUrl cache for the downloader's lifetime: seeded by the fetch, topped up in batches during downloads
+        self.url_resolver = BaseUrlResolver(None, limiter=self.rate_limiter.api, latency=self.api_latency['batchGet'])
+        self.connection_summary = None  # connection reuse of the last download run, set by run_download_engine
+        self.scheduler = None  # DownloadScheduler of the last download run, for its per-lane stats
+        if not offline: #offline commands only work on the local index and repository
+            self.connect()
 
+        self.checkpoint_interval = checkpoint_interval #unused, for later implementation of a periodic save to file in case of interrupted downloads.
+        if profiler is not None:
+            profiler.instrument(self)  # times and profiles the phase methods, see gpd_profile.py
+
+    def connect(self):
+        if self.api_base_url:
+            self.photos_api = self.build_photos_api()
+            logging.info(f"Connected to {self.api_base_url} (no OAuth).")
+            return
         creds = None
 
         token_path = os.path.join(self.script_dir, 'token.pickle')
@@ -108,10 +146,26 @@ class GooglePhotosDownloader:
             with open(token_path, 'wb') as token_file:
                 pickle.dump(creds, token_file)
 
-        self.photos_api = build('photoslibrary', 'v1', static_discovery=False, credentials=creds)
+        self.photos_api = self.build_photos_api(creds)
         logging.info("Connected to Google server.")
 
-        self.checkpoint_interval = checkpoint_interval #unused, for later implementation of a periodic save to file in case of interrupted downloads.
+    def build_photos_api(self, creds=None):
+        # httplib2 connections are not thread safe, and the fetch workers and baseUrl batches call the API from several
+        # threads at once, so every thread gets its own connection (kept alive between its calls).
+        local = threading.local()
+
+        def thread_http():
+            if not hasattr(local, 'http'):
+                local.http = httplib2.Http() if creds is None else AuthorizedHttp(creds, http=httplib2.Http())
+            return local.http
+
+        def request_builder(http, *args, **kwargs):
+            return HttpRequest(thread_http(), *args, **kwargs)
+
+        if self.api_base_url:
+            return build('photoslibrary', 'v1', static_discovery=False, cache_discovery=False, http=thread_http(), requestBuilder=request_builder,
+                         discoveryServiceUrl=f"{self.api_base_url.rstrip('/')}/$discovery/rest?version=v1")
+        return build('photoslibrary', 'v1', static_discovery=False, http=thread_http(), requestBuilder=request_builder)
     
     def authenticate(self):
         """Perform the OAuth authentication using the provided auth_code."""
@@ -120,10 +174,13 @@ class GooglePhotosDownloader:
         with open('token.pickle', 'wb') as token_file:
             pickle.dump(creds, token_file)
 
-        self.photos_api = build('photoslibrary', 'v1', static_discovery=False, credentials=creds)
+        self.photos_api = self.build_photos_api(creds)
         logging.info("Connected to Google server.")   
 
-    def get_all_media_items(self): #This method is used to fetch all media items from the Google Photos API
+    def get_all_media_items(self, on_new_items=None, save=True): #This method is used to fetch all media items from the Google Photos API
+        # on_new_items(records) is called with the items in the date range that still need downloading, first those
+        # already in the index, then the new items of every search page (used by fetch_and_download_photos).
+        # save=False leaves the final index save to the caller.
         print(f"Start Date: {self.start_date}")
         print(f"End Date: {self.end_date}")
         print(f"Backup Path: {self.backup_path}")
@@ -136,91 +193,127 @@ class GooglePhotosDownloader:
         end_datetime = datetime.strptime(self.end_date, "%Y-%m-%d").replace(tzinfo=tzlocal()) + timedelta(days=1, seconds=-1)
 
         # Filter out any items that are outside the date range
-        self.all_media_items = {
-            id: item 
-            for id, item in self.all_media_items.items() 
-            if start_datetime <= datetime.strptime(item['mediaMetadata']['creationTime'], "%Y-%m-%dT%H:%M:%S%z") <= end_datetime} 
+        in_range = self.media_index.items(created_between=(start_datetime.timestamp(), end_datetime.timestamp()))
+        self.narrowed_by_date = self.narrowed_by_date or len(in_range) < len(self.all_media_items)
+        self.all_media_items = in_range
+        self.media_index.rebuild(self.all_media_items)
         logging.info(f"FETCHER: {len(self.all_media_items)} existing items are within the date range")
+        if on_new_items is not None:
+            on_new_items(list(self.missing_media_items().values()))
         
-        date_filter = {
-            "dateFilter": {
-                "ranges": [
-                    {
-                        "startDate": {
-                            "year": start_datetime.year,
-                            "month": start_datetime.month,
-                            "day": start_datetime.day
-                        },
-                        "endDate": {
-                            "year": end_datetime.year,
-                            "month": end_datetime.month,
-                            "day": end_datetime.day
-                        }
-                    }
-                ]
-            }
-        }
-        page_counter = 0  # Initialize a page counter
-        page_token = None
-        indexing_start_time = time.time()  # Record the starting time
-        items_processed = 0  # Initialize the items processed counter outside of the loop
-        # Initialize average_time_per_item outside the loop
-        average_time_per_item = 0
+        # One search per date shard, fetch_workers shards at a time; they share the api rate limiter bucket.
+        progress = FetchProgress(self.backup_path, start_datetime.date(), end_datetime.date()).load()
+        shards = progress.shards
+        if not shards:
+            shards = plan_shards(start_datetime.date(), end_datetime.date(), count_items=self.count_indexed_items)
+            progress.start(shards)
+        pending_shards = [shard for shard in shards if not progress.is_completed(shard)]
+        logging.info(f"FETCHER: {len(shards)} date shards, {len(shards) - len(pending_shards)} already fetched by an interrupted run. "
+                     f"Fetching {len(pending_shards)} with {self.fetch_workers} workers...")
+        self.fetch_counters = {'pages': 0, 'items': 0, 'new': 0, 'start': time.time()}
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            futures = [executor.submit(self.fetch_shard, shard, progress, on_new_items) for shard in pending_shards]
+            for future in futures:
+                future.result()  # re-raise the first error; the shards completed so far stay recorded
+        progress.finish()
+        elapsed_indexing_time = time.time() - self.fetch_counters['start']
+        average_time_per_item = self.fetch_counters['items'] / elapsed_indexing_time if elapsed_indexing_time else 0
+        logging.info(f"FETCHER: {self.fetch_counters['pages']} pages, {self.fetch_counters['items']} items, {self.fetch_counters['new']} new.")
 
+        self.all_item_count = len(self.all_media_items)
+        self.fetcher_elapsed_time = time.time() - fetcher_start_time  # Calculate elapsed time
+        logging.info(f"FETCHER: Total time to fetch index: {time.time() - fetcher_start_time} seconds. ({average_time_per_item} p/sec)")
+        if save:
+            self.save_index_to_file(self.all_media_items)  # Save the index to file
+
+    def count_indexed_items(self, shard):
+        # Items of the local index in a date shard (local time, like --start_date/--end_date): the density hint
+        # plan_shards uses to split busy months.
+        start = datetime(shard.start.year, shard.start.month, shard.start.day, tzinfo=tzlocal())
+        end = datetime(shard.end.year, shard.end.month, shard.end.day, tzinfo=tzlocal()) + timedelta(days=1, seconds=-1)
+        return self.media_index.count(created_between=(start.timestamp(), end.timestamp()))
+
+    def fetch_shard(self, shard, progress, on_new_items=None):
+        # Page through mediaItems.search for one date shard, adding items not yet in the index.  Runs in a fetch worker.
+        page_token = None
+        shard_items = 0
         while True: # Loop until there are no more pages
-            
-            results = self.photos_api.mediaItems().search(
+            results = execute_with_limiter(self.photos_api.mediaItems().search(
                 body={
                     'pageToken': page_token,
-                    'filters': date_filter,
+                    'filters': date_filter(shard),
                     'pageSize': 99  # Set the pageSize here  
                 } 
-            ).execute()
+            ), self.rate_limiter.api, latency=self.api_latency['search'])  # waits for an api token; 429/5xx slow the bucket down and are retried
 
-            items = results.get('mediaItems')
-            if not items:
-                logging.info("FETCHER: No more results")
-                break
-
-  
+            items = results.get('mediaItems') or []
+            new_items = []
             for item in items:
-                items_processed += 1  # Increment the items_processed counter
-                if item['id'] not in self.all_media_items: #if the item is not already in the index, add it.
+                # search results come with a baseUrl valid for about an hour: keep it for the download, never in the index
+                base_url = item.pop('baseUrl', None)
+                item.pop('baseURL', None)
+                existing = self.all_media_items.get(item['id'])
+                if base_url is not None and (existing is None or existing.status not in ['downloaded', 'verified']):
+                    self.url_resolver.store(item['id'], base_url)
+                with self.fetch_lock:  # shards do not overlap, but an item must never be added twice
+                    if item['id'] in self.all_media_items: #if the item is already in the index, skip it.
+                        continue
                     convention_filename = self.append_id_to_string(item['filename'], item['id'])
                     convention_filename = convention_filename.replace('\\', '-').replace('/', '-') #avoid slashes in filenames
                     # If the filename doesn't exist in the scan results, mark it as 'fetched'
                     item['status'] = 'fetched' #fetched but not verified by scan.        
                     # Record the UTC time of the item fetch
                     item['date_fetched'] = datetime.utcnow().isoformat()
-                    # Remove the 'baseURL' key if it exists
-                    item.pop('baseURL', None) # Removes the 'baseURL' key if it exists, does nothing if it doesn't
-                    self.all_media_items[item['id']] = item #add the item to the index.
-                
+                    record = MediaRecord.from_api(item)
+                    self.add_item(record) #add the item to the index.
+                new_items.append(record)
+            if on_new_items is not None and new_items:
+                on_new_items(new_items)  # may block until the download workers catch up
+            shard_items += len(items)
+
+            self.metrics.counter('gpd_fetch_pages_total', 'Search pages fetched').inc()
+            self.metrics.counter('gpd_fetch_items_total', 'Items on the search pages').inc(len(items))
+            self.metrics.counter('gpd_fetch_new_items_total', 'Items added to the index by the fetch').inc(len(new_items))
+            with self.fetch_lock:
+                counters = self.fetch_counters
+                counters['pages'] += 1
+                counters['items'] += len(items)
+                counters['new'] += len(new_items)
+                report = counters['pages'] % 10 == 0
+                if report:
+                    elapsed_indexing_time = time.time() - counters['start']
+                    logging.info(f"FETCHER: Processed {counters['pages']} pages and {counters['items']} items ({counters['new']} new) "
+                                 f"averaging {counters['items'] / elapsed_indexing_time:.1f} items per second.")
+            if report:
+                self.journal.flush()  # new items are in the journal; the snapshot is written once the fetch completes
 
             page_token = results.get('nextPageToken')
             if not page_token:
-                logging.info("FETCHER: No more pages")
                 break
 
-            page_counter += 1  # Increment the page counter
-
-            # If 10 pages have been processed, report progress and estimate time to completion
-            if page_counter % 10 == 0:                
-                elapsed_indexing_time = time.time() - indexing_start_time  # Calculate elapsed time
-                self.save_index_to_file(self.all_media_items)  # Save the index to file   
-
-                # Check if items_processed is zero         
-                if  items_processed == 0:
-                  
-                    average_time_per_item = items_processed / elapsed_indexing_time # Calculate average processing time per item
-
-                    
-                logging.info(f"FETCHER: Processed {page_counter} pages and {items_processed} items averaging {average_time_per_item} per second. Estimated remaining time, WTH knows.")
-
-        self.all_item_count = len(self.all_media_items)
-        self.fetcher_elapsed_time = time.time() - fetcher_start_time  # Calculate elapsed time
-        logging.info(f"FETCHER: Total time to fetch index: {time.time() - fetcher_start_time} seconds. ({average_time_per_item} p/sec)")
-        self.save_index_to_file(self.all_media_items)  # Save the index to file
+        self.journal.flush()  # the shard's items must be on disk before it is recorded as done
+        progress.complete(shard, shard_items)
+        logging.info(f"FETCHER: Shard {shard_key(shard)} done, {shard_items} items")
+
+    def update_item(self, item, **fields):
+        # Single entry point for changing an item in the index.  Records the id so the next save only writes changed items,
+        # and appends the change to the journal so it survives a crash before that save.
+        changed = {key: value for key, value in fields.items() if item.get(key) != value}
+        if not changed:
+            return
+        self.media_index.update(item, changed)
+        item.update(changed)
+        with self.index_lock:
+            self.dirty_item_ids.add(item.id)
+        self.journal.append_update(item.id, changed)
+
+    def add_item(self, item):
+        # Add a newly fetched item to the index, journaling the whole record.
+        self.all_media_items[item.id] = item
+        self.media_index.add(item)
+        with self.index_lock:
+            self.dirty_item_ids.add(item.id)
+        self.journal.append_item(item)
 
     def append_id_to_string(self, string_to_append, item_id):
         # this method is used to append the last 14 digits of the Google Photos ID to a string (usually a file_path or filename)
@@ -237,408 +330,506 @@ class GooglePhotosDownloader:
     
     def construct_file_path(self, item):
         # Parse the creation time and convert to local time zone
-        creation_time = parse(item['mediaMetadata']['creationTime']).astimezone(pytz.utc).replace(tzinfo=None)
+        creation_time = item.creation_datetime().replace(tzinfo=None)
         creation_time_local = convert_utc_to_local(creation_time)
         # Define the subdirectory based on the local time zone-adjusted creation time
         subdirectory = os.path.join(str(creation_time_local.year), str(creation_time_local.month))
         # Define the filename with the appended ID based on the local time zone-adjusted creation time
-        convention_filename = self.append_id_to_string(item['filename'], item['id'])
+        convention_filename = self.append_id_to_string(item.filename, item.id)
         # Combine everything to get the full file path
         convention_filename = convention_filename.replace('\\', '-').replace('/', '-')
         convention_filepath = os.path.normpath(os.path.join(self.backup_path, subdirectory, convention_filename))
         
         return convention_filename, convention_filepath
 
+    def scan_repository(self):
+        # One walk of the backup tree.  Folders whose mtime matches ScanCache.json are taken from the cache.
+        snapshot = walk_repository(self.backup_path, self.scan_workers, cache=ScanCache(self.backup_path), use_cache=not self.full_rescan,
+                                   exclude_dirs=self.excluded_dirs)
+        logging.info(f"SCANNER: Listed {snapshot.listed_count} folders, {snapshot.cached_count} unchanged folders taken from the scan cache.")
+        return snapshot
+
     def scandisk_and_get_filepaths_and_filenames(self): #scans drive for filenames and filepaths and returns a dictionary of all filenames and filepaths in the backup folder.
         scanner_start_time = time.time()
-        # loop through all files in the backup folder and create a dictionary of all filenames and filepaths.
-        filepaths_and_filenames = {}
-        for root_subdir in os.listdir(self.backup_path):
-            root_subdir_path = os.path.normpath(os.path.join(self.backup_path, root_subdir))
-            if os.path.isdir(root_subdir_path):
-                for dirpath, dirnames, filenames in os.walk(root_subdir_path):
-                    for filename in filenames:
-                        filename = filename.replace('\\', '-').replace('/', '-') #some weird filenames contain slashes.  Replace them with dashes.
-                        filepath = os.path.normpath(os.path.join(dirpath, filename))
-                        filepaths_and_filenames[filepath] = filename
-
+        # list all files in the backup folder's subdirectories once, with their sizes, and create a dictionary of all filenames and filepaths.
+        snapshot = self.scan_repository()
+        filepaths_and_filenames = snapshot.filepaths_and_filenames()
+        logging.info(f"SCANNER: Found {len(filepaths_and_filenames)} files in {len(snapshot.dir_mtimes)} folders.")
 
         if len(self.all_media_items) == 0:
             self.load_index_from_file()
             logging.info("SCANNER: No media items in memory, loading from file.")
             
-        #loop through all items in the index and update the file path and status.  Possibly move to a separate method called update_index.
+        #match every item in the index against the files on disk, then carry out the moves and status updates.
         logging.info(f"SCANNER: Number of items loaded to all_media_items for get all filepaths: {len(self.all_media_items)}")
         logging.info(f"SCANNER: Scanning repository...")
-        moved_count = 0
-        renamed_count = 0
-        filepath_added_count = 0
-
-        for item in self.all_media_items.values():
-            convention_filename, convention_filepath = self.construct_file_path(item)
-            
-            if convention_filepath in filepaths_and_filenames: #update the filepath in the index if it exists in the dictionary.
-                item['file_path'] = convention_filepath #add file repository metadata to the index.
-                item['file_size'] = os.path.getsize(convention_filepath)
-                item['filename'] = convention_filename
-                item['status'] = 'verified' #mark the item as verified if the file exists.                         
-                
-            if item['filename'] in filepaths_and_filenames.values():
-                #possibly should be a separate method called organize_files.  This is the main loop to organize files.
-                current_filepaths = [path for path, name in filepaths_and_filenames.items() if name == convention_filename] #get a list of all filepaths with the same filename.
-                #first subloop to move files to the correct location if they are named correctly.
-                scanned_count =+ 1
-                for current_filepath in current_filepaths:
-                    # If the file is properly named but not in the correct location, move it
-                    if current_filepath and current_filepath != convention_filepath:
-                        # Create the directory if it doesn't exist
-                        os.makedirs(os.path.dirname(convention_filepath), exist_ok=True)
-                        # Only move the file if it does not already exist at the destination
-                        if not os.path.exists(convention_filepath):
-                            logging.info(f"SCANNER: Moving {current_filepath} to {convention_filepath}")
-                            os.rename(current_filepath, convention_filepath)
-                            # Update the filepath in the item and in the dictionary
-                            item['file_path'] = convention_filepath
-                            item['status'] = 'verified'
-                            filepaths_and_filenames[convention_filepath] = item['filename']
-                            del filepaths_and_filenames[current_filepath]
-                            moved_count += 1
-                            
-                        else:
-                            # If a file already exists at the convention_filepath, check if it is the correct file
-                            if os.path.basename(convention_filepath) != item['filename']:
-                                # If it is not the correct file, move it to the backup directory
-                                backup_dir = os.path.join(os.path.dirname(convention_filepath), 'backup')
-                                os.makedirs(backup_dir, exist_ok=True)
-                                backup_filepath = os.path.join(backup_dir, os.path.basename(convention_filepath))
-                                if not os.path.exists(backup_filepath):  # Check if the file already exists in the backup directory
-                                    logging.info(f"SCANNER: Moving existing file at {convention_filepath} to backup directory {backup_filepath}")
-                                    os.rename(convention_filepath, backup_filepath)
-                                else:
-                                    logging.info(f"SCANNER: File already exists in the backup directory. Skipping move.")
-
-
-                # Second subloop to rename files if they are not named correctly.  possibly should be a separate method called rename_files.
-                if convention_filepath in filepaths_and_filenames:
-                    if item['filename'] != filepaths_and_filenames[convention_filepath]:
-                        logging.info(f"SCANNER: Filename {filepaths_and_filenames[convention_filepath]} does not match the convention. Renaming to {convention_filename}")
-                        os.rename(convention_filepath, os.path.join(os.path.dirname(convention_filepath), convention_filename))
-                        # Update the filename in the item and in the dictionary
-                        item['filename'] = convention_filename
-                        filepaths_and_filenames[convention_filepath] = convention_filename
-                        item['status'] = 'verified' #mark the item as verified if the file exists.
-                        renamed_count += 1
-                else:
-                    item['status'] = 'missing'
-                    logging.info(f"SCANNER: File {item['filename']} is missing")
-                    missing_count =+ 1
-
-                #third subloop to loop to look for items in the index that only have source filename,
-                #and add any missing file_path or file_size or status values to the index.
-                #possibly should be a separate method called add_missing_filepaths.
-                if not item.get('file_path'):
-                    # file path is missing or None: 
-                    logging.info(f"SCANNER: File {convention_filepath} exists, adding file_path to index.")
-                    item['file_size'] = os.path.getsize(convention_filepath)
-                    item['file_path'] = convention_filepath
-                    filepath_added_count += 1
-                    #update filename to convention_filename if it doesn't match.
-                    if item['filename'] != convention_filename:
-                        logging.info(f"SCANNER: Filename {item['filename']} does not match the convention. Renaming filename and adding status and filename to index.")
-                        item['filename'] = convention_filename
-                        filepaths_and_filenames[convention_filepath] = convention_filename
-                        os.rename(convention_filepath, os.path.join(os.path.dirname(convention_filepath), convention_filename))
-                        item['status'] = 'verified'
-                    else: #ensure the status and filename exist in the record if the stray file is correctly named, in the index, but doesn't have this info.
-                        logging.info(f"SCANNER: Filename {item['filename']} matches the convention. Updating index status and filename.")
-                        item['filename'] = convention_filename
-                        item['status'] = 'verified'  
-                        filepaths_and_filenames[convention_filepath] = convention_filename                            
+        plan = plan_reconciliation(self.all_media_items.values(), filepaths_and_filenames, self.construct_file_path)
+        logging.info(f"SCANNER: Reconciliation plan: {plan.summary()}")
+        self.apply_reconciliation_plan(plan, snapshot)
                 
         scanner_end_time = time.time()
         
-        logging.info(f'SCANNER: Last file verified was {convention_filepath}')
-                      #and found {missing_count or 0} missing files.  Renamed {renamed_count or 0} files and moved {moved_count or 0} files.  Added filepaths to {filepath_added_count or 0} files.")
         self.scanner_elapsed_time = scanner_end_time - scanner_start_time
         logging.info(f"SCANNER: Validator completed processing in {scanner_end_time - scanner_start_time} seconds.")
         time.sleep(1.5)
         self.save_index_to_file(self.all_media_items)
-        return filepaths_and_filenames
-
-    def validate_repository(self): #this method is used to validate the repository by checking the index against the actual files in the repository.
-        validator_start_time = time.time()
+        return snapshot.filepaths_and_filenames()
 
-        logging.info(f"VALIDATOR: Number of items loaded to all_media_items for checking existing file paths in index: {len(self.all_media_items)}")
+    def apply_reconciliation_plan(self, plan, snapshot):
+        # Executes a plan from plan_reconciliation: records verified files, moves misplaced and misnamed files to their
+        # convention paths, and marks items whose files are gone as missing.
+        for item, filepath in plan.verified:
+            #add file repository metadata to the index and mark the item as verified if the file exists.
+            self.update_item(item, file_path=filepath, file_size=snapshot.files[filepath].size, filename=os.path.basename(filepath), status='verified')
 
-        missing_count = 0
-        validated_count = 0
-        validated_files = []
-        missing_files = []
-      
-        for item in self.all_media_items.values():
-            if item.get('file_path') is not None:
-                file_path_to_verify = os.path.normpath(item['file_path'])
-
-                try:
-                    if file_path_to_verify is not None and os.path.exists(file_path_to_verify):
-                        validated_count += 1
-                        validated_files.append(file_path_to_verify)
-                        item['status'] = "verified" # Set status to "verified"
-                    else:
-                        missing_count += 1
-                        missing_files.append(file_path_to_verify)
-                        item['status'] = "missing" # Set status to "missing"
-                        
-                except:
-                    logging.info(f"Error verifying file {file_path_to_verify}")
-                    continue
-
-        logging.info(f"VALIDATOR: Verified {validated_count} indexed file paths and found {missing_count} missing files.")
-        logging.info(f'VALIDATOR: The last validated file path was {file_path_to_verify}')
-
-        # Now let's find extraneous files  This should possibly be the a separate method called find_extraneous_files
-        # or part of the scandisk_and_get_filepaths_and_filenames method.
-        extraneous_files = []
-        for root, dirs, files in os.walk(self.backup_path):
-            # If the current directory is the root of the backup directory, skip it
-            if os.path.normpath(root) == os.path.normpath(self.backup_path):
+        moved_count = 0
+        for item, current_filepath, convention_filepath in plan.moves():
+            # Create the directory if it doesn't exist
+            os.makedirs(os.path.dirname(convention_filepath), exist_ok=True)
+            # Only move the file if it does not already exist at the destination
+            if os.path.exists(convention_filepath):
+                logging.info(f"SCANNER: {convention_filepath} already exists. Leaving {current_filepath} in place.")
                 continue
-            for file in files:
-                file_path = os.path.join(root, file)
-                normalized_file_path = os.path.normpath(file_path)
-                if normalized_file_path not in validated_files:
-                    extraneous_files.append(normalized_file_path)
-
-        # Log the number of extraneous files
-        logging.info(f"VALIDATOR: Found {len(extraneous_files)} extraneous files.")
-        if len(extraneous_files) >= 1:
-
-            # Save the list of extraneous files to a file
-            with open('extraneous_files.txt', 'w') as f:
-                for file in extraneous_files:
-                    f.write("%s\n" % file)
+            logging.info(f"SCANNER: Moving {current_filepath} to {convention_filepath}")
+            os.rename(current_filepath, convention_filepath)
+            # Update the filepath in the item and in the snapshot
+            snapshot.move(current_filepath, convention_filepath)
+            self.update_item(item, file_path=convention_filepath, file_size=snapshot.files[convention_filepath].size, filename=os.path.basename(convention_filepath), status='verified')
+            moved_count += 1
 
-            #ask user whether to delete, relocate or leave files alone
-            user_input = input("Would you like to delete, relocate or leave alone the extraneous files? (d/r/l): ")
-            if user_input == 'd':
-                for file in extraneous_files:
-                    os.remove(file)
-                logging.info("Extraneous files deleted")
-            elif user_input == 'r':
-                # ask user for new directory
-                new_directory = input("Enter the new directory: ")
-                for file in extraneous_files:
-                    # Get the relative path of the file
-                    rel_path = os.path.relpath(file, self.backup_path)
-                    # Create the new path for the file
-                    new_filepath = os.path.join(new_directory, rel_path)
-                    # Create any necessary directories
-                    os.makedirs(os.path.dirname(new_filepath), exist_ok=True)
-                    # Move the file
-                    os.rename(file, new_filepath)
-                logging.info(f"Extraneous files moved to {new_directory}")
-
-            elif user_input == 'l':
-                logging.info("Leaving files alone")
-            else:
-                logging.info("Invalid input. Leaving files alone")
-            
+        for item in plan.missing:
+            if item.status != 'missing':
+                logging.info(f"SCANNER: File {item.filename} is missing")
+            self.update_item(item, status='missing')
 
-        # Update the existing items with the modified items from all_media_items
-        existing_items_dict = self.all_media_items
+        logging.info(f"SCANNER: Verified {len(plan.verified)} files, moved or renamed {moved_count} files, {len(plan.missing)} files missing, {len(plan.orphans)} files not in the index.")
 
-        for item_id, item in self.all_media_items.items():
-            if item['id'] in existing_items_dict:
-                existing_items_dict[item['id']].update(item)  # Update existing item
+    def validate_repository(self): #this method is used to validate the repository by checking the index against the actual files in the repository.
+        validator_start_time = time.time()
+
+        # A file is only extraneous if the whole index lacks it, not just the date range fetched by this run
+        narrowed_by_date = self.narrowed_by_date
+        if narrowed_by_date:
+            logging.info("VALIDATOR: The index was narrowed to --start_date..--end_date, reloading all of it...")
+            self.save_index_to_file(self.all_media_items)
+            self.load_index_from_file()
+            self.narrowed_by_date = False
 
-        # Write the updated items back to the file
-        with open(self.downloaded_items_path, 'w') as f:
-            json.dump(existing_items_dict, f, indent=4)
+        logging.info(f"VALIDATOR: Number of items loaded to all_media_items for checking existing file paths in index: {len(self.all_media_items)}")
+
+        snapshot = self.scan_repository()  # one listing of the tree serves both checks below
+        report = validate_snapshot(self.all_media_items.values(), snapshot)
+        for item, _ in report.verified:
+            self.update_item(item, status="verified") # Set status to "verified"
+        for item in report.missing:
+            self.update_item(item, status="missing") # Set status to "missing"
+        logging.info(f"VALIDATOR: Verified {len(report.verified)} indexed file paths and found {len(report.missing)} missing files.")
+
+        # files in the root of the backup directory are not part of the snapshot, so the index, log and caches never show up here
+        logging.info(f"VALIDATOR: Found {len(report.extraneous)} extraneous files.")
+        if len(report.extraneous) >= 1:
+
+            # Save the list of extraneous files next to the index
+            extraneous_list_path = os.path.join(self.backup_path, 'extraneous_files.txt')
+            with open(extraneous_list_path, 'w') as f:
+                for file in report.extraneous:
+                    f.write("%s\n" % file)
+            logging.info(f"VALIDATOR: List of extraneous files saved to {extraneous_list_path}")
+
+            policy = self.extraneous_policy
+            quarantine_dir = self.quarantine_dir
+            if policy == 'ask':
+                if not sys.stdin.isatty():
+                    logging.info("VALIDATOR: No terminal to ask about extraneous files, leaving them alone")
+                    policy = 'leave'
+                else:
+                    #ask user whether to delete, relocate or leave files alone
+                    user_input = input("Would you like to delete, relocate or leave alone the extraneous files? (d/r/l): ")
+                    if user_input == 'd':
+                        policy = 'delete'
+                    elif user_input == 'r':
+                        policy = 'quarantine'
+                        quarantine_dir = input(f"Enter the new directory [{self.quarantine_dir}]: ") or self.quarantine_dir
+                    elif user_input == 'l':
+                        policy = 'leave'
+                    else:
+                        logging.info("Invalid input. Leaving files alone")
+                        policy = 'leave'
+            if policy == 'delete' and narrowed_by_date:
+                logging.info("VALIDATOR: Not deleting extraneous files after a date-limited fetch, leaving them alone. Use validate_only or --extraneous quarantine")
+                policy = 'leave'
+            apply_extraneous_policy(report.extraneous, self.backup_path, policy, quarantine_dir)
+
+        # Write the updated statuses back to the index
+        self.save_index_to_file(self.all_media_items)
 
         validator_end_time = time.time()
         self.validator_elapsed_time = validator_end_time - validator_start_time
         logging.info(f"VALIDATOR: Total time to validate repository: {self.validator_elapsed_time} seconds")
 
 
+    def verify_content(self, hash_workers=None, rehash=False):
+        # Hash every downloaded file and flag zero-byte, truncated and resized files.  Hashes are kept in the index
+        # with the size and mtime they were taken at, so unchanged files are not read again on the next run.
+        verifier_start_time = time.time()
+        if len(self.all_media_items) == 0:
+            self.load_index_from_file()
+        snapshot = walk_repository(self.backup_path, self.scan_workers, exclude_dirs=self.excluded_dirs)  # no scan cache: sizes and mtimes must be current
+        items = [item for item in self.all_media_items.values() if item.file_path is not None]
+        logging.info(f"VERIFIER: Checking {len(items)} files recorded in the index...")
+        report = check_content(items, snapshot, num_workers=hash_workers, rehash=rehash,
+                               on_hashed=lambda item, content_hash: self.update_item(item, content_hash=content_hash))
+        logging.info(f"VERIFIER: {report.summary()}")
+
+        # Damaged files are marked failed so download_missing fetches them again.
+        for item, _ in report.zero_byte:
+            self.update_item(item, status='failed')
+        for item, _, _, _ in report.truncated + report.size_mismatch:
+            self.update_item(item, status='failed')
+
+        problems = report.problems()
+        if problems:
+            report_path = os.path.join(self.backup_path, 'verify_content_report.txt')
+            with open(report_path, 'w') as f:
+                for problem, item, detail in problems:
+                    f.write(f"{problem}\t{item.id}\t{detail}\n")
+            logging.warning(f"VERIFIER: {len(problems)} problems found, listed in {report_path}")
+
+        self.save_index_to_file(self.all_media_items)
+        logging.info(f"VERIFIER: Total time to verify content: {time.time() - verifier_start_time} seconds")
+        return report
+
+    def record_download(self, item, convention_filename, convention_file_path, file_size):
+        # Index updates and progress logging after a successful download; shared by the threaded and async engines.
+        self.update_item(item,
+                         file_path=convention_file_path,  # record the file path
+                         file_size=file_size,  # record the file size
+                         status='downloaded',  # record the status
+                         filename=convention_filename, #record the filename
+                         partial_download=None, #the .part file has been renamed into place
+                         date_downloaded=datetime.utcnow().isoformat()) #record the timestamp of download
+        logging.info(f"DOWNLOADER: Downloaded {convention_file_path}")
+        self.url_resolver.release(item.id)
+        self.total_file_size.inc(file_size)
+
+        if self.downloaded_count.inc() % self.progress_log_interval == 0:  # inc() is atomic, so exactly one worker logs
+            processed = self.downloaded_count.value + self.failed_count.value
+            percent_complete = (processed / self.potential_job_size) * 100 if self.potential_job_size else 100.0
+            download_progress_timestamp = time.time()
+            download_elapsed_time = download_progress_timestamp - self.download_start_timestamp
+            download_rate = processed / download_elapsed_time
+            download_ETR = max(self.potential_job_size - processed, 0) / download_rate
+            logging.info(Fore.GREEN + f"Progress: {percent_complete:.2f}% complete. ETR {download_ETR/60} minutes" + Style.RESET_ALL)
+            logging.info(Fore.CYAN + f"DOWNLOADER: Processed {processed} files out of {self.potential_job_size} files at {download_rate} files/sec." + Style.RESET_ALL)
+            # Status changes are already in the journal; only make sure they are on disk.
+            self.journal.flush()
+
+    def record_failure(self, item):
+        # An item given up on, by either engine.
+        self.update_item(item, status='failed')
+        self.failed_count.inc()
+
     def download_image(self, item):
-        #logging.info(f"DOWNLOADER: considering {item['filename']}...")
+        #logging.info(f"DOWNLOADER: considering {item.filename}...")
         #construct filepath for the download
         convention_filename, convention_file_path = self.construct_file_path(item)
 
         # If the file cannot be found at either file_path, download it.   
         logging.info(f"DOWNLOADER: Starting download request for {convention_file_path}")
-        session = requests.Session() #creates a new session for each download attempt.  This is to prevent the session from timing out and causing the download to fail.
         for attempt in range(self.MAX_RETRIES):  # Retry up to MAX_RETRIES times.  Part of exponential backoff.
-            while not rate_limiter.consume(): #if the rate limiter is not ready, wait for a short time and try again.
-                time.sleep(0.1)  # Wait for a short time if no tokens are available
+            image_url = None
             try:                
-                image = self.photos_api.mediaItems().get(mediaItemId=item['id']).execute()
-                #logging.info(f"DOWNLOADER: Response from Google Photos API: {image}")
-
-                if 'video' in item['mimeType'] or '.mov' in item['filename']:  # Check if 'video' is in mimeType. need to account for motion photos and other media types.
-                    image_url = image['baseUrl'] + '=dv' #motion videos also dowlnoad as =dv. Stil testing.
-                elif 'image' in item['mimeType']:
-                    image_url = image['baseUrl'] + '=d'
-                else:
-                    image_url = image['baseUrl'] + '=d'
+                base_url = self.url_resolver.base_url(item.id) #resolved in batches of 50 with mediaItems.batchGet
+                image_url = self.media_url(item, base_url)
 
                 logging.info(f"DOWNLOADER: Attempting to download {convention_file_path}...")  # Log a message before the download attempt
-                response = session.get(image_url, stream=True)
-                logging.info(f"DOWNLOADER: Download attempt finished. Status code: {response.status_code}")  # Log a message after the download attempt
-                self.download_counter += 1
-                # Log the status code and headers
-                logging.info(f"DOWNLOADER: Response headers: {response.headers}")
-                os.makedirs(os.path.dirname(convention_file_path), exist_ok=True)
-                with open(convention_file_path, "wb") as f: 
-                    f.write(response.content) #write the file to the backup folder
-
-                item['file_path'] = convention_file_path  # record the file path
-                item['file_size'] = os.path.getsize(convention_file_path)  # record the file size
-                item['status'] = 'downloaded'  # record the status
-                item['filename'] = convention_filename #record the filename
-                item['date_downloaded'] = datetime.utcnow().isoformat() #record the timestamp of download
-                logging.info(f"DOWNLOADER: Downloaded {convention_file_path}")
-                
-                if self.download_counter % self.progress_log_interval == 0:
-                    percent_complete = (self.download_counter / self.potential_job_size) * 100
-                    download_progress_timestamp = time.time()
-                    download_elapsed_time = download_progress_timestamp - self.download_start_timestamp
-                    download_rate = self.download_counter / download_elapsed_time
-                    download_ETR = (self.potential_job_size - self.download_counter) / download_rate
-                    logging.info(Fore.GREEN + f"Progress: {percent_complete:.2f}% complete. ETR {download_ETR/60} minutes" + Style.RESET_ALL)
-                    logging.info(Fore.CYAN + f"DOWNLOADER: Processed {self.download_counter} files out of {self.potential_job_size} files at {download_rate} files/sec." + Style.RESET_ALL)
-                    # Save the index to file after every progress_log_interval downloads
-                    self.save_index_to_file(self.all_media_items)
-
-                break #if download is successful, break out of the retry loop and download the next item.
-            
-            except TimeoutError: #if the request times out, log an error and move on to the next item.
-                logging.error(f"DOWNLOADER: FAILED Request to Google Photos API for item {item['id']} timed out.") #test
-                self.download_counter += 1
-                continue #test
-            except requests.exceptions.RequestException as e: #if a request exception occurs, log an error and move on to the next item.
-                logging.error(f"DOWNLOADER: FAILED RequestException occurred while trying to get {image_url}: {e}")
-                logging.error(f"DOWNLOADER: Traceback: {traceback.format_exc()}")
-                self.download_counter += 1
-                time.sleep(1)
-            except (requests.exceptions.RequestException, ssl.SSLError) as e:
+                # pick up where an earlier attempt (or an earlier run) left off
+                offset = resume_offset(convention_file_path, item.partial_download)
+                if offset:
+                    logging.info(f"DOWNLOADER: Resuming {convention_file_path} at byte {offset}")
+                self.rate_limiter.content.acquire()
+                request_start = time.perf_counter()
+                with self.session.get(image_url, stream=True, headers=range_headers(offset, item.partial_download)) as response:
+                    transfer_start = time.perf_counter()  # stream=True returns once the headers are in
+                    self.ttfb_latency.observe(transfer_start - request_start)
+                    logging.info(f"DOWNLOADER: Download attempt finished. Status code: {response.status_code}")  # Log a message after the download attempt
+                    self.rate_limiter.content.record(response.status_code)  # 429/5xx slow the content bucket down
+                    self.download_counter.inc()
+                    # Log the status code and headers
+                    logging.info(f"DOWNLOADER: Response headers: {response.headers}")
+                    os.makedirs(os.path.dirname(convention_file_path), exist_ok=True)
+                    file_size = stream_to_file(response, convention_file_path, offset=offset, #stream the file to the backup folder in chunks
+                                               on_checkpoint=lambda state: self.update_item(item, partial_download=state),
+                                               write_latency=self.disk_write_latency)
+                    self.transfer_latency.observe(time.perf_counter() - transfer_start)
+
+                self.record_download(item, convention_filename, convention_file_path, file_size)
+                return #if download is successful, move on to the next item.
+
+            except MediaItemUnavailableError as e: #the item is gone from Google Photos or no longer accessible
+                logging.error(f"DOWNLOADER: FAILED {e}")
+                self.record_failure(item)
+                self.download_counter.inc()
+                return
+            except (requests.exceptions.RequestException, OSError, BaseUrlLookupError) as e: #HTTP errors, timeouts, SSL, disk and batchGet errors: retry, as the async engine does
+                logging.error(f"DOWNLOADER: Error occurred while trying to get {image_url}: {e!r}. Attempt {attempt + 1} of {self.MAX_RETRIES}.")
+                if getattr(getattr(e, 'response', None), 'status_code', None) == 403:
+                    self.url_resolver.invalidate(item.id)  # expired baseUrl; fetch a new one for the retry
                 if attempt < self.MAX_RETRIES - 1:
-                    logging.error(f"DOWNLOADER: Error occurred while trying to get {image_url}: {e}. Retrying...")
-                    wait_time = (2 ** attempt) + random.random()  # Exponential backoff with jitter
-                    time.sleep(wait_time)
-                else:
-                    logging.error(f"DOWNLOADER: Failed to download {item['id']} after {self.MAX_RETRIES} attempts.")
-                    item['status'] = 'failed'
-                    self.download_counter += 1
-                    break
+                    time.sleep((2 ** attempt) + random.random())  # Exponential backoff with jitter
+        logging.error(f"DOWNLOADER: Failed to download {item.id} after {self.MAX_RETRIES} attempts.")
+        self.record_failure(item)
+
+    def media_url(self, item, base_url):
+        if 'video' in item.mimeType or '.mov' in item.filename:  # Check if 'video' is in mimeType. need to account for motion photos and other media types.
+            return base_url + '=dv' #motion videos also dowlnoad as =dv. Stil testing.
+        elif 'image' in item.mimeType:
+            return base_url + '=d'
+        else:
+            return base_url + '=d'
+
+    def download_slots(self):
+        # downloads in flight: worker threads, or async transfers
+        return self.transfer_concurrency if self.engine == 'async' else self.num_workers
+
+    def run_download_engine(self, all_media_items):
+        # photo and video lanes with their own workers, smallest files first within each lane
+        self.scheduler = DownloadScheduler(all_media_items.values(), self.download_slots(), self.video_share)
+        # roughly the order the workers will ask for baseUrls, so the resolver batches the ids they will need next
+        item_ids = [item.id for item in self.scheduler.planned_order()]
+        self.url_resolver.plan(item_ids, self.photos_api)
+        self.run_scheduler()
+
+    def run_scheduler(self):
+        # Runs the chosen engine over self.scheduler until it is finished.
+        logging.info(f"DOWNLOADER: Workers per lane: {self.scheduler.workers}")
+        if self.engine == 'async':
+            engine = AsyncDownloadEngine(self, self.rate_limiter, api_concurrency=self.api_concurrency,
+                                         transfer_concurrency=self.transfer_concurrency, timeout=self.session.timeout)
+            engine.run(self.scheduler)
+            self.connection_summary = engine.connection_summary
+        else:
+            self.scheduler.run(self.download_image)
+            self.connection_summary = self.session.connection_summary
 
     def download_photos(self, all_media_items): #this function downloads all photos and videos in the all_media_items list.
         self.download_start_timestamp = time.time()  # Record the starting time
         logging.info(f"DOWNLOADER: Total index size: {len(all_media_items)}")
-        self.potential_job_size = len([item for item in all_media_items.values() if item.get('status') not in ['downloaded', 'verified']])
+        self.potential_job_size = len([item for item in all_media_items.values() if item.status not in ['downloaded', 'verified']])
         downloader_start_time = time.time()
         try:
             logging.info(f"DOWNLOADER: Downloading {self.potential_job_size} files...") #might remove subsequent date filter.
             time.sleep(1.5)
-            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
-                executor.map(self.download_image, all_media_items.values())
+            self.run_download_engine(all_media_items)
 
         except Exception as e:
             logging.error(f"DOWNLOADER: An unexpected error occurred in download_photos: {e}")
         finally:
             logging.info(f"DOWNLOADER: All items processed, performing final checkpoint...")
             self.save_index_to_file(all_media_items)
-            downloader_end_time = time.time()
-            self.downloader_elapsed_time = downloader_end_time - downloader_start_time
-            logging.info(f"DOWNLOADER: Total time to download photos: {downloader_end_time - downloader_start_time} seconds")
-            logging.info(f"DOWNLOADER: Download rate: {self.potential_job_size / (downloader_end_time - downloader_start_time)} files per second")
-            logging.info(f"DOWNLOADER: Rate limiter stats: {rate_limiter}")
-            
+            self.log_download_stats(downloader_start_time)
+
+    def enqueue_downloads(self, records):
+        # fetch_and_download_photos: hand fetched items to the download workers.  Blocks while the queue is full.
+        records = [record for record in records if record.status not in ['downloaded', 'verified']]
+        if not records:
+            return
+        with self.index_lock:  # called from every fetch worker
+            self.potential_job_size += len(records)
+        self.url_resolver.add_pending([record.id for record in records])
+        self.scheduler.put(records)
+
+    def fetch_and_download_photos(self, queue_size=PIPELINE_QUEUE_SIZE):
+        # get_all_media_items and download_photos overlapped: the fetcher runs in its own thread and queues the new
+        # items of every search page while the workers download earlier ones.  The queue holds at most queue_size
+        # items, so the fetcher waits for the downloads rather than running ahead.  Both write only through
+        # update_item/add_item (journaled), and the index is saved once, after both have finished.
+        self.download_start_timestamp = time.time()
+        self.potential_job_size = 0
+        downloader_start_time = time.time()
+        self.scheduler = DownloadScheduler([], self.download_slots(), self.video_share, streaming=True, capacity=queue_size)
+        self.url_resolver.plan([], self.photos_api)
+        fetch_errors = []
 
-    def report_stats(self): #this function reports the status of all items in the index.
-        # Initialize counters
-        total_size = 0
-        total_files = 0
-        total_images = 0
-        total_videos = 0
-        recent_changes = 0
-        status_counts = {}
+        def fetch():
+            try:
+                self.get_all_media_items(on_new_items=self.enqueue_downloads, save=False)
+            except Exception as e:
+                logging.error(f"FETCHER: Fetch stopped with an error, downloading what was queued: {e}")
+                fetch_errors.append(e)
+            finally:
+                self.scheduler.close()
+
+        fetcher = threading.Thread(target=fetch, name='fetcher')
+        fetcher.start()
+        try:
+            logging.info(f"DOWNLOADER: Downloading while fetching, up to {queue_size} items queued...")
+            self.run_scheduler()
+        except Exception as e:
+            logging.error(f"DOWNLOADER: An unexpected error occurred in fetch_and_download_photos: {e}")
+        finally:
+            self.scheduler.cancel()  # lets the fetcher finish the index if the downloads stopped early
+            fetcher.join()
+            self.all_item_count = len(self.all_media_items)
+            logging.info("DOWNLOADER: Fetch and download finished, performing final checkpoint...")
+            self.save_index_to_file(self.all_media_items)
+            self.log_download_stats(downloader_start_time)
+        if fetch_errors:
+            raise fetch_errors[0]
+
+    def sync(self, overlap_days=SYNC_OVERLAP_DAYS, deep=False, deep_every_days=None, download=True, pipeline=False, queue_size=PIPELINE_QUEUE_SIZE):
+        # Incremental fetch (and download).  Fetches from the high-water mark in SyncState.json, less overlap_days for
+        # late uploads of older media, to end_date, so frequent syncs only page through the newest items.  A deep sync
+        # (the first one, deep=True, or one every deep_every_days) fetches the whole start_date..end_date range and also
+        # retries downloads that failed for older items.  The mark only moves after a fetch that finished.
+        state = SyncState(self.backup_path).load()
         now = datetime.now(timezone.utc)
+        deep = deep or state.deep_sync_due(now, deep_every_days)
+        if not deep:
+            mark = datetime.fromtimestamp(state.newest_creation, tzlocal()) - timedelta(days=overlap_days)
+            self.start_date = max(self.start_date, mark.strftime('%Y-%m-%d'))
+        logging.info(f"SYNC: {'Deep' if deep else 'Incremental'} sync from {self.start_date} to {self.end_date}. Last sync: {state.last_sync}, last deep sync: {state.last_deep_sync}")
+        self.load_index_from_file()
+        if download and pipeline:
+            self.fetch_and_download_photos(queue_size)
+        else:
+            self.get_all_media_items()
+            if download:
+                self.download_photos(self.missing_media_items())
+        # newest item of the fetched range; a camera clock set in the future must not push the mark past now
+        newest = max((item.creation_ts for item in self.all_media_items.values() if item.creation_ts is not None), default=None)
+        state.record(now, min(newest, now.timestamp()) if newest is not None else None, deep)
+        logging.info(f"SYNC: Done. High-water mark: {format_creation_time(state.newest_creation) if state.newest_creation is not None else None}")
+
+    def collect_metrics(self):
+        # Gauges derived from other state; MetricsRegistry calls this before every export and summary.
+        metrics = self.metrics
+        now, downloaded_bytes = time.monotonic(), self.total_file_size.value
+        last_time, last_bytes = self.last_collect
+        if now > last_time:
+            metrics.gauge('gpd_download_bytes_per_second', 'Download throughput since the previous export').set((downloaded_bytes - last_bytes) / (now - last_time))
+        self.last_collect = (now, downloaded_bytes)
+        metrics.gauge('gpd_download_average_bytes_per_second', 'Download throughput since the command started').set(
+            downloaded_bytes / max(time.time() - metrics.started, 1e-9))
+        if self.scheduler is not None:
+            for lane, depth in self.scheduler.depths().items():
+                metrics.gauge('gpd_download_queue_depth', 'Items waiting for a download worker', lane=lane).set(depth)
+        metrics.gauge('gpd_base_url_queue_depth', 'Ids waiting to be batched into a batchGet call').set(len(self.url_resolver.pending))
+        for bucket in (self.rate_limiter.api, self.rate_limiter.content):
+            metrics.gauge('gpd_rate_limit_per_second', 'Current rate of a rate limiter bucket', bucket=bucket.name).set(bucket.rate)
+
+    def run_all(self, pipeline=False, queue_size=PIPELINE_QUEUE_SIZE):
+        # scan, fetch, download, validate and report, as the run_all command does
+        self.scandisk_and_get_filepaths_and_filenames()
+        if pipeline:
+            self.fetch_and_download_photos(queue_size)
+        else:
+            self.get_all_media_items()
+            missing_media_items = self.missing_media_items()
+            self.download_photos(missing_media_items)
+        self.validate_repository()
+        self.report_stats()
+
+    def log_download_stats(self, downloader_start_time):
+        downloader_end_time = time.time()
+        self.downloader_elapsed_time = downloader_end_time - downloader_start_time
+        logging.info(f"DOWNLOADER: Total time to download photos: {downloader_end_time - downloader_start_time} seconds")
+        logging.info(f"DOWNLOADER: Download rate: {self.potential_job_size / (downloader_end_time - downloader_start_time)} files per second")
+        logging.info(f"DOWNLOADER: Rate limiter stats: {self.rate_limiter}")
+        logging.info(f"DOWNLOADER: baseUrl cache: {self.url_resolver}")
+        stages = {'batchGet': self.api_latency['batchGet'], 'first byte': self.ttfb_latency, 'transfer': self.transfer_latency, 'disk write': self.disk_write_latency}
+        logging.info("DOWNLOADER: Latency p50/p90 (s): " + ', '.join(
+            f"{stage} {histogram.quantile(0.5) or 0:.3f}/{histogram.quantile(0.9) or 0:.3f}" for stage, histogram in stages.items()))
+        if self.connection_summary is not None:
+            logging.info(f"DOWNLOADER: Connection reuse: {self.connection_summary()}")
+        if self.scheduler is not None:
+            logging.info(f"DOWNLOADER: Per lane: {self.scheduler.summary()}")
 
-        for item in self.all_media_items.values():
-            # Update the total size
-            if item.get('status') in ['downloaded', 'verified'] and 'file_size' in item:
-                total_size += item['file_size']
-
-            # Update the total number of files
-            total_files += 1
-
-            # Update the total number of images and videos
-            if 'image' in item['mimeType']:
-                total_images += 1
-            elif 'video' in item['mimeType']:
-                total_videos += 1
 
-            # Check for recent changes
-            creation_time = datetime.strptime(item['mediaMetadata']['creationTime'], "%Y-%m-%dT%H:%M:%S%z")
-            if (now - creation_time).days <= 7:  # Change this to the desired number of days
-                recent_changes += 1
-            
-            # Count the statuses
-            status = item.get('status')
-            if status not in status_counts:
-                status_counts[status] = 1
-            else:
-                status_counts[status] += 1
+    def report_stats(self): #this function reports the status of all items in the index.
+        if not self.all_media_items and self.journal.has_entries():
+            self.load_index_from_file()  # fold outstanding journal entries in before counting
+        if self.dirty_item_ids:
+            self.save_index_to_file(self.all_media_items)  # make sure the index store reflects in-memory changes
+        if self.all_media_items:
+            stats = self.media_index.stats()
+        else:
+            stats = self.index_store.stats() #the index store loads or queries the index itself
 
         # Print the stats
-        logging.info(f"Total size: {total_size/1024/1024/1024} gigabytes") #of downloaded or verified files.
-        logging.info(f"Total file records: {total_files}")
-        logging.info(f"Total image records: {total_images}")
-        logging.info(f"Total video records: {total_videos}")
-        logging.info(f"Recently created media: {recent_changes}")
+        logging.info(f"Total size: {stats['total_size']/1024/1024/1024} gigabytes") #of downloaded or verified files.
+        logging.info(f"Total file records: {stats['total_files']}")
+        logging.info(f"Total image records: {stats['total_images']}")
+        logging.info(f"Total video records: {stats['total_videos']}")
+        logging.info(f"Recently created media: {stats['recent_changes']}")
          # Print the status counts
-        for status, count in status_counts.items():
+        for status, count in stats['status_counts'].items():
             logging.info(f"Status field tallies '{status}': {count} items")
 
     def save_index_to_file(self, all_items):
         logging.info("Starting to save lists to file...")
-        if os.access(self.downloaded_items_path, os.W_OK):
-            # Load existing items
-            if os.path.exists(self.downloaded_items_path):
-                with open(self.downloaded_items_path, 'r') as f:
-                    existing_items_dict = json.load(f)
-            else:
-                existing_items_dict = {}
-
-            # Update existing items and append new ones
-            for item in all_items.values():
-                if item['id'] in existing_items_dict:
-                    existing_items_dict[item['id']].update(item)  # Update existing item
-                else:
-                    existing_items_dict[item['id']] = item  # Append new item
-
-            # Write the updated items back to the file
-            with open(self.downloaded_items_path, 'w') as f:
-                json.dump(existing_items_dict, f, indent=4)
-
-            logging.info("INDEX UPDATER: Successfully saved lists to file.")
+        with self.index_lock:
+            dirty_ids = self.dirty_item_ids & all_items.keys()
+            self.dirty_item_ids -= dirty_ids
+            # The journal can only be compacted if this save covers every outstanding change.
+            compact_journal = not self.dirty_item_ids
+        if compact_journal:
+            self.journal.rotate()
+        else:
+            self.journal.flush()
+        if self.index_store.save(all_items, dirty_ids):
+            if compact_journal:
+                self.journal.discard_rotated()
+            logging.info(f"INDEX UPDATER: Successfully saved lists to {self.index_store.path}.")
         else:
-            logging.error(f"INDEX UPDATER: No write access to the file: {self.downloaded_items_path}")  
+            with self.index_lock:
+                self.dirty_item_ids |= dirty_ids  # keep them for the next attempt
 
     def load_index_from_file(self): #to implement throughout.
 
-        self.all_media_items_path = os.path.normpath(os.path.join(self.backup_path, 'DownloadItems.json'))
-        if os.path.exists(self.all_media_items_path):
+        self.all_media_items_path = self.index_store.path
+        if self.index_store.exists():
             self.all_media_items = {}
             try:
-                with open(self.all_media_items_path, 'r') as f:
-                    self.all_media_items = json.load(f)
-                logging.info(f"Loaded {len(self.all_media_items)} existing media items from file.")
+                self.all_media_items = self.index_store.load()
+                logging.info(f"Loaded {len(self.all_media_items)} existing media items from {self.all_media_items_path}.")
             except json.JSONDecodeError:
                 logging.info("There was an error decoding the JSON file. Please check the file format.")
+        # Replay changes made after the last snapshot (e.g. by an interrupted download run)
+        replayed_ids = self.journal.replay(self.all_media_items)
+        with self.index_lock:
+            self.dirty_item_ids |= replayed_ids
+        self.media_index.rebuild(self.all_media_items)
+
+    def query_index(self, status_in=None, status_not_in=None, start_date=None, end_date=None, mime=None, filename=None, limit=50):
+        # Offline lookup in the local index.  Dates are YYYY-MM-DD in local time, like --start_date/--end_date.
+        if not self.all_media_items:
+            self.load_index_from_file()
+        created_between = None
+        if start_date or end_date:
+            created_between = (
+                datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=tzlocal()).timestamp() if start_date else None,
+                (datetime.strptime(end_date, "%Y-%m-%d").replace(tzinfo=tzlocal()) + timedelta(days=1, seconds=-1)).timestamp() if end_date else None)
+        results = self.media_index.items(status_in=status_in, status_not_in=status_not_in, created_between=created_between, mime=mime, filename=filename)
+        logging.info(f"QUERY: {len(results)} matching items")
+        for count, record in enumerate(results.values()):
+            if limit is not None and count >= limit:
+                print(f"... {len(results) - limit} more (use --limit to show more)")
+                break
+            print(f"{record.id}\t{record.status}\t{record.creationTime}\t{record.mimeType}\t{record.filename}\t{record.file_path or ''}")
+        return results
+
+    def missing_media_items(self):
+        # Items that still need downloading
+        return self.media_index.items(status_not_in=['downloaded', 'verified'])
+
+    def compact_index(self):
+        # Fold the journal into a new index snapshot.
+        self.load_index_from_file()
+        self.save_index_to_file(self.all_media_items)
 
 if __name__ == "__main__":
+    metrics = exporter = profiler = None
     try:
         parser = argparse.ArgumentParser(description='Google Photos Downloader')
         subparsers = parser.add_subparsers(dest='command')
@@ -664,6 +855,10 @@ if __name__ == "__main__":
             command_parser.add_argument('--start_date', type=str, default='1800-01-01', required=False, help='Start date in the format YYYY-MM-DD')
             command_parser.add_argument('--end_date', type=str, default=(datetime.now(timezone.utc) + timedelta(days=1)).strftime('%Y-%m-%d'), required=False, help='End date in the format YYYY-MM-DD')#default end_date now
             command_parser.add_argument('--num_workers', type=int, default=1, required=False, help='Number of worker threads for downloading images')
+            command_parser.add_argument('--scan_workers', type=int, default=8, required=False, help='Number of threads listing the backup folder')
+            command_parser.add_argument('--full_rescan', '--full-rescan', action='store_true', help='Ignore the scan cache and list every folder again')
+            command_parser.add_argument('--extraneous', type=str, choices=EXTRANEOUS_POLICIES, default='ask', help='What the validator does with files that are not in the index')
+            command_parser.add_argument('--quarantine_dir', type=str, default=None, help=f'Where --extraneous quarantine moves files. Defaults to {QUARANTINE_DIRNAME} in the backup folder')
         
         # Sub-parser for download
         run_all_parser = subparsers.add_parser('download', help='Fetch new items and download them and report stats in sequence')
@@ -678,61 +873,177 @@ if __name__ == "__main__":
         run_all_parser.add_argument('--end_date', type=str, default=(datetime.now(timezone.utc) + timedelta(days=1)).strftime('%Y-%m-%d'), required=False, help='End date in the format YYYY-MM-DD')#default end_date now
         run_all_parser.add_argument('--backup_path', type=str, required=True, help='Path to the folder where you want to save the backup')
         run_all_parser.add_argument('--num_workers', type=int, default=1, help='Number of worker threads for downloading images')
+        run_all_parser.add_argument('--scan_workers', type=int, default=8, help='Number of threads listing the backup folder')
+        run_all_parser.add_argument('--full_rescan', '--full-rescan', action='store_true', help='Ignore the scan cache and list every folder again')
+        run_all_parser.add_argument('--extraneous', type=str, choices=EXTRANEOUS_POLICIES, default='ask', help='What the validator does with files that are not in the index')
+        run_all_parser.add_argument('--quarantine_dir', type=str, default=None, help=f'Where --extraneous quarantine moves files. Defaults to {QUARANTINE_DIRNAME} in the backup folder')
+
+        # Sub-parser for sync
+        sync_parser = subparsers.add_parser('sync', help='Fetch and download only what was added since the last sync')
+        sync_parser.add_argument('--backup_path', type=str, required=True, help='Path to the folder where you want to save the backup')
+        sync_parser.add_argument('--start_date', type=str, default='1800-01-01', required=False, help='Start of the range a deep sync fetches, YYYY-MM-DD')
+        sync_parser.add_argument('--end_date', type=str, default=(datetime.now(timezone.utc) + timedelta(days=1)).strftime('%Y-%m-%d'), required=False, help='End date in the format YYYY-MM-DD')#default end_date now
+        sync_parser.add_argument('--num_workers', type=int, default=1, help='Number of worker threads for downloading images')
+        sync_parser.add_argument('--overlap_days', type=float, default=SYNC_OVERLAP_DAYS, help='Fetch this many days before the newest item seen so far, for late uploads of older media')
+        sync_parser.add_argument('--deep', action='store_true', help='Fetch the whole date range this time, as the first sync does')
+        sync_parser.add_argument('--deep_every_days', type=float, default=None, help='Make a sync a deep one when the last deep sync is older than this')
+        sync_parser.add_argument('--no_download', action='store_true', help='Only update the index')
+
+        # Sub-parser for verify_content
+        verify_parser = subparsers.add_parser('verify_content', help='Hash downloaded files and flag zero-byte, truncated or resized files')
+        verify_parser.add_argument('--backup_path', type=str, required=True, help='Path to the folder where you want to save the backup')
+        verify_parser.add_argument('--hash_workers', type=int, default=None, help='Number of processes hashing files. Defaults to the number of CPU cores')
+        verify_parser.add_argument('--scan_workers', type=int, default=8, help='Number of threads listing the backup folder')
+        verify_parser.add_argument('--rehash', action='store_true', help='Hash every file again, ignoring the hashes stored in the index')
+
+        # Download engine options
+        for command_parser in [download_parser, subparsers.choices['download'], run_all_parser, sync_parser]:
+            command_parser.add_argument('--engine', type=str, choices=ENGINES, default='threads', help='threads: num_workers blocking workers. async: one asyncio event loop (needs aiohttp)')
+            command_parser.add_argument('--api_concurrency', type=int, default=2, help='async engine: API calls in flight')
+            command_parser.add_argument('--transfer_concurrency', type=int, default=16, help='async engine: downloads in flight')
+            command_parser.add_argument('--connect_timeout', type=float, default=CONNECT_TIMEOUT, help='Seconds to wait for a connection to the content server')
+            command_parser.add_argument('--read_timeout', type=float, default=READ_TIMEOUT, help='Seconds a download may go without receiving data')
+            command_parser.add_argument('--video_share', type=float, default=VIDEO_SHARE, help='Share of the workers (or async transfers) reserved for videos; the rest download photos, smallest first')
+
+        # Pipelined fetch and download
+        for command_parser in [subparsers.choices['download'], run_all_parser, sync_parser]:
+            command_parser.add_argument('--pipeline', action='store_true', help='Start downloading while the index is still being fetched')
+            command_parser.add_argument('--queue_size', type=int, default=PIPELINE_QUEUE_SIZE, help='--pipeline: most fetched items waiting for a download worker')
+
+        # Rate limiter options for every command that calls the API
+        for command_parser in [fetch_parser, download_parser, subparsers.choices['download'], run_all_parser, sync_parser]:
+            command_parser.add_argument('--api_rate', type=float, default=1, help='Library API requests per second to start at')
+            command_parser.add_argument('--api_max_rate', type=float, default=5, help='Library API requests per second the limiter may ramp up to while the API keeps answering')
+            command_parser.add_argument('--content_rate', type=float, default=20, help='File downloads started per second to start at')
+            command_parser.add_argument('--fetch_workers', type=int, default=FETCH_WORKERS, help='Date shards of the index fetched at the same time')
+            command_parser.add_argument('--api_base_url', type=str, default=None, help='Use this server instead of Google, without OAuth, e.g. a gpd_fakeserver.FakePhotosServer for benchmarks')
+
+        # Sub-parser for import_index
+        import_parser = subparsers.add_parser('import_index', help='Import an existing DownloadItems.json into the SQLite index (DownloadItems.db)')
+        import_parser.add_argument('--backup_path', type=str, required=True, help='Path to the folder where you want to save the backup')
+
+        # Sub-parser for compact_index
+        compact_parser = subparsers.add_parser('compact_index', help='Fold the change journal (DownloadItems.journal) into a new index snapshot')
+        compact_parser.add_argument('--backup_path', type=str, required=True, help='Path to the folder where you want to save the backup')
+        compact_parser.add_argument('--start_date', type=str, default='1800-01-01', required=False, help='Start date in the format YYYY-MM-DD')
+        compact_parser.add_argument('--end_date', type=str, default=(datetime.now(timezone.utc) + timedelta(days=1)).strftime('%Y-%m-%d'), required=False, help='End date in the format YYYY-MM-DD')#default end_date now
+
+        # Sub-parser for query
+        query_parser = subparsers.add_parser('query', help='Look up items in the local index without contacting Google')
+        query_parser.add_argument('--backup_path', type=str, required=True, help='Path to the folder where you want to save the backup')
+        query_parser.add_argument('--status', type=str, nargs='+', default=None, help='Only items with one of these statuses')
+        query_parser.add_argument('--exclude_status', type=str, nargs='+', default=None, help='Skip items with any of these statuses')
+        query_parser.add_argument('--start_date', type=str, default=None, help='Only items created on or after this date (YYYY-MM-DD)')
+        query_parser.add_argument('--end_date', type=str, default=None, help='Only items created on or before this date (YYYY-MM-DD)')
+        query_parser.add_argument('--mime', type=str, default=None, help="mimeType or prefix, e.g. 'video' or 'image/heic'")
+        query_parser.add_argument('--filename', type=str, default=None, help='Exact filename as recorded in the index')
+        query_parser.add_argument('--limit', type=int, default=50, help='Maximum number of items to print')
+
+        # Options shared by every command that opens the index
+        for command_parser in subparsers.choices.values():
+            if command_parser is not import_parser:
+                command_parser.add_argument('--index_backend', type=str, choices=INDEX_BACKENDS, default=None, help='Index storage backend. Defaults to sqlite if DownloadItems.db exists, otherwise json')
+
+        # Metrics options, for every command
+        for command_parser in subparsers.choices.values():
+            command_parser.add_argument('--metrics_textfile', type=str, default=None, help='Prometheus textfile to rewrite every --metrics_interval seconds while the command runs, e.g. for node_exporter')
+            command_parser.add_argument('--metrics_interval', type=float, default=EXPORT_INTERVAL, help='Seconds between writes of --metrics_textfile')
+            command_parser.add_argument('--metrics_summary', type=str, default=None, help='JSON summary of the metrics written when the command ends. Defaults to Metrics/<command>_<UTC time>.json in the backup folder')
+            command_parser.add_argument('--profile', action='store_true', help='Profile each phase with cProfile and tracemalloc into Profiles/<command>_<UTC time> in the backup folder, and print wall time, CPU time and peak memory per phase')
 
         args = parser.parse_args()
 
         log_filename = os.path.join(args.backup_path, 'google_photos_downloader.log')
         logging.basicConfig(filename=log_filename, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-        rate_limiter = TokenBucket(rate=1, capacity=2)  # You can adjust these numbers based on the rate limits 
+        # one metrics registry per run, shared by everything the command does; see gpd_metrics.py
+        metrics = MetricsRegistry()
+        exporter = MetricsExporter(metrics, args.metrics_textfile, args.metrics_interval).start() if args.metrics_textfile else None
+        # --profile: cProfile and tracemalloc per phase; see gpd_profile.py
+        profiler = PhaseProfiler(os.path.join(args.backup_path, PROFILES_DIRNAME, f"{args.command}_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}")).start() if args.profile else None
 
-        if args.command == 'auth':
-            downloader = GooglePhotosDownloader(args.backup_path)
+        # one limiter per run, backing off on 429/5xx; see gpd_ratelimit.py
+        rate_limiter = RateLimiter(api_rate=args.api_rate, api_max_rate=args.api_max_rate, content_rate=args.content_rate) if 'api_rate' in args else None
+
+        if args.command == 'import_index':
+            index_store = SqliteIndexStore(args.backup_path)
+            index_store.import_json(os.path.join(args.backup_path, 'DownloadItems.json'))
+            index_store.close()
+
+        elif args.command == 'compact_index':
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, index_backend=args.index_backend, offline=True, metrics=metrics, profiler=profiler)
+            downloader.compact_index()
+
+        elif args.command == 'query':
+            downloader = GooglePhotosDownloader(None, None, args.backup_path, index_backend=args.index_backend, offline=True, metrics=metrics, profiler=profiler)
+            downloader.query_index(status_in=args.status, status_not_in=args.exclude_status, start_date=args.start_date, end_date=args.end_date,
+                                   mime=args.mime, filename=args.filename, limit=args.limit)
+
+        elif args.command == 'verify_content':
+            downloader = GooglePhotosDownloader(None, None, args.backup_path, index_backend=args.index_backend, offline=True, scan_workers=args.scan_workers, metrics=metrics, profiler=profiler)
+            downloader.verify_content(hash_workers=args.hash_workers, rehash=args.rehash)
+
+        elif args.command == 'auth':
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, index_backend=args.index_backend, metrics=metrics, profiler=profiler)
             downloader.authenticate()
 
         elif args.command == 'stats_only':
-            downloader = GooglePhotosDownloader(args.backup_path)
-            downloader.load_index_from_file()
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, index_backend=args.index_backend, metrics=metrics, profiler=profiler)
             downloader.report_stats()
 
         elif args.command == 'validate_only':
-            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, args.num_workers)
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, args.num_workers, index_backend=args.index_backend, scan_workers=args.scan_workers, full_rescan=args.full_rescan,
+                                                extraneous_policy=args.extraneous, quarantine_dir=args.quarantine_dir, metrics=metrics, profiler=profiler)
             downloader.load_index_from_file()
             downloader.validate_repository()
 
         elif args.command == 'scan_only':
-            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, args.num_workers)
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, args.num_workers, index_backend=args.index_backend, scan_workers=args.scan_workers, full_rescan=args.full_rescan,
+                                                extraneous_policy=args.extraneous, quarantine_dir=args.quarantine_dir, metrics=metrics, profiler=profiler)
             downloader.scandisk_and_get_filepaths_and_filenames()
 
         elif args.command == 'download_missing':
-            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, args.num_workers)
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, args.num_workers, index_backend=args.index_backend,
+                                                engine=args.engine, api_concurrency=args.api_concurrency, transfer_concurrency=args.transfer_concurrency,
+                                                connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, rate_limiter=rate_limiter, video_share=args.video_share, metrics=metrics, api_base_url=args.api_base_url, profiler=profiler)
             downloader.load_index_from_file()
-            missing_media_items = {id: item for id, item in downloader.all_media_items.items() if item.get('status') not in ['downloaded', 'verified']}
+            missing_media_items = downloader.missing_media_items()
             downloader.download_photos(missing_media_items)
             downloader.save_index_to_file(missing_media_items)
 
         elif args.command == 'fetch_only':  #need to add process to remove extraneous index entries
-            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path)
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, index_backend=args.index_backend, rate_limiter=rate_limiter, fetch_workers=args.fetch_workers, metrics=metrics, api_base_url=args.api_base_url, profiler=profiler)
             downloader.load_index_from_file()
             downloader.get_all_media_items()
 
         elif args.command == 'download':
-            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, args.num_workers)
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, args.num_workers, index_backend=args.index_backend,
+                                                engine=args.engine, api_concurrency=args.api_concurrency, transfer_concurrency=args.transfer_concurrency,
+                                                connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, rate_limiter=rate_limiter, fetch_workers=args.fetch_workers, video_share=args.video_share, metrics=metrics, api_base_url=args.api_base_url, profiler=profiler)
             downloader.load_index_from_file()
-            downloader.get_all_media_items()
-            missing_media_items = {id: item for id, item in downloader.all_media_items.items() if item.get('status') not in ['downloaded', 'verified']}
-            downloader.download_photos(missing_media_items)
+            if args.pipeline:
+                downloader.fetch_and_download_photos(args.queue_size)
+            else:
+                downloader.get_all_media_items()
+                missing_media_items = downloader.missing_media_items()
+                downloader.download_photos(missing_media_items)
             downloader.report_stats()
         
-        elif args.command == 'run_all':
-            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, num_workers=args.num_workers)
-            downloader.scandisk_and_get_filepaths_and_filenames()
-            downloader.get_all_media_items()
-            missing_media_items = {id: item for id, item in downloader.all_media_items.items() if item.get('status') not in ['downloaded', 'verified']}
-            downloader.download_photos(missing_media_items)
-            downloader.validate_repository()
+        elif args.command == 'sync':
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, args.num_workers, index_backend=args.index_backend,
+                                                engine=args.engine, api_concurrency=args.api_concurrency, transfer_concurrency=args.transfer_concurrency,
+                                                connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, rate_limiter=rate_limiter, fetch_workers=args.fetch_workers, video_share=args.video_share, metrics=metrics, api_base_url=args.api_base_url, profiler=profiler)
+            downloader.sync(overlap_days=args.overlap_days, deep=args.deep, deep_every_days=args.deep_every_days, download=not args.no_download,
+                            pipeline=args.pipeline, queue_size=args.queue_size)
             downloader.report_stats()
 
+        elif args.command == 'run_all':
+            downloader = GooglePhotosDownloader(args.start_date, args.end_date, args.backup_path, num_workers=args.num_workers, index_backend=args.index_backend, scan_workers=args.scan_workers, full_rescan=args.full_rescan,
+                                                extraneous_policy=args.extraneous, quarantine_dir=args.quarantine_dir,
+                                                engine=args.engine, api_concurrency=args.api_concurrency, transfer_concurrency=args.transfer_concurrency,
+                                                connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, rate_limiter=rate_limiter, fetch_workers=args.fetch_workers, video_share=args.video_share, metrics=metrics, api_base_url=args.api_base_url, profiler=profiler)
+            downloader.run_all(pipeline=args.pipeline, queue_size=args.queue_size)
+
         else:
             downloader = GooglePhotosDownloader(args.backup_path)
             downloader.load_index_from_file()
@@ -741,6 +1052,19 @@ if __name__ == "__main__":
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}")
         traceback.print_exc()
+    finally:
+        if profiler is not None:
+            print(profiler.finish())
+            logging.info(f"PROFILER: Profiles and summary written to {profiler.output_dir}")
+        if metrics is not None:  # also after a failed command, so a nightly run always leaves its numbers behind
+            if exporter is not None:
+                exporter.stop()
+            summary_path = args.metrics_summary or os.path.join(args.backup_path, METRICS_DIRNAME, f"{args.command}_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.json")
+            try:
+                metrics.write_summary(summary_path, command=args.command, options={key: value for key, value in vars(args).items() if key != 'command'})
+                logging.info(f"METRICS: Summary written to {summary_path}")
+            except OSError as e:
+                logging.error(f"METRICS: Could not write {summary_path}: {e}")
 
 
 #sample usage: 
@@ -749,8 +1073,24 @@ if __name__ == "__main__":
 #python google_photos_downloader.py stats_only --backup_path C:\users\alexw\onedrive\gphotos
 #python google_photos_downloader.py validate_only --backup_path C:\users\alexw\onedrive\gphotos
 #python google_photos_downloader.py scan_only --backup_path C:\users\alexw\onedrive\gphotos
+#python google_photos_downloader.py scan_only --backup_path C:\users\alexw\onedrive\gphotos --full-rescan
+#python google_photos_downloader.py validate_only --backup_path C:\users\alexw\onedrive\gphotos --extraneous quarantine
+#python google_photos_downloader.py verify_content --backup_path C:\users\alexw\onedrive\gphotos --hash_workers 4
 #python google_photos_downloader.py auth --backup_path C:\users\alexw\onedrive\gphotos
 #python google_photos_downloader.py run_all --start_date 2023-01-01 --end_date 2023-12-31 --backup_path C:\users\alexw\onedrive\gphotos --num_workers 5
 #python google_photos_downloader.py download --backup_path c:\users\alexw\onedrive\gphotos --num_workers 1
+#python google_photos_downloader.py query --backup_path C:\users\alexw\onedrive\gphotos --status missing failed --mime video
+#python google_photos_downloader.py import_index --backup_path C:\users\alexw\onedrive\gphotos
+#python google_photos_downloader.py download_missing --backup_path C:\users\alexw\onedrive\gphotos --index_backend sqlite
+#python google_photos_downloader.py download_missing --backup_path C:\users\alexw\onedrive\gphotos --engine async --transfer_concurrency 32
+#python google_photos_downloader.py download_missing --backup_path C:\users\alexw\onedrive\gphotos --num_workers 8 --video_share 0.5
+#python google_photos_downloader.py download --start_date 2023-01-01 --backup_path C:\users\alexw\onedrive\gphotos --pipeline --queue_size 1000
+#python google_photos_downloader.py fetch_only --start_date 2023-01-01 --end_date 2023-12-31 --backup_path C:\users\alexw\onedrive\gphotos --api_rate 2 --api_max_rate 10
+#python google_photos_downloader.py sync --backup_path C:\users\alexw\onedrive\gphotos --num_workers 4 --deep_every_days 7
+#python google_photos_downloader.py sync --backup_path C:\users\alexw\onedrive\gphotos --deep --no_download
+#python google_photos_downloader.py fetch_only --start_date 2015-01-01 --end_date 2023-12-31 --backup_path C:\users\alexw\onedrive\gphotos --fetch_workers 8 --api_max_rate 10
+#python google_photos_downloader.py sync --backup_path C:\users\alexw\onedrive\gphotos --metrics_textfile C:\node_exporter\textfile\gphotos.prom --metrics_interval 30
+#python google_photos_downloader.py run_all --start_date 2023-01-01 --backup_path C:\users\alexw\onedrive\gphotos --profile
+#python google_photos_downloader.py run_all --start_date 2023-01-01 --backup_path C:\temp\gphotos_fake --api_base_url http://127.0.0.1:8080
 
 #python C:\Users\alexw\OneDrive\github\GooglePhotoSync\google_photos_downloader.py download --start_date 2023-08-02 --backup_path C:\users\alexw\onedrive\gphotos
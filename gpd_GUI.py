@@ -30,7 +30,7 @@ def run_command():
     if command == 'download_missing':
         downloader = GooglePhotosDownloader(start_date, end_date, backup_path, num_workers)
         downloader.load_index_from_file()
-        missing_media_items = {id: item for id, item in downloader.all_media_items.items() if item.get('status') not in ['downloaded', 'verified']}
+        missing_media_items = downloader.missing_media_items()
         downloader.download_photos(missing_media_items)
     elif command == 'fetch_only':
         downloader = GooglePhotosDownloader(start_date, end_date, backup_path)
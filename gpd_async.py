@@ -0,0 +1,168 @@
+# asyncio download engine for the Google Photos Downloader (--engine async).
+# One event loop drives every transfer, so many downloads can be in flight without a thread each.  API lookups
+# (baseUrl batches through BaseUrlResolver) and content transfers have separate concurrency limits, and the blocking
+# pieces, the Google API client and file writes, run in a small thread pool so they never stall the loop.  API tokens
+# are taken inside those threads by the resolver; content tokens are waited for on the loop.
+# Index updates go through the same GooglePhotosDownloader methods as the threaded engine.
+
+import os
+import time
+import random
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiohttp
+except ImportError:  # only needed for --engine async
+    aiohttp = None
+
+from gpd_download import PartFile, resume_offset, range_headers, MediaItemUnavailableError, BaseUrlLookupError, IncompleteDownloadError, DOWNLOAD_CHUNK_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT
+
+ENGINES = ['threads', 'async']
+
+
+async def acquire_token(bucket):
+    # TokenBucket.acquire() without blocking the event loop: sleep until the next token is due.
+    while True:
+        delay = bucket.try_acquire()
+        if not delay:
+            return
+        await asyncio.sleep(delay)
+
+
+class AsyncDownloadEngine:
+    def __init__(self, downloader, rate_limiter, api_concurrency=2, transfer_concurrency=32, io_threads=8,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        self.downloader = downloader
+        self.rate_limiter = rate_limiter  # gpd_ratelimit.RateLimiter
+        self.api_concurrency = api_concurrency  # batchGet calls in flight
+        self.transfer_concurrency = transfer_concurrency  # downloads in flight
+        self.io_threads = io_threads  # threads for file writes and API calls
+        self.chunk_size = chunk_size
+        self.timeout = timeout  # (connect, read) seconds, as for PooledSession
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.executor = None
+        self.api_semaphore = None
+
+    def run(self, scheduler):
+        # scheduler: gpd_schedule.DownloadScheduler, split over transfer_concurrency workers
+        if aiohttp is None:
+            raise RuntimeError("--engine async needs the aiohttp package: pip install aiohttp")
+        asyncio.run(self._run(scheduler))
+
+    async def _run(self, scheduler):
+        self.api_semaphore = asyncio.Semaphore(self.api_concurrency)
+        connector = aiohttp.TCPConnector(limit=self.transfer_concurrency)  # keep-alive pool shared by all workers
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout[0], sock_read=self.timeout[1])
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_created)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+        with ThreadPoolExecutor(max_workers=self.io_threads) as executor:
+            self.executor = executor
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[trace_config]) as session:
+                # A fixed set of workers, each pulling from its lane of the scheduler, keeps memory flat however
+                # many items there are.
+                await asyncio.gather(*(self._worker(session, scheduler, lane) for lane in scheduler.worker_lanes()))
+
+    async def _on_connection_created(self, session, context, params):
+        self.new_connections += 1
+
+    async def _on_connection_reused(self, session, context, params):
+        self.reused_connections += 1
+
+    def connection_summary(self):
+        return (f"{self.new_connections + self.reused_connections} requests on {self.new_connections} connections, "
+                f"{self.reused_connections} handshakes saved")
+
+    async def _worker(self, session, scheduler, lane):
+        while True:
+            item = scheduler.next_item(lane, wait=False)  # never block the loop
+            if item is None:
+                if scheduler.finished():
+                    return
+                await asyncio.sleep(0.1)  # streaming scheduler: the fetcher has not queued more yet
+                continue
+            start = time.monotonic()
+            try:
+                await self.download_item(session, item)
+            except Exception as e:  # keep the worker going, as the thread pool does
+                logging.error(f"DOWNLOADER: Unexpected error downloading {item.id}: {e!r}")
+            finally:
+                scheduler.record(item, time.monotonic() - start)
+
+    def _offload(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def base_url(self, item):
+        resolver = self.downloader.url_resolver
+        url = resolver.cached_url(item.id)
+        if url is not None:
+            return url
+        async with self.api_semaphore:
+            url = resolver.cached_url(item.id)  # resolved by another worker's batch while this one waited
+            if url is not None:
+                return url
+            return await self._offload(resolver.base_url, item.id)  # blocks on the api bucket in the thread
+
+    async def download_item(self, session, item):
+        downloader = self.downloader
+        convention_filename, convention_file_path = downloader.construct_file_path(item)
+        logging.info(f"DOWNLOADER: Starting download request for {convention_file_path}")
+        for attempt in range(downloader.MAX_RETRIES):
+            image_url = None
+            try:
+                image_url = downloader.media_url(item, await self.base_url(item))
+                offset = resume_offset(convention_file_path, item.partial_download)
+                if offset:
+                    logging.info(f"DOWNLOADER: Resuming {convention_file_path} at byte {offset}")
+                await acquire_token(self.rate_limiter.content)
+                request_start = time.perf_counter()
+                async with session.get(image_url, headers=range_headers(offset, item.partial_download)) as response:
+                    transfer_start = time.perf_counter()
+                    downloader.ttfb_latency.observe(transfer_start - request_start)
+                    logging.info(f"DOWNLOADER: Download attempt finished. Status code: {response.status}")
+                    self.rate_limiter.content.record(response.status)
+                    downloader.download_counter.inc()
+                    file_size = await self.stream_to_file(response, item, convention_file_path, offset)
+                    downloader.transfer_latency.observe(time.perf_counter() - transfer_start)
+                downloader.record_download(item, convention_filename, convention_file_path, file_size)
+                return
+            except MediaItemUnavailableError as e:
+                logging.error(f"DOWNLOADER: FAILED {e}")
+                downloader.record_failure(item)
+                downloader.download_counter.inc()
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownloadError, OSError, BaseUrlLookupError) as e:
+                logging.error(f"DOWNLOADER: Error occurred while trying to get {image_url}: {e!r}. Attempt {attempt + 1} of {downloader.MAX_RETRIES}.")
+                if isinstance(e, aiohttp.ClientResponseError) and e.status == 403:
+                    downloader.url_resolver.invalidate(item.id)  # expired baseUrl; fetch a new one for the retry
+                if attempt < downloader.MAX_RETRIES - 1:
+                    await asyncio.sleep((2 ** attempt) + random.random())  # Exponential backoff with jitter
+        logging.error(f"DOWNLOADER: Failed to download {item.id} after {downloader.MAX_RETRIES} attempts.")
+        downloader.record_failure(item)
+
+    async def stream_to_file(self, response, item, file_path, offset):
+        # The aiohttp counterpart of gpd_download.stream_to_file.  Chunks are collected on the loop and written, one
+        # chunk_size block at a time, in the thread pool.
+        await self._offload(lambda: os.makedirs(os.path.dirname(file_path), exist_ok=True))
+        part_file = await self._offload(lambda: PartFile(file_path, response.status, response.headers, offset,
+                                                         on_checkpoint=lambda state: self.downloader.update_item(item, partial_download=state)))
+        response.raise_for_status()  # never save an error page as a photo
+        try:
+            await self._offload(part_file.open)
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                buffer += chunk
+                if len(buffer) >= self.chunk_size:
+                    block, buffer = buffer, bytearray()
+                    await self._offload(part_file.write, block)
+            if buffer:
+                await self._offload(part_file.write, buffer)
+            file_size = await self._offload(part_file.finish)
+            self.downloader.disk_write_latency.observe(part_file.write_seconds)
+            return file_size
+        except BaseException:
+            part_file.abandon()  # not offloaded: it must also run when the task is being cancelled
+            raise
@@ -0,0 +1,885 @@
+# Offline benchmarks for the Google Photos Downloader.
+# Each scenario builds its own synthetic data in a scratch folder, so no Google account or real library is needed.
+#
+# sample usage:
+#python gpd_benchmark.py index_load --sizes 100000 1000000 --work_dir C:\temp\gpd_bench
+#python gpd_benchmark.py reconcile --sizes 10000 100000 1000000
+#python gpd_benchmark.py make_repository --backup_path C:\temp\gpd_synthetic --size 100000 --missing 0.02 --extraneous 0.01
+#python gpd_benchmark.py repository --sizes 10000 100000 1000000 --results C:\temp\gpd_bench.jsonl
+#python gpd_benchmark.py download --sizes_mb 64 1024
+#python gpd_benchmark.py resolve --sizes 1000 10000 --api_latency_ms 150
+#python gpd_benchmark.py engines --items 2000 --latency_ms 100 --file_kb 512
+#python gpd_benchmark.py ratelimit --server_rate 8 --seconds 20
+#python gpd_benchmark.py lanes --items 2000 --video_ratio 0.1 --num_workers 5
+#python gpd_benchmark.py pipeline --items 3000 --api_latency_ms 300 --latency_ms 50
+#python gpd_benchmark.py fetch --items 20000 --api_latency_ms 300 --fetch_workers 1 4 8
+#python gpd_benchmark.py server_fetch --items 20000 --page_latency_ms 200 --fetch_workers 1 4 --results C:\temp\gpd_bench.jsonl
+#python gpd_benchmark.py server_download --items 2000 --num_workers 1 5 10 --content_latency_ms 50 --size_spread 0.8
+#python gpd_benchmark.py server_run_all --items 1000 --throttle_ratio 0.02 --error_ratio 0.01 --results C:\temp\gpd_bench.jsonl
+
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+
+from gpd_index import JsonIndexStore, SqliteIndexStore, open_index_store
+from gpd_records import MediaRecord
+from gpd_scan import plan_reconciliation
+from gpd_download import stream_to_file, BaseUrlResolver, MediaItemUnavailableError
+from gpd_ratelimit import RateLimiter, TokenBucket
+from gpd_schedule import DownloadScheduler, estimate_size, lane_of
+from gpd_fakeserver import FakePhotosServer, FileSizes, search_page
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+SCANNER_SAVE_PAUSE = 1.5  # seconds scandisk_and_get_filepaths_and_filenames sleeps before saving the index
+
+
+def make_synthetic_item(index, rng):
+    # Shaped like a mediaItems().search result after a fetch and a download.
+    item_id = 'AF1Qip' + ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_') for _ in range(60))
+    created = datetime(2005, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=rng.randrange(0, 20 * 365 * 86400))
+    is_video = rng.random() < 0.1
+    filename = f"{'VID' if is_video else 'IMG'}_{index:08d}.{'mp4' if is_video else 'jpg'}"
+    item = {
+        'id': item_id,
+        'productUrl': f'https://photos.google.com/lr/photo/{item_id}',
+        'mimeType': 'video/mp4' if is_video else 'image/jpeg',
+        'mediaMetadata': {
+            'creationTime': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'width': str(rng.choice([1920, 3024, 4032])),
+            'height': str(rng.choice([1080, 3024, 3024])),
+        },
+        'filename': filename,
+        'status': rng.choice(['fetched', 'downloaded', 'verified', 'verified', 'verified']),
+        'date_fetched': datetime.utcnow().isoformat(),
+    }
+    if is_video:
+        item['mediaMetadata']['video'] = {'cameraMake': 'Google', 'cameraModel': 'Pixel 7', 'fps': 30, 'status': 'READY'}
+    else:
+        item['mediaMetadata']['photo'] = {'cameraMake': 'Google', 'cameraModel': 'Pixel 7', 'focalLength': 6.81, 'apertureFNumber': 1.89, 'isoEquivalent': 50, 'exposureTime': '0.001s'}
+    return item
+
+
+def write_synthetic_index(path, size, seed=0):
+    # Writes a DownloadItems.json of the given size, one record at a time.
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('{')
+        for index in range(size):
+            item = make_synthetic_item(index, rng)
+            f.write((',' if index else '') + '\n    ' + json.dumps(item['id']) + ': ' + json.dumps(item, indent=4))
+        f.write('\n}')
+
+
+def measure(function):
+    # Returns (seconds, peak traced bytes, result).  Timing and memory are taken in separate runs
+    # because tracemalloc slows allocation-heavy code down considerably.
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def bench_index_load(args):
+    results = []
+    for size in args.sizes:
+        folder = os.path.join(args.work_dir, f'index_{size}')
+        os.makedirs(folder, exist_ok=True)
+        json_store = JsonIndexStore(folder)
+        if not os.path.exists(json_store.path):
+            print(f"Writing synthetic index with {size} items to {json_store.path}...")
+            write_synthetic_index(json_store.path, size)
+        sqlite_store = SqliteIndexStore(folder)
+        if not os.path.exists(sqlite_store.path):
+            sqlite_store.import_json(json_store.path)
+
+        def eager_load():
+            with open(json_store.path, 'r') as f:
+                return json.load(f)
+
+        for name, function in [('json.load (eager)', eager_load), ('json streaming (lazy)', json_store.load), ('sqlite (lazy)', sqlite_store.load)]:
+            elapsed, peak, items = measure(function)
+            results.append({'scenario': 'index_load', 'size': size, 'loader': name, 'seconds': elapsed, 'peak_mb': peak / 1024 / 1024})
+            print(f"{size:>9} items  {name:<24} {elapsed:8.2f} s  peak {peak / 1024 / 1024:9.1f} MB")
+            del items
+        json_store.close()
+        sqlite_store.close()
+    return results
+
+
+def synthetic_convention_path(record, backup_path):
+    # Same layout as GooglePhotosDownloader.construct_file_path, in UTC so no timezone database is needed.
+    created = record.creation_datetime()
+    base, ext = os.path.splitext(record.filename)
+    convention_filename = f"{base}_{record.id[-14:]}{ext}"
+    return convention_filename, os.path.normpath(os.path.join(backup_path, str(created.year), str(created.month), convention_filename))
+
+
+def bench_reconcile(args):
+    # Times plan_reconciliation on an in-memory index and file listing (nothing touches the disk), with
+    # 5% each of misplaced, misnamed and missing files plus 5% orphans.
+    backup_path = os.path.normpath('/backup')
+    results = []
+    for size in args.sizes:
+        rng = random.Random(size)
+        records = [MediaRecord(make_synthetic_item(index, rng)) for index in range(size)]
+        filepaths_and_filenames = {}
+        for record in records:
+            convention_filename, convention_filepath = synthetic_convention_path(record, backup_path)
+            roll = rng.random()
+            if roll < 0.05:  # misplaced
+                filepath = os.path.join(backup_path, '1999', '1', convention_filename)
+            elif roll < 0.10:  # misnamed
+                filepath = os.path.join(os.path.dirname(convention_filepath), record.filename)
+            elif roll < 0.15:  # missing
+                continue
+            else:
+                filepath = convention_filepath
+            filepaths_and_filenames[filepath] = os.path.basename(filepath)
+        for index in range(size // 20):  # orphans
+            filepath = os.path.join(backup_path, '2001', '2', f'orphan_{index}.jpg')
+            filepaths_and_filenames[filepath] = os.path.basename(filepath)
+
+        start = time.perf_counter()
+        plan = plan_reconciliation(records, filepaths_and_filenames, lambda record: synthetic_convention_path(record, backup_path))
+        elapsed = time.perf_counter() - start
+        results.append({'scenario': 'reconcile', 'size': size, 'files': len(filepaths_and_filenames), 'seconds': elapsed})
+        print(f"{size:>9} items {len(filepaths_and_filenames):>9} files  {elapsed:8.2f} s  {elapsed / size * 1e6:6.1f} us/item  ({plan.summary()})")
+    return results
+
+
+def build_synthetic_repository(backup_path, size, misplaced=0.05, misnamed=0.05, missing=0.05, extraneous=0.05, file_kb=0,
+                               index_backend='json', seed=0):
+    # A backup tree and a matching index of size downloaded items, as the downloader would have left them, except that
+    # the given shares of the items are misplaced (convention name, wrong year folder), misnamed (original name,
+    # right folder) or missing (no file), and extraneous * size files are not in the index at all.  Files are
+    # sparse (file_kb, 0 for empty files), so a large tree costs inodes rather than disk space.
+    # Returns the counts of each kind, to check the scanner's and validator's findings against.
+    from google_photos_downloader import GooglePhotosDownloader
+    rng = random.Random(seed)
+    os.makedirs(backup_path, exist_ok=True)
+    downloader = GooglePhotosDownloader(None, None, backup_path, offline=True, index_backend=index_backend)  # for construct_file_path
+    counts = {'items': size, 'verified': 0, 'misplaced': 0, 'misnamed': 0, 'missing': 0, 'extraneous': 0}
+    file_size = file_kb * 1024
+    records = {}
+    files = []
+    for index in range(size):
+        item = make_synthetic_item(index, rng)
+        item['status'] = 'downloaded'
+        record = MediaRecord(item)
+        convention_filename, convention_filepath = downloader.construct_file_path(record)
+        records[record.id] = record
+        roll = rng.random()
+        if not misplaced <= roll < misplaced + misnamed:  # misnamed items keep their original name, as from older versions
+            record.update(file_path=convention_filepath, file_size=file_size, filename=convention_filename)
+        if roll < misplaced:
+            year_folder = os.path.dirname(os.path.dirname(convention_filepath))
+            wrong_folder = os.path.join(os.path.dirname(year_folder), str(int(os.path.basename(year_folder)) - 1), os.path.basename(os.path.dirname(convention_filepath)))
+            files.append(os.path.join(wrong_folder, convention_filename))
+            counts['misplaced'] += 1
+        elif roll < misplaced + misnamed:
+            files.append(os.path.join(os.path.dirname(convention_filepath), item['filename']))
+            counts['misnamed'] += 1
+        elif roll < misplaced + misnamed + missing:
+            counts['missing'] += 1
+        else:
+            files.append(convention_filepath)
+            counts['verified'] += 1
+    folders = sorted({os.path.dirname(path) for path in files})
+    for index in range(int(size * extraneous)):
+        files.append(os.path.join(rng.choice(folders), f'extraneous_{index:08d}.jpg'))
+        counts['extraneous'] += 1
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+    for path in files:
+        with open(path, 'wb') as f:
+            if file_size:
+                f.truncate(file_size)
+    downloader.journal.close()
+    downloader.index_store.close()
+    index_store = open_index_store(backup_path, index_backend)
+    index_store.save(records)
+    index_store.close()
+    return counts
+
+
+def bench_make_repository(args):
+    start = time.perf_counter()
+    counts = build_synthetic_repository(args.backup_path, args.size, args.misplaced, args.misnamed, args.missing, args.extraneous,
+                                        args.file_kb, args.index_backend, args.seed)
+    elapsed = time.perf_counter() - start
+    print(f"Built {args.backup_path} in {elapsed:.2f} s: {counts}")
+    return [dict(counts, scenario='make_repository', seconds=elapsed)]
+
+
+def bench_repository(args):
+    # scan_only, validate_only and stats_only on a synthetic repository of each size, each in a fresh offline downloader
+    # as the commands run them.  The first scan lists every folder and moves the misplaced and misnamed files; the
+    # rescan finds everything in place and takes unchanged folders from the scan cache.  The validator leaves the
+    # extraneous files alone, so every size is measured on the same tree.
+    from google_photos_downloader import GooglePhotosDownloader
+    results = []
+    for size in args.sizes:
+        backup_path = os.path.join(args.work_dir, f'repository_{size}')
+        shutil.rmtree(backup_path, ignore_errors=True)
+        print(f"Building a synthetic repository with {size} items in {backup_path}...")
+        start = time.perf_counter()
+        counts = build_synthetic_repository(backup_path, size, args.misplaced, args.misnamed, args.missing, args.extraneous,
+                                            args.file_kb, args.index_backend, args.seed)
+        print(f"Built in {time.perf_counter() - start:.2f} s: {counts}")
+
+        def scan(downloader):
+            downloader.scandisk_and_get_filepaths_and_filenames()
+            return f"{len(downloader.media_index.items(status_in=['verified']))} verified, {len(downloader.media_index.items(status_in=['missing']))} missing"
+
+        def validate(downloader):
+            downloader.load_index_from_file()
+            downloader.validate_repository()
+            with open(os.path.join(backup_path, 'extraneous_files.txt')) as f:
+                return f"{sum(1 for _ in f)} extraneous files"
+
+        def stats(downloader):
+            downloader.report_stats()
+            return ''
+
+        for phase, function in [('scan', scan), ('rescan', scan), ('validate', validate), ('stats', stats)]:
+            downloader = GooglePhotosDownloader(None, None, backup_path, offline=True, index_backend=args.index_backend,
+                                                scan_workers=args.scan_workers, extraneous_policy='leave')
+            start = time.perf_counter()
+            found = function(downloader)
+            elapsed = time.perf_counter() - start
+            if phase in ('scan', 'rescan'):
+                elapsed -= SCANNER_SAVE_PAUSE
+            downloader.journal.close()
+            downloader.index_store.close()
+            results.append({'scenario': 'repository', 'size': size, 'index_backend': args.index_backend, 'phase': phase, 'seconds': elapsed,
+                            'us_per_item': elapsed / size * 1e6, 'found': found, 'expected': counts})
+            print(f"{size:>9} items  {phase:<9} {elapsed:8.2f} s  {elapsed / size * 1e6:7.1f} us/item  {found}")
+        if not args.keep:
+            shutil.rmtree(backup_path, ignore_errors=True)
+    return results
+
+
+class _LargeFileHandler(BaseHTTPRequestHandler):
+    # Serves server.file_size bytes with a Content-Length, generated block by block so the server itself stays small.
+    BLOCK = b'\xa5' * (1 << 20)
+
+    def do_GET(self):
+        remaining = self.server.file_size
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(remaining))
+        self.end_headers()
+        while remaining > 0:
+            block = self.BLOCK[:remaining]
+            self.wfile.write(block)
+            remaining -= len(block)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _SlowFileHandler(_LargeFileHandler):
+    # Waits server.latency seconds before answering, like a distant content server.
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the real server allows
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        super().do_GET()
+
+
+def start_file_server(file_size, latency=0.0):
+    # Local stand-in for a baseUrl=dv download.  Returns (server, url); call server.shutdown() when done.
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _SlowFileHandler if latency else _LargeFileHandler)
+    server.file_size = file_size
+    server.latency = latency
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/video'
+
+
+def bench_download(args):
+    # Peak Python memory of one download: the old response.content write against stream_to_file.
+    os.makedirs(args.work_dir, exist_ok=True)
+    file_path = os.path.join(args.work_dir, 'download.bin')
+    results = []
+    for size_mb in args.sizes_mb:
+        server, url = start_file_server(size_mb * 1024 * 1024)
+        session = requests.Session()
+
+        def buffered():
+            response = session.get(url, stream=True)
+            with open(file_path, 'wb') as f:
+                f.write(response.content)
+            return os.path.getsize(file_path)
+
+        def streamed():
+            with session.get(url, stream=True) as response:
+                return stream_to_file(response, file_path)
+
+        for name, function in [('response.content (buffered)', buffered), ('stream_to_file', streamed)]:
+            elapsed, peak, written = measure(function)
+            results.append({'scenario': 'download', 'size_mb': size_mb, 'writer': name, 'seconds': elapsed, 'peak_mb': peak / 1024 / 1024})
+            print(f"{size_mb:>7} MB  {name:<28} {elapsed:8.2f} s  {size_mb / elapsed:8.1f} MB/s  peak {peak / 1024 / 1024:9.1f} MB")
+        session.close()
+        server.shutdown()
+        os.remove(file_path)
+    return results
+
+
+class FakePhotosApi:
+    # In-process stand-in for the mediaItems resource: get(), batchGet() and search() with a fixed latency per call.
+    # Ids in missing_ids come back from batchGet with a NOT_FOUND status, as deleted items do.  search() pages
+    # through library, a list of API item dicts, applying the first dateFilter range (in UTC).  After fail_after
+    # search calls every further search raises, like a dropped connection.
+    def __init__(self, latency=0.0, missing_ids=(), base_url='https://lh3.googleusercontent.com/fake', library=(), fail_after=None):
+        self.latency = latency
+        self.base_url = base_url
+        self.missing_ids = set(missing_ids)
+        self.library = sorted(library, key=lambda item: item['mediaMetadata']['creationTime'])
+        self.fail_after = fail_after
+        self.calls = {'get': 0, 'batchGet': 0, 'search': 0}
+        self.lock = threading.Lock()
+
+    def mediaItems(self):
+        return self
+
+    def _request(self, method, result):
+        api = self
+
+        class Request:
+            def execute(self):
+                with api.lock:
+                    api.calls[method] += 1
+                time.sleep(api.latency)
+                return result
+        return Request()
+
+    def _item(self, item_id):
+        return {'id': item_id, 'baseUrl': f'{self.base_url}/{item_id}'}
+
+    def get(self, mediaItemId):
+        return self._request('get', self._item(mediaItemId))
+
+    def batchGet(self, mediaItemIds):
+        if len(mediaItemIds) > 50:
+            raise ValueError('batchGet accepts at most 50 ids')
+        return self._request('batchGet', {'mediaItemResults': [
+            {'status': {'code': 5, 'message': 'NOT_FOUND'}} if item_id in self.missing_ids else {'mediaItem': self._item(item_id)}
+            for item_id in mediaItemIds]})
+
+    def search(self, body):
+        if self.fail_after is not None and self.calls['search'] >= self.fail_after:
+            raise ConnectionError('fake API: connection dropped')
+        return self._request('search', search_page(self.library, body, self.base_url))
+
+
+def bench_resolve(args):
+    # API calls and wall time to get a baseUrl for every item: one mediaItems.get per item against
+    # BaseUrlResolver's batchGet calls, with the download workers asking concurrently in download order.
+    results = []
+    for size in args.sizes:
+        item_ids = [f'ID{index:010d}' for index in range(size)]
+        missing_ids = set(item_ids[::97])
+        latency = args.api_latency_ms / 1000
+
+        api = FakePhotosApi(latency, missing_ids)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+            list(executor.map(lambda item_id: api.mediaItems().get(mediaItemId=item_id).execute()['baseUrl'], item_ids))
+        per_item = (time.perf_counter() - start, api.calls['get'])
+
+        api = FakePhotosApi(latency, missing_ids)
+        resolver = BaseUrlResolver(api, item_ids)
+        unavailable = 0
+
+        def lookup(item_id):
+            nonlocal unavailable
+            try:
+                resolver.base_url(item_id)
+                resolver.release(item_id)
+            except MediaItemUnavailableError:
+                unavailable += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+            list(executor.map(lookup, item_ids))
+        batched = (time.perf_counter() - start, api.calls['batchGet'])
+
+        for name, (elapsed, calls) in [('mediaItems.get per item', per_item), ('BaseUrlResolver batchGet', batched)]:
+            results.append({'scenario': 'resolve', 'size': size, 'resolver': name, 'api_calls': calls, 'seconds': elapsed})
+            print(f"{size:>9} items  {name:<26} {calls:>8} API calls  {elapsed:8.2f} s")
+        print(f"{size:>9} items  {unavailable} of {len(missing_ids)} missing items reported unavailable")
+    return results
+
+
+def bench_engines(args):
+    # Threaded against async download engine, end to end through GooglePhotosDownloader, against a local server that
+    # adds latency_ms to every response.  Needs the downloader's own dependencies (and aiohttp for the async engine).
+    from google_photos_downloader import GooglePhotosDownloader
+    server, url = start_file_server(args.file_kb * 1024, latency=args.latency_ms / 1000)
+    rng = random.Random(0)
+    results = []
+    for engine, options in [('threads', {'num_workers': args.num_workers}), ('async', {'transfer_concurrency': args.transfer_concurrency})]:
+        backup_path = tempfile.mkdtemp(prefix=f'gpd_engine_{engine}_')
+        # neither the API nor the content host limit is what is measured here
+        rate_limiter = RateLimiter(api_rate=1000, api_capacity=1000, content_rate=10000, content_capacity=10000)
+        downloader = GooglePhotosDownloader(None, None, backup_path, offline=True, engine=engine, rate_limiter=rate_limiter, **options)
+        downloader.photos_api = FakePhotosApi(base_url=url)
+        downloader.download_start_timestamp = time.time()
+        items = {}
+        for index in range(args.items):
+            item = MediaRecord(make_synthetic_item(index, rng))
+            item.status = 'fetched'
+            items[item.id] = item
+        downloader.potential_job_size = len(items)
+        start = time.perf_counter()
+        downloader.run_download_engine(items)
+        elapsed = time.perf_counter() - start
+        downloaded = sum(1 for item in items.values() if item.status == 'downloaded')
+        print(f"{engine:<8} connection reuse: {downloader.connection_summary()}")
+        results.append({'scenario': 'engines', 'engine': engine, 'items': args.items, 'downloaded': downloaded, 'seconds': elapsed})
+        print(f"{engine:<8} {options}  {downloaded}/{args.items} files  {elapsed:8.2f} s  {downloaded / elapsed:8.1f} files/s  "
+              f"{downloaded * args.file_kb / 1024 / elapsed:8.1f} MB/s")
+        downloader.journal.close()
+        downloader.index_store.close()
+        shutil.rmtree(backup_path, ignore_errors=True)
+    server.shutdown()
+    return results
+
+
+def bench_ratelimit(args):
+    # num_workers threads send requests for args.seconds to a simulated server that accepts server_rate requests per
+    # second and answers 429 beyond that.  A fixed bucket set too high keeps hitting 429; the adaptive bucket settles
+    # near server_rate.
+    results = []
+    for name, bucket in [('fixed', TokenBucket(args.start_rate, capacity=2)),
+                         ('adaptive', TokenBucket(args.start_rate, capacity=2, min_rate=0.5, max_rate=args.start_rate * 4, increase=0.5))]:
+        server = TokenBucket(args.server_rate, capacity=args.server_rate)
+        counts = {'ok': 0, 'throttled': 0}
+        counts_lock = threading.Lock()
+        deadline = time.monotonic() + args.seconds
+
+        def client():
+            while time.monotonic() < deadline:
+                bucket.acquire()
+                status = 200 if server.consume() else 429
+                bucket.record(status)
+                with counts_lock:
+                    counts['ok' if status == 200 else 'throttled'] += 1
+
+        threads = [threading.Thread(target=client) for _ in range(args.num_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results.append({'scenario': 'ratelimit', 'limiter': name, **counts, 'final_rate': bucket.rate})
+        print(f"{name:<9} {counts['ok'] / args.seconds:6.2f} ok/s  {counts['throttled']:6} x 429  final rate {bucket.rate:6.2f}/s  ({bucket!r})")
+    return results
+
+
+def bench_lanes(args):
+    # Simulated downloads (sleep latency + size / bandwidth per file, sizes near the estimate) in index order through
+    # a thread pool, as before the scheduler, against DownloadScheduler.  Reports when the photos were done.
+    rng = random.Random(0)
+    items = []
+    for index in range(args.items):
+        item = make_synthetic_item(index, rng)
+        is_video = rng.random() < args.video_ratio
+        item['mimeType'] = 'video/mp4' if is_video else 'image/jpeg'
+        item['filename'] = f"{'VID' if is_video else 'IMG'}_{index:08d}.{'mp4' if is_video else 'jpg'}"
+        items.append(MediaRecord(item))
+    actual_sizes = {item.id: int(estimate_size(item) * rng.uniform(0.5, 1.5)) for item in items}
+    bandwidth = args.bandwidth_mb * 1024 * 1024
+    results = []
+    for name in ['index order', 'lanes']:
+        for item in items:
+            item.status = 'fetched'
+            item.file_size = None
+        start = time.monotonic()
+        photo_times = []
+        lock = threading.Lock()
+
+        def download(item):
+            size = actual_sizes[item.id]
+            time.sleep(args.latency_ms / 1000 + size / bandwidth)
+            item.status = 'downloaded'
+            item.file_size = size
+            if lane_of(item) == 'photo':
+                with lock:
+                    photo_times.append(time.monotonic() - start)
+
+        if name == 'lanes':
+            scheduler = DownloadScheduler(items, args.num_workers, args.video_share)
+            scheduler.run(download)
+            detail = scheduler.summary()
+        else:
+            with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+                list(executor.map(download, items))
+            detail = ''
+        elapsed = time.monotonic() - start
+        photo_times.sort()
+        half = photo_times[len(photo_times) // 2] if photo_times else 0.0
+        last = photo_times[-1] if photo_times else 0.0
+        results.append({'scenario': 'lanes', 'order': name, 'seconds': elapsed, 'photos_half': half, 'photos_done': last})
+        print(f"{name:<12} total {elapsed:7.2f} s  half the photos {half:7.2f} s  all photos {last:7.2f} s  {detail}")
+    return results
+
+
+def bench_pipeline(args):
+    # End to end through GooglePhotosDownloader against FakePhotosApi (search pages of 99 with api_latency_ms each) and
+    # the local file server: fetch, then download, against fetch_and_download_photos.
+    from google_photos_downloader import GooglePhotosDownloader
+    library = make_fake_library(args.items, random.Random(0))
+    server, url = start_file_server(args.file_kb * 1024, latency=args.latency_ms / 1000)
+    results = []
+    for mode in ['sequential', 'pipelined']:
+        backup_path = tempfile.mkdtemp(prefix=f'gpd_pipeline_{mode}_')
+        rate_limiter = RateLimiter(api_rate=1000, api_capacity=1000, content_rate=10000, content_capacity=10000)
+        downloader = GooglePhotosDownloader(None, None, backup_path, num_workers=args.num_workers, offline=True, rate_limiter=rate_limiter)
+        downloader.photos_api = api = FakePhotosApi(latency=args.api_latency_ms / 1000, base_url=url, library=library)
+        start = time.monotonic()
+        if mode == 'sequential':
+            downloader.get_all_media_items()
+            downloader.download_start_timestamp = time.time()
+            missing = downloader.missing_media_items()
+            downloader.potential_job_size = len(missing)
+            downloader.run_download_engine(missing)  # download_photos without its 1.5 s pause
+            downloader.save_index_to_file(downloader.all_media_items)
+        else:
+            downloader.fetch_and_download_photos(args.queue_size)
+        elapsed = time.monotonic() - start
+        first_download = min((stats.first_start for stats in downloader.scheduler.stats.values() if stats.first_start is not None),
+                             default=start) - start
+        downloaded = sum(1 for item in downloader.all_media_items.values() if item.status == 'downloaded')
+        results.append({'scenario': 'pipeline', 'mode': mode, 'items': args.items, 'downloaded': downloaded, 'seconds': elapsed})
+        print(f"{mode:<11} {downloaded}/{args.items} files  {api.calls['search']} search pages  {api.calls['batchGet']} batchGet calls ({downloader.url_resolver.hits} cached URLs used)  first download after {first_download:6.2f} s  "
+              f"total {elapsed:7.2f} s")
+        downloader.journal.close()
+        downloader.index_store.close()
+        shutil.rmtree(backup_path, ignore_errors=True)
+    server.shutdown()
+    return results
+
+
+def make_fake_library(size, rng):
+    # API items for FakePhotosApi(library=...): synthetic items without the fields the downloader adds.
+    library = []
+    for index in range(size):
+        item = make_synthetic_item(index, rng)
+        for key in ('status', 'date_fetched'):
+            del item[key]
+        library.append(item)
+    return library
+
+
+def bench_fetch(args):
+    # Index fetch time against FakePhotosApi for each fetch_workers setting, first into an empty index (yearly
+    # shards), then again with the index in place (shards planned from its density).  Then an interrupted fetch:
+    # the API fails halfway, and the rerun only asks for the shards that did not complete.
+    from google_photos_downloader import GooglePhotosDownloader
+    library = make_fake_library(args.items, random.Random(0))
+    results = []
+
+    def fetch(backup_path, fetch_workers, fail_after=None):
+        rate_limiter = RateLimiter(api_rate=1000, api_capacity=1000)  # the shards, not the quota, are measured here
+        downloader = GooglePhotosDownloader(None, None, backup_path, offline=True, rate_limiter=rate_limiter, fetch_workers=fetch_workers)
+        downloader.photos_api = api = FakePhotosApi(latency=args.api_latency_ms / 1000, library=library, fail_after=fail_after)
+        downloader.load_index_from_file()
+        start = time.perf_counter()
+        error = None
+        try:
+            downloader.get_all_media_items()
+        except ConnectionError as e:
+            error = e
+        elapsed = time.perf_counter() - start
+        count = len(downloader.all_media_items)
+        downloader.journal.close()
+        downloader.index_store.close()
+        return elapsed, api.calls['search'], count, error
+
+    for fetch_workers in args.fetch_workers:
+        backup_path = tempfile.mkdtemp(prefix='gpd_fetch_')
+        for run in ['empty index', 'indexed']:
+            elapsed, calls, count, _ = fetch(backup_path, fetch_workers)
+            if run == 'empty index':
+                empty_index_calls = calls
+            results.append({'scenario': 'fetch', 'fetch_workers': fetch_workers, 'run': run, 'search_calls': calls, 'items': count, 'seconds': elapsed})
+            print(f"{fetch_workers:>3} workers  {run:<12} {count:>8} items  {calls:>5} search calls  {elapsed:8.2f} s")
+        shutil.rmtree(backup_path, ignore_errors=True)
+
+    backup_path = tempfile.mkdtemp(prefix='gpd_fetch_resume_')
+    elapsed, first_calls, count, error = fetch(backup_path, args.fetch_workers[-1], fail_after=empty_index_calls // 2)
+    print(f"interrupted  {count:>8} items  {first_calls:>5} search calls  ({error})")
+    elapsed, second_calls, count, _ = fetch(backup_path, args.fetch_workers[-1])
+    print(f"resumed      {count:>8} items  {second_calls:>5} search calls  {elapsed:8.2f} s")
+    results.append({'scenario': 'fetch', 'run': 'resumed', 'search_calls': second_calls, 'items': count, 'seconds': elapsed})
+    shutil.rmtree(backup_path, ignore_errors=True)
+    return results
+
+
+def start_fake_server(args):
+    # A FakePhotosServer over a synthetic library, configured from the server_* scenario options.
+    library = make_fake_library(args.items, random.Random(args.seed))
+    server = FakePhotosServer(library, page_latency=args.page_latency_ms / 1000, content_latency=args.content_latency_ms / 1000,
+                              throttle_ratio=args.throttle_ratio, error_ratio=args.error_ratio,
+                              file_sizes=FileSizes(args.photo_kb, args.video_kb, args.size_spread), seed=args.seed)
+    return server.start()
+
+
+def server_downloader(args, server, backup_path, **options):
+    # A GooglePhotosDownloader talking to server over HTTP, through the real API client, without OAuth.
+    from google_photos_downloader import GooglePhotosDownloader
+    rate_limiter = RateLimiter(api_rate=args.api_rate, api_capacity=max(2, int(args.api_rate)), api_max_rate=args.api_rate * 2,
+                               content_rate=args.content_rate, content_capacity=max(20, int(args.content_rate)))
+    return GooglePhotosDownloader(None, None, backup_path, rate_limiter=rate_limiter, api_base_url=server.url, **options)
+
+
+def close_downloader(downloader):
+    downloader.journal.close()
+    downloader.index_store.close()
+    downloader.session.close()
+
+
+def server_delta(before, after):
+    # Requests the server answered between two stats() snapshots.
+    return {key: after[key] - before.get(key, 0) for key in after if after[key] != before.get(key, 0)}
+
+
+def metric_quantiles(downloader, names):
+    # p50/p90 of some of the downloader's latency histograms, for the results.
+    summary = downloader.metrics.summary()
+    return {name: {q: summary[name][q] for q in ('p50', 'p90')} for name in names if name in summary}
+
+
+def bench_server_fetch(args):
+    # get_all_media_items through the API client against FakePhotosServer, into an empty index, per fetch_workers.
+    server = start_fake_server(args)
+    results = []
+    for fetch_workers in args.fetch_workers:
+        backup_path = tempfile.mkdtemp(prefix='gpd_server_fetch_')
+        downloader = server_downloader(args, server, backup_path, fetch_workers=fetch_workers)
+        before = server.stats()
+        start = time.perf_counter()
+        downloader.get_all_media_items()
+        elapsed = time.perf_counter() - start
+        requests_made = server_delta(before, server.stats())
+        count = len(downloader.all_media_items)
+        results.append({'scenario': 'server_fetch', 'fetch_workers': fetch_workers, 'items': count, 'seconds': elapsed,
+                        'items_per_second': count / elapsed, 'requests': requests_made,
+                        'latency': metric_quantiles(downloader, ['gpd_api_request_seconds{call="search"}'])})
+        print(f"{fetch_workers:>3} fetch workers  {count:>8} items  {elapsed:8.2f} s  {count / elapsed:8.1f} items/s  {requests_made}")
+        close_downloader(downloader)
+        shutil.rmtree(backup_path, ignore_errors=True)
+    server.shutdown()
+    return results
+
+
+def bench_server_download(args):
+    # The download of a freshly fetched index against FakePhotosServer, per num_workers.  The download runs in a new
+    # downloader, as download_missing would, so its baseUrls come from batchGet rather than the fetch.
+    server = start_fake_server(args)
+    results = []
+    for num_workers in args.num_workers:
+        backup_path = tempfile.mkdtemp(prefix='gpd_server_download_')
+        fetcher = server_downloader(args, server, backup_path)
+        fetcher.get_all_media_items()
+        close_downloader(fetcher)
+        downloader = server_downloader(args, server, backup_path, num_workers=num_workers, engine=args.engine,
+                                       transfer_concurrency=num_workers)
+        downloader.load_index_from_file()
+        missing = downloader.missing_media_items()
+        downloader.download_start_timestamp = time.time()
+        downloader.potential_job_size = len(missing)
+        before = server.stats()
+        start = time.perf_counter()
+        downloader.run_download_engine(missing)  # download_photos without its 1.5 s pause
+        downloader.save_index_to_file(downloader.all_media_items)
+        elapsed = time.perf_counter() - start
+        requests_made = server_delta(before, server.stats())
+        downloaded = sum(1 for item in downloader.all_media_items.values() if item.status == 'downloaded')
+        megabytes = requests_made.get('content_bytes', 0) / 1024 / 1024
+        results.append({'scenario': 'server_download', 'engine': args.engine, 'num_workers': num_workers, 'items': len(missing),
+                        'downloaded': downloaded, 'seconds': elapsed, 'files_per_second': downloaded / elapsed, 'mb_per_second': megabytes / elapsed,
+                        'requests': requests_made,
+                        'latency': metric_quantiles(downloader, ['gpd_download_ttfb_seconds', 'gpd_download_transfer_seconds', 'gpd_disk_write_seconds'])})
+        print(f"{num_workers:>3} workers  {downloaded}/{len(missing)} files  {elapsed:8.2f} s  {downloaded / elapsed:8.1f} files/s  "
+              f"{megabytes / elapsed:8.1f} MB/s  {requests_made}")
+        close_downloader(downloader)
+        shutil.rmtree(backup_path, ignore_errors=True)
+    server.shutdown()
+    return results
+
+
+def bench_server_run_all(args):
+    # run_all end to end against FakePhotosServer: into an empty backup folder, then again with everything in place.
+    server = start_fake_server(args)
+    backup_path = tempfile.mkdtemp(prefix='gpd_server_run_all_')
+    results = []
+    for run in ['first run', 'rerun']:
+        downloader = server_downloader(args, server, backup_path, num_workers=args.num_workers[0], extraneous_policy='leave')
+        before = server.stats()
+        start = time.perf_counter()
+        downloader.run_all(pipeline=args.pipeline)
+        elapsed = time.perf_counter() - start
+        requests_made = server_delta(before, server.stats())
+        statuses = {}
+        for item in downloader.all_media_items.values():
+            statuses[str(item.status)] = statuses.get(str(item.status), 0) + 1
+        results.append({'scenario': 'server_run_all', 'run': run, 'pipeline': args.pipeline, 'items': len(downloader.all_media_items),
+                        'statuses': statuses, 'seconds': elapsed, 'requests': requests_made})
+        print(f"{run:<10} {len(downloader.all_media_items):>8} items  {elapsed:8.2f} s  {statuses}  {requests_made}")
+        close_downloader(downloader)
+    shutil.rmtree(backup_path, ignore_errors=True)
+    server.shutdown()
+    return results
+
+
+def write_results(path, args, results):
+    # One JSON line per benchmark run, so runs can be appended to one file and compared.
+    record = {'finished': datetime.now(timezone.utc).isoformat(), 'scenario': args.scenario,
+              'options': {key: value for key, value in vars(args).items() if key not in ('scenario', 'results')}, 'results': results}
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Google Photos Downloader benchmarks')
+    subparsers = parser.add_subparsers(dest='scenario', required=True)
+
+    index_load_parser = subparsers.add_parser('index_load', help='Load time and peak memory of the index loaders')
+    index_load_parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000], help='Number of items in the synthetic indexes')
+    index_load_parser.add_argument('--work_dir', type=str, default=os.path.join(tempfile.gettempdir(), 'gpd_bench'), help='Folder for the synthetic indexes (kept between runs)')
+
+    reconcile_parser = subparsers.add_parser('reconcile', help='Scaling of the disk/index reconciliation engine')
+    reconcile_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='Number of items in the synthetic index')
+
+    make_repository_parser = subparsers.add_parser('make_repository', help='Build a synthetic backup folder and index, e.g. to run the downloader\'s offline commands on')
+    make_repository_parser.add_argument('--backup_path', type=str, required=True, help='Folder to build the repository in')
+    make_repository_parser.add_argument('--size', type=int, default=100000, help='Number of items in the index')
+    repository_parser = subparsers.add_parser('repository', help='scan, validate and stats on synthetic repositories of each size')
+    repository_parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000], help='Number of items in the synthetic repositories')
+    repository_parser.add_argument('--work_dir', type=str, default=os.path.join(tempfile.gettempdir(), 'gpd_bench'), help='Folder for the synthetic repositories')
+    repository_parser.add_argument('--scan_workers', type=int, default=8, help='Threads listing the tree')
+    repository_parser.add_argument('--keep', action='store_true', help='Keep the repositories after the benchmark')
+    for repository_options in [make_repository_parser, repository_parser]:
+        repository_options.add_argument('--misplaced', type=float, default=0.05, help='Share of files in the wrong year folder')
+        repository_options.add_argument('--misnamed', type=float, default=0.05, help='Share of files under their original name')
+        repository_options.add_argument('--missing', type=float, default=0.05, help='Share of indexed items without a file')
+        repository_options.add_argument('--extraneous', type=float, default=0.05, help='Files not in the index, as a share of the items')
+        repository_options.add_argument('--file_kb', type=int, default=0, help='Size of the sparse files, 0 for empty files')
+        repository_options.add_argument('--index_backend', type=str, choices=['json', 'sqlite'], default='json', help='Index backend to write')
+        repository_options.add_argument('--seed', type=int, default=0, help='Seed of the items and of the injected problems')
+
+    download_parser = subparsers.add_parser('download', help='Peak memory of buffered against streamed downloads from a local HTTP server')
+    download_parser.add_argument('--sizes_mb', type=int, nargs='+', default=[64, 512], help='Sizes of the served file in MB')
+    download_parser.add_argument('--work_dir', type=str, default=os.path.join(tempfile.gettempdir(), 'gpd_bench'), help='Folder for the downloaded file')
+
+    resolve_parser = subparsers.add_parser('resolve', help='API calls needed to resolve baseUrls, per item against batched')
+    resolve_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help='Number of items to resolve')
+    resolve_parser.add_argument('--api_latency_ms', type=float, default=20, help='Simulated latency of one API call')
+    resolve_parser.add_argument('--num_workers', type=int, default=5, help='Number of download workers asking for URLs')
+
+    engines_parser = subparsers.add_parser('engines', help='Threaded against async download engine with a slow local server')
+    engines_parser.add_argument('--items', type=int, default=500, help='Number of files to download')
+    engines_parser.add_argument('--file_kb', type=int, default=256, help='Size of each file in KB')
+    engines_parser.add_argument('--latency_ms', type=float, default=100, help='Latency the server adds to every response')
+    engines_parser.add_argument('--num_workers', type=int, default=5, help='Threads for the threaded engine')
+    engines_parser.add_argument('--transfer_concurrency', type=int, default=64, help='Downloads in flight for the async engine')
+
+    ratelimit_parser = subparsers.add_parser('ratelimit', help='Fixed against adaptive token bucket against a server that answers 429 when overloaded')
+    ratelimit_parser.add_argument('--server_rate', type=float, default=8, help='Requests per second the simulated server accepts')
+    ratelimit_parser.add_argument('--start_rate', type=float, default=20, help='Requests per second both limiters start at')
+    ratelimit_parser.add_argument('--seconds', type=float, default=10, help='How long each limiter runs')
+    ratelimit_parser.add_argument('--num_workers', type=int, default=5, help='Threads sending requests')
+
+    lanes_parser = subparsers.add_parser('lanes', help='Photo and video lanes against index order, with simulated downloads')
+    lanes_parser.add_argument('--items', type=int, default=1000, help='Number of items')
+    lanes_parser.add_argument('--video_ratio', type=float, default=0.1, help='Share of the items that are videos')
+    lanes_parser.add_argument('--num_workers', type=int, default=5, help='Download workers')
+    lanes_parser.add_argument('--video_share', type=float, default=0.25, help='Share of the workers reserved for videos')
+    lanes_parser.add_argument('--latency_ms', type=float, default=20, help='Simulated latency of every download')
+    lanes_parser.add_argument('--bandwidth_mb', type=float, default=100, help='Simulated MB/s of one download')
+
+    pipeline_parser = subparsers.add_parser('pipeline', help='Fetch then download against pipelined fetch and download, with a fake API and local server')
+    pipeline_parser.add_argument('--items', type=int, default=2000, help='Number of items in the fake library')
+    pipeline_parser.add_argument('--api_latency_ms', type=float, default=300, help='Latency of one search page')
+    pipeline_parser.add_argument('--latency_ms', type=float, default=50, help='Latency the file server adds to every download')
+    pipeline_parser.add_argument('--file_kb', type=int, default=64, help='Size of each file in KB')
+    pipeline_parser.add_argument('--num_workers', type=int, default=5, help='Download threads')
+    pipeline_parser.add_argument('--queue_size', type=int, default=500, help='Most fetched items waiting for a download')
+
+    fetch_parser = subparsers.add_parser('fetch', help='Date-sharded index fetch against a fake API, and resuming an interrupted fetch')
+    fetch_parser.add_argument('--items', type=int, default=10000, help='Number of items in the fake library')
+    fetch_parser.add_argument('--api_latency_ms', type=float, default=300, help='Latency of one search page')
+    fetch_parser.add_argument('--fetch_workers', type=int, nargs='+', default=[1, 4, 8], help='Shards fetched at the same time')
+
+    # Scenarios against FakePhotosServer, through GooglePhotosDownloader(api_base_url=...)
+    server_fetch_parser = subparsers.add_parser('server_fetch', help='get_all_media_items against a local fake Google Photos server')
+    server_fetch_parser.add_argument('--fetch_workers', type=int, nargs='+', default=[1, 4], help='Shards fetched at the same time')
+    server_download_parser = subparsers.add_parser('server_download', help='Download of a fetched index against a local fake Google Photos server')
+    server_download_parser.add_argument('--num_workers', type=int, nargs='+', default=[1, 5, 10], help='Download workers (or async transfers)')
+    server_download_parser.add_argument('--engine', type=str, choices=['threads', 'async'], default='threads', help='Download engine')
+    server_run_all_parser = subparsers.add_parser('server_run_all', help='run_all end to end against a local fake Google Photos server, twice')
+    server_run_all_parser.add_argument('--num_workers', type=int, nargs=1, default=[5], help='Download workers')
+    server_run_all_parser.add_argument('--pipeline', action='store_true', help='Download while fetching')
+    for server_parser in [server_fetch_parser, server_download_parser, server_run_all_parser]:
+        server_parser.add_argument('--items', type=int, default=1000, help='Number of items in the fake library')
+        server_parser.add_argument('--page_latency_ms', type=float, default=100, help='Latency of every API call')
+        server_parser.add_argument('--content_latency_ms', type=float, default=20, help='Latency before every download response')
+        server_parser.add_argument('--throttle_ratio', type=float, default=0.0, help='Share of API and content requests answered with 429')
+        server_parser.add_argument('--error_ratio', type=float, default=0.0, help='Share of API and content requests answered with 500')
+        server_parser.add_argument('--photo_kb', type=int, default=256, help='Median photo size in KB')
+        server_parser.add_argument('--video_kb', type=int, default=4096, help='Median video size in KB')
+        server_parser.add_argument('--size_spread', type=float, default=0.5, help='Sigma of the lognormal file sizes, 0 for fixed sizes')
+        server_parser.add_argument('--api_rate', type=float, default=50, help='Library API requests per second the downloader starts at')
+        server_parser.add_argument('--content_rate', type=float, default=1000, help='Downloads started per second the downloader starts at')
+        server_parser.add_argument('--seed', type=int, default=0, help='Seed of the library and of the injected failures')
+
+    for scenario_parser in subparsers.choices.values():
+        scenario_parser.add_argument('--results', type=str, default=None, help='Append the results as one JSON line to this file')
+
+    args = parser.parse_args()
+    if args.scenario == 'index_load':
+        results = bench_index_load(args)
+    elif args.scenario == 'reconcile':
+        results = bench_reconcile(args)
+    elif args.scenario == 'make_repository':
+        results = bench_make_repository(args)
+    elif args.scenario == 'repository':
+        results = bench_repository(args)
+    elif args.scenario == 'download':
+        results = bench_download(args)
+    elif args.scenario == 'resolve':
+        results = bench_resolve(args)
+    elif args.scenario == 'engines':
+        results = bench_engines(args)
+    elif args.scenario == 'ratelimit':
+        results = bench_ratelimit(args)
+    elif args.scenario == 'lanes':
+        results = bench_lanes(args)
+    elif args.scenario == 'pipeline':
+        results = bench_pipeline(args)
+    elif args.scenario == 'fetch':
+        results = bench_fetch(args)
+    elif args.scenario == 'server_fetch':
+        results = bench_server_fetch(args)
+    elif args.scenario == 'server_download':
+        results = bench_server_download(args)
+    elif args.scenario == 'server_run_all':
+        results = bench_server_run_all(args)
+    if args.results:
+        write_results(args.results, args, results)
@@ -0,0 +1,409 @@
+# File transfer for the Google Photos Downloader.
+# stream_to_file() writes a response body to "<target>.part" in fixed-size chunks, checks the byte count against
+# Content-Length, fsyncs and only then renames the file into place, so memory per download is bounded by the chunk
+# size and an interrupted download never leaves a partial file under the final name.
+# An interrupted download keeps its .part file.  Its resume state ({"path", "offset", "size", "etag", "last_modified"})
+# is handed to on_checkpoint, which the downloader stores on the item as partial_download, and the next attempt asks
+# for the rest with a Range request.
+# BaseUrlResolver fetches baseUrls with mediaItems.batchGet, 50 ids per call, just ahead of the download workers.
+# PooledSession is the one requests session the download workers share, with a keep-alive connection pool per host.
+
+import os
+import re
+import time
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from gpd_ratelimit import execute_with_limiter
+from gpd_metrics import timed
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+RESUME_CHECKPOINT_BYTES = 64 << 20  # fsync and record the resume offset every 64 MiB
+PART_SUFFIX = '.part'
+BATCH_GET_SIZE = 50  # the most ids mediaItems.batchGet accepts
+BASE_URL_LIFETIME = 50 * 60  # baseUrls stay valid for 60 minutes; refresh them with a margin
+CONNECT_TIMEOUT = 10  # seconds
+READ_TIMEOUT = 120  # seconds without any data arriving, not for the whole transfer
+
+
+class IncompleteDownloadError(requests.exceptions.RequestException):
+    # The connection ended before Content-Length bytes arrived.  A RequestException so the normal retry path applies.
+    pass
+
+
+class MediaItemUnavailableError(Exception):
+    # batchGet returned an error status instead of the item, e.g. it was deleted or is no longer shared.
+    pass
+
+
+class BaseUrlLookupError(Exception):
+    # The batchGet call itself failed (an HTTP error after the rate limiter's retries, or a transport error), so no
+    # id in the batch was resolved.  Unlike MediaItemUnavailableError this says nothing about the item: retry it.
+    pass
+
+
+def expected_length(headers):
+    # Content-Length of the body as written to disk, or None if unknown.  With a Content-Encoding the header counts
+    # encoded bytes while the HTTP clients yield decoded ones, so it cannot be checked.
+    length = headers.get('Content-Length')
+    if length is None or headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    try:
+        return int(length)
+    except ValueError:
+        return None
+
+
+def _content_range(headers):
+    # (first byte, total size or None) from a 206 Content-Range header, or None if absent or malformed.
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', headers.get('Content-Range', ''))
+    if match is None:
+        return None
+    return int(match.group(1)), None if match.group(2) == '*' else int(match.group(2))
+
+
+def resume_offset(file_path, partial_download):
+    # Number of bytes of file_path.part that can be kept, given the item's stored resume state.
+    if not partial_download or partial_download.get('path') != file_path:
+        return 0
+    try:
+        size_on_disk = os.path.getsize(file_path + PART_SUFFIX)
+    except OSError:
+        return 0
+    return min(size_on_disk, partial_download.get('offset', 0))  # bytes past the recorded offset were never fsynced
+
+
+def range_headers(offset, partial_download):
+    # Request headers for resuming at offset.  If-Range makes the server send the whole file instead of a range if
+    # the content changed since the partial download began.
+    if offset <= 0:
+        return {}
+    headers = {'Range': f'bytes={offset}-'}
+    validator = partial_download.get('etag') or partial_download.get('last_modified')
+    if validator:
+        headers['If-Range'] = validator
+    return headers
+
+
+class PartFile:
+    # One attempt at writing a response body to "<file_path>.part", independent of the HTTP client so the threaded
+    # and async engines share it.  offset is the number of bytes already on disk, as requested with range_headers();
+    # a 206 answer starting there is appended, anything else starts from scratch.
+    # on_checkpoint(state) is called with the resume state while the download runs and when it is abandoned, and with
+    # None if the part file had to be discarded.  Clearing the state after a successful download is up to the caller.
+    def __init__(self, file_path, status_code, headers, offset=0, on_checkpoint=None, checkpoint_bytes=RESUME_CHECKPOINT_BYTES):
+        self.file_path = file_path
+        self.part_path = file_path + PART_SUFFIX
+        self.on_checkpoint = on_checkpoint
+        self.checkpoint_bytes = checkpoint_bytes
+        content_range = _content_range(headers) if status_code == 206 else None
+        if status_code == 416 or (status_code == 206 and (content_range is None or content_range[0] != offset)):
+            # The stored range no longer fits the file; drop the part file so the retry downloads it whole.
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+            if on_checkpoint is not None:
+                on_checkpoint(None)
+            raise IncompleteDownloadError(f"unusable range response ({status_code}) resuming {file_path} at byte {offset}")
+        if content_range is not None:
+            self.expected = content_range[1]
+            self.mode = 'r+b'
+        else:
+            offset = 0
+            self.expected = expected_length(headers)
+            self.mode = 'wb'
+        self.offset = self.written = offset
+        self.state = {'path': file_path, 'offset': offset, 'size': self.expected,
+                      'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+        self.next_checkpoint = offset + checkpoint_bytes
+        self.file = None
+        self.write_seconds = 0.0  # time spent in write and finish (writes, fsyncs, rename), for the disk write metric
+
+    def open(self):
+        self.file = open(self.part_path, self.mode)
+        self.file.seek(self.offset)
+        self.file.truncate()
+
+    def write(self, chunk):
+        start = time.perf_counter()
+        self.file.write(chunk)
+        self.written += len(chunk)
+        if self.written >= self.next_checkpoint and self.on_checkpoint is not None:
+            self._sync()
+            self.on_checkpoint(dict(self.state, offset=self.written))
+            self.next_checkpoint = self.written + self.checkpoint_bytes
+        self.write_seconds += time.perf_counter() - start
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _close(self):
+        if self.file is not None:
+            try:
+                self._sync()
+            finally:
+                self.file.close()
+                self.file = None
+
+    def finish(self):
+        # fsync, check the length and rename into place.  Returns the size of the finished file.
+        start = time.perf_counter()
+        self._close()
+        if self.expected is not None and self.written != self.expected:
+            raise IncompleteDownloadError(f"received {self.written} of {self.expected} bytes for {self.file_path}")
+        os.replace(self.part_path, self.file_path)
+        self.write_seconds += time.perf_counter() - start
+        return self.written
+
+    def abandon(self):
+        # After a failed attempt: keep what was written for resuming, or remove the part file if that is not possible.
+        try:
+            self._close()
+        finally:
+            if self.written > 0 and self.on_checkpoint is not None:
+                self.on_checkpoint(dict(self.state, offset=self.written))
+            elif os.path.exists(self.part_path):
+                os.remove(self.part_path)
+
+
+def stream_to_file(response, file_path, chunk_size=DOWNLOAD_CHUNK_SIZE, offset=0, on_checkpoint=None,
+                   checkpoint_bytes=RESUME_CHECKPOINT_BYTES, write_latency=None):
+    # Write a requests response to file_path through a PartFile.  Returns the size of the finished file.
+    # write_latency: gpd_metrics.Histogram that gets the disk time of a finished file.
+    part_file = PartFile(file_path, response.status_code, response.headers, offset, on_checkpoint, checkpoint_bytes)
+    response.raise_for_status()  # never save an error page as a photo
+    try:
+        part_file.open()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            part_file.write(chunk)
+        size = part_file.finish()
+        if write_latency is not None:
+            write_latency.observe(part_file.write_seconds)
+        return size
+    except BaseException:
+        part_file.abandon()
+        raise
+
+
+class BaseUrlResolver:
+    # Hands out baseUrls to the download workers, one resolver per downloader so URLs outlive a single run.
+    # URLs come from two places: store() seeds the ones mediaItems.search already returned while fetching, and on a
+    # miss the requested id is resolved together with the next ids in download order, up to BATCH_GET_SIZE per
+    # batchGet call, so URLs are fetched shortly before they are used and one API call serves up to 50 downloads.
+    # URLs older than lifetime seconds, or invalidated after the server refused them, are resolved again.  The lock is
+    # never held during an API call: ids being resolved are marked in flight and other callers wait for that batch
+    # instead of starting their own.  URLs only live here; they are never written to the index.
+    def __init__(self, photos_api, item_ids=(), batch_size=BATCH_GET_SIZE, lifetime=BASE_URL_LIFETIME, limiter=None, latency=None):
+        self.photos_api = photos_api
+        self.pending = deque(item_ids)  # ids in the order the workers will ask for them
+        self.batch_size = batch_size
+        self.lifetime = lifetime
+        self.limiter = limiter  # gpd_ratelimit.TokenBucket for the Library API, or None for no limit
+        self.latency = latency  # gpd_metrics.Histogram of batchGet calls, or None
+        self.urls = {}  # id -> (baseUrl or MediaItemUnavailableError, time resolved, 'search' or 'batchGet')
+        self.in_flight = {}  # id -> threading.Event set when its batch has been stored
+        self.released = set()  # ids already downloaded; skipped if they are still pending
+        self.lock = threading.Lock()
+        self.seeded = 0  # URLs stored from search results, over the resolver's lifetime
+        self.reset_stats()
+
+    def reset_stats(self):
+        # Per run counters, reported by __repr__.
+        self.api_calls = 0
+        self.resolved_count = 0
+        self.hits = 0  # lookups answered from the cache
+        self.search_hits = 0  # ... with a URL from a search result
+        self.misses = 0  # lookups that had to wait for a batchGet
+        self.expired = 0  # ... because the cached URL was too old
+        self.invalidated = 0  # URLs dropped after the server refused them
+
+    def plan(self, item_ids, photos_api=None):
+        # Start a download run: item_ids is the order the workers will ask for URLs in.  Cached URLs are kept; ids
+        # with a fresh one are skipped when batching, stale ones are resolved again when asked for.  photos_api
+        # replaces the client if it was reconnected.
+        with self.lock:
+            if photos_api is not None:
+                self.photos_api = photos_api
+            self.pending = deque(item_ids)
+            self.released = set()
+            self.reset_stats()
+
+    def store(self, item_id, base_url, source='search'):
+        # Seed the URL of a media item returned by mediaItems.search, so its download needs no batchGet.
+        with self.lock:
+            self.urls[item_id] = (base_url, time.monotonic(), source)
+            self.seeded += 1
+
+    def _fresh_url(self, item_id, now):
+        # Call with the lock held.
+        entry = self.urls.get(item_id)
+        if entry is None or now - entry[1] >= self.lifetime:
+            return None
+        return entry[0]
+
+    def _count_hit(self, item_id):
+        # Call with the lock held.
+        self.hits += 1
+        if self.urls[item_id][2] == 'search':
+            self.search_hits += 1
+
+    @staticmethod
+    def _result(url):
+        if isinstance(url, MediaItemUnavailableError):
+            raise url
+        return url
+
+    def base_url(self, item_id):
+        first_look = True
+        while True:
+            with self.lock:
+                url = self._fresh_url(item_id, time.monotonic())
+                if url is not None:
+                    if first_look:
+                        self._count_hit(item_id)
+                    return self._result(url)
+                if first_look:
+                    self.misses += 1
+                    if item_id in self.urls:
+                        self.expired += 1
+                    first_look = False
+                event = self.in_flight.get(item_id)
+                if event is None:
+                    batch = self._take_batch(item_id)
+                    event = threading.Event()
+                    for batch_id in batch:
+                        self.in_flight[batch_id] = event
+                    break
+            event.wait()  # another worker is resolving this id; look again once it is done
+        try:
+            self._resolve_batch(batch)
+        finally:
+            with self.lock:
+                for batch_id in batch:
+                    self.in_flight.pop(batch_id, None)
+            event.set()
+        with self.lock:
+            return self._result(self.urls[item_id][0])
+
+    def add_pending(self, item_ids):
+        # More ids to resolve, after those already pending (the pipelined mode learns about items while it downloads).
+        with self.lock:
+            self.pending.extend(item_ids)
+
+    def cached_url(self, item_id):
+        # The URL if it is already resolved and fresh, else None.  Never calls the API or waits for another call.
+        # Only hits are counted; a miss is counted by the base_url call that follows.
+        with self.lock:
+            url = self._fresh_url(item_id, time.monotonic())
+            if url is not None:
+                self._count_hit(item_id)
+        return None if url is None else self._result(url)
+
+    def invalidate(self, item_id):
+        # Forget a URL the server refused (usually expired) so the next base_url call fetches a new one.
+        with self.lock:
+            if self.urls.pop(item_id, None) is not None:
+                self.invalidated += 1
+
+    def release(self, item_id):
+        # Drop the URL of a finished download.  The id is remembered so a batch never resolves it again, which matters
+        # when workers do not take items in exactly the pending order.
+        with self.lock:
+            self.urls.pop(item_id, None)
+            self.released.add(item_id)
+
+    def _take_batch(self, item_id):
+        # Call with the lock held: item_id plus the next pending ids that are neither fresh nor already in flight.
+        now = time.monotonic()
+        batch = [item_id]
+        while self.pending and len(batch) < self.batch_size:
+            next_id = self.pending.popleft()
+            if next_id != item_id and next_id not in self.in_flight and next_id not in self.released and self._fresh_url(next_id, now) is None:
+                batch.append(next_id)
+        return batch
+
+    def _resolve_batch(self, batch):
+        request = self.photos_api.mediaItems().batchGet(mediaItemIds=batch)
+        try:
+            if self.limiter is None:
+                with timed(self.latency):
+                    response = request.execute()
+            else:
+                response = execute_with_limiter(request, self.limiter, latency=self.latency)
+        except Exception as e:  # googleapiclient HttpError, httplib2 and socket errors
+            raise BaseUrlLookupError(f"batchGet of {len(batch)} ids failed: {e!r}") from e
+        now = time.monotonic()
+        results = response.get('mediaItemResults', [])
+        with self.lock:
+            self.api_calls += 1
+            for requested_id, result in zip(batch, results):  # results come back in request order
+                media_item = result.get('mediaItem')
+                if media_item is not None and 'baseUrl' in media_item:
+                    self.urls[requested_id] = (media_item['baseUrl'], now, 'batchGet')
+                    self.resolved_count += 1
+                else:
+                    message = result.get('status', {}).get('message', 'no baseUrl returned')
+                    self.urls[requested_id] = (MediaItemUnavailableError(f"{requested_id}: {message}"), now, 'batchGet')
+            for requested_id in batch[len(results):]:
+                self.urls[requested_id] = (MediaItemUnavailableError(f"{requested_id}: missing from batchGet response"), now, 'batchGet')
+
+    def __repr__(self):
+        return (f"BaseUrlResolver(hits={self.hits} ({self.search_hits} from search), misses={self.misses} "
+                f"({self.expired} expired), invalidated={self.invalidated}, seeded={self.seeded}, "
+                f"api_calls={self.api_calls}, resolved={self.resolved_count})")
+
+
+class PooledSession(requests.Session):
+    # A requests session shared by all download workers.  Each scheme://host gets its own HTTPAdapter whose pool keeps
+    # up to pool_maxsize connections alive (one per worker), so consecutive downloads from the same content host reuse
+    # a connection instead of paying a new TCP and TLS handshake.  With pool_block the workers wait for a pooled
+    # connection rather than opening extra ones that would be thrown away afterwards.
+    # Connection errors are retried by urllib3 before any response is returned, which also covers a kept-alive
+    # connection that the server closed while it sat idle in the pool.  Everything after that is left to the
+    # downloader's own retry loop.
+    def __init__(self, pool_maxsize=5, pool_block=True, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, connect_retries=3):
+        super().__init__()
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = Retry(total=connect_retries, connect=connect_retries, read=1, status=0, other=0, redirect=5,
+                             allowed_methods=frozenset(['GET', 'HEAD']), backoff_factor=0.5, raise_on_status=False)
+        self.host_adapters = {}  # 'scheme://host' -> HTTPAdapter
+        self.adapter_lock = threading.Lock()
+
+    def get_adapter(self, url):
+        parts = urlsplit(url)
+        prefix = f"{parts.scheme}://{parts.netloc}".lower()
+        with self.adapter_lock:
+            if prefix not in self.host_adapters:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, pool_block=self.pool_block, max_retries=self.retries)
+                self.host_adapters[prefix] = adapter
+                self.mount(prefix + '/', adapter)
+        return super().get_adapter(url)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+    def connection_stats(self):
+        # {host: (requests, new connections)} from urllib3's per-pool counters
+        stats = {}
+        with self.adapter_lock:
+            adapters = dict(self.host_adapters)
+        for prefix, adapter in adapters.items():
+            pools = adapter.poolmanager.pools
+            pool_list = [pool for pool in (pools.get(key) for key in pools.keys()) if pool is not None]
+            stats[prefix] = (sum(pool.num_requests for pool in pool_list), sum(pool.num_connections for pool in pool_list))
+        return stats
+
+    def connection_summary(self):
+        stats = self.connection_stats()
+        total_requests = sum(requests_made for requests_made, _ in stats.values())
+        total_connections = sum(connections for _, connections in stats.values())
+        reused = total_requests - total_connections
+        per_host = ', '.join(f"{host}: {requests_made} requests on {connections} connections" for host, (requests_made, connections) in stats.items())
+        return (f"{total_requests} requests on {total_connections} connections, {reused} handshakes saved"
+                + (f" ({per_host})" if per_host else ''))
@@ -0,0 +1,242 @@
+# Local stand-in for Google Photos, for benchmarks and offline testing.
+# FakePhotosServer answers the Library API calls the downloader makes (mediaItems.search, get and batchGet) and the
+# content URLs they hand out (baseUrl=d, baseUrl=dv) over real HTTP on 127.0.0.1.  It also serves a discovery document,
+# so googleapiclient builds a normal client against it: GooglePhotosDownloader(api_base_url=server.url) skips OAuth
+# and talks to the server as it would to Google.
+# Page latency, content latency, 429 and 5xx injection and the file size distribution are configurable.  Injected
+# failures come from a seeded random generator and file sizes are derived from the item id, so runs are repeatable.
+
+import json
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BATCH_GET_SIZE = 50
+MAX_PAGE_SIZE = 100
+CONTENT_CHUNK = b'\0' * (64 << 10)
+
+
+class FileSizes:
+    # Sizes of the served files: median photo_kb / video_kb, spread is the sigma of a lognormal around them
+    # (0 serves every photo and every video at exactly the median).
+    def __init__(self, photo_kb=3072, video_kb=51200, spread=0.0):
+        self.photo_kb = photo_kb
+        self.video_kb = video_kb
+        self.spread = spread
+
+    def size_of(self, item):
+        median = (self.video_kb if 'video' in item.get('mimeType', '') else self.photo_kb) * 1024
+        if not self.spread:
+            return int(median)
+        return max(1, int(median * random.Random(item['id']).lognormvariate(0, self.spread)))
+
+
+def search_page(library, body, base_url):
+    # One mediaItems.search page over library (sorted by creationTime), applying the first dateFilter range in UTC.
+    # The page token is the offset of the next item.
+    ranges = (body.get('filters') or {}).get('dateFilter', {}).get('ranges')
+    if ranges:
+        first, last = (f"{day['year']:04d}-{day['month']:02d}-{day['day']:02d}" for day in (ranges[0]['startDate'], ranges[0]['endDate']))
+        library = [item for item in library if first <= item['mediaMetadata']['creationTime'][:10] <= last]
+    start = int(body.get('pageToken') or 0)
+    end = start + min(int(body.get('pageSize') or 25), MAX_PAGE_SIZE)
+    page = {'mediaItems': [dict(item, baseUrl=f'{base_url}/{item["id"]}') for item in library[start:end]]}
+    if end < len(library):
+        page['nextPageToken'] = str(end)
+    return page
+
+
+def discovery_document(root_url):
+    # Just enough of the photoslibrary v1 discovery document for googleapiclient to build mediaItems().search/get/batchGet.
+    def schema(name):
+        return {'id': name, 'type': 'object', 'properties': {}}
+
+    return {
+        'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'id': 'photoslibrary:v1', 'name': 'photoslibrary',
+        'version': 'v1', 'protocol': 'rest', 'rootUrl': root_url, 'servicePath': '', 'baseUrl': root_url, 'batchPath': 'batch',
+        'parameters': {},
+        'schemas': {name: schema(name) for name in ('SearchMediaItemsRequest', 'SearchMediaItemsResponse', 'MediaItem', 'BatchGetMediaItemsResponse')},
+        'resources': {'mediaItems': {'methods': {
+            'search': {'id': 'photoslibrary.mediaItems.search', 'path': 'v1/mediaItems:search', 'flatPath': 'v1/mediaItems:search',
+                       'httpMethod': 'POST', 'parameters': {}, 'parameterOrder': [],
+                       'request': {'$ref': 'SearchMediaItemsRequest'}, 'response': {'$ref': 'SearchMediaItemsResponse'}},
+            'get': {'id': 'photoslibrary.mediaItems.get', 'path': 'v1/mediaItems/{+mediaItemId}', 'flatPath': 'v1/mediaItems/{mediaItemsId}',
+                    'httpMethod': 'GET', 'parameters': {'mediaItemId': {'type': 'string', 'required': True, 'location': 'path'}},
+                    'parameterOrder': ['mediaItemId'], 'response': {'$ref': 'MediaItem'}},
+            'batchGet': {'id': 'photoslibrary.mediaItems.batchGet', 'path': 'v1/mediaItems:batchGet', 'flatPath': 'v1/mediaItems:batchGet',
+                         'httpMethod': 'GET', 'parameters': {'mediaItemIds': {'type': 'string', 'repeated': True, 'location': 'query'}},
+                         'parameterOrder': [], 'response': {'$ref': 'BatchGetMediaItemsResponse'}},
+        }}},
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as Google's servers
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.fake.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.fake.handle(self, 'POST')
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # many download workers connect at once
+
+
+class FakePhotosServer:
+    # library: API item dicts, as mediaItems.search returns them (without baseUrl).  missing_ids come back from
+    # batchGet and get as NOT_FOUND, like deleted items.  throttle_ratio and error_ratio are the shares of API and
+    # content requests answered with 429 and 500.
+    def __init__(self, library, page_latency=0.0, content_latency=0.0, throttle_ratio=0.0, error_ratio=0.0, file_sizes=None,
+                 missing_ids=(), seed=0):
+        self.library = sorted(library, key=lambda item: item['mediaMetadata']['creationTime'])
+        self.items = {item['id']: item for item in self.library}
+        self.page_latency = page_latency
+        self.content_latency = content_latency
+        self.throttle_ratio = throttle_ratio
+        self.error_ratio = error_ratio
+        self.file_sizes = file_sizes or FileSizes()
+        self.missing_ids = set(missing_ids)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()  # (route, status) -> count
+        self.content_bytes = 0
+        self.server = None
+        self.url = None
+
+    def start(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.fake = self
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, name='fake-photos-server', daemon=True).start()
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def discovery_url(self):
+        return f'{self.url}/$discovery/rest?version=v1'
+
+    def stats(self):
+        # {'route status': count} plus the content bytes served.
+        with self.lock:
+            stats = {f'{route} {status}': count for (route, status), count in sorted(self.requests.items())}
+            stats['content_bytes'] = self.content_bytes
+        return stats
+
+    def calls(self, route, status=200):
+        with self.lock:
+            return self.requests[(route, status)]
+
+    def _injected_status(self):
+        with self.lock:
+            roll = self.rng.random()
+        if roll < self.throttle_ratio:
+            return 429
+        if roll < self.throttle_ratio + self.error_ratio:
+            return 500
+        return None
+
+    def _count(self, route, status):
+        with self.lock:
+            self.requests[(route, status)] += 1
+
+    def _send_json(self, handler, route, status, document):
+        body = json.dumps(document).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json; charset=UTF-8')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+        self._count(route, status)
+
+    def _send_error(self, handler, route, status, message):
+        reason = {400: 'INVALID_ARGUMENT', 404: 'NOT_FOUND', 429: 'RESOURCE_EXHAUSTED', 500: 'INTERNAL'}.get(status, 'UNKNOWN')
+        self._send_json(handler, route, status, {'error': {'code': status, 'message': message, 'status': reason}})
+
+    def handle(self, handler, method):
+        parts = urlsplit(handler.path)
+        path = unquote(parts.path)
+        body = handler.rfile.read(int(handler.headers.get('Content-Length') or 0))  # always drained, for keep-alive
+        query = parse_qs(parts.query)
+        if method == 'POST' and handler.headers.get('X-HTTP-Method-Override') == 'GET':
+            # googleapiclient sends a GET whose URI is too long (a full batchGet) as a POST with the query in the body
+            method = 'GET'
+            query.update(parse_qs(body.decode()))
+        try:
+            if path == '/$discovery/rest':
+                self._send_json(handler, 'discovery', 200, discovery_document(self.url + '/'))
+            elif path.startswith('/content/'):
+                self._content(handler, path[len('/content/'):])
+            elif path.startswith('/v1/mediaItems'):
+                self._api(handler, method, path, query, body)
+            else:
+                self._send_error(handler, 'unknown', 404, f'no route for {path}')
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up on the response
+
+    def _api(self, handler, method, path, query, body):
+        route = {'/v1/mediaItems:search': 'search', '/v1/mediaItems:batchGet': 'batchGet'}.get(path, 'get')
+        time.sleep(self.page_latency)
+        status = self._injected_status()
+        if status is not None:
+            self._send_error(handler, route, status, 'injected by FakePhotosServer')
+            return
+        if route == 'search' and method == 'POST':
+            self._send_json(handler, route, 200, search_page(self.library, json.loads(body or b'{}'), self.url + '/content'))
+        elif route == 'batchGet':
+            item_ids = query.get('mediaItemIds', [])
+            if len(item_ids) > BATCH_GET_SIZE:
+                self._send_error(handler, route, 400, f'at most {BATCH_GET_SIZE} ids per batchGet')
+                return
+            self._send_json(handler, route, 200, {'mediaItemResults': [self._lookup(item_id) for item_id in item_ids]})
+        else:
+            result = self._lookup(path[len('/v1/mediaItems/'):])
+            if 'mediaItem' in result:
+                self._send_json(handler, route, 200, result['mediaItem'])
+            else:
+                self._send_error(handler, route, 404, result['status']['message'])
+
+    def _lookup(self, item_id):
+        item = self.items.get(item_id)
+        if item is None or item_id in self.missing_ids:
+            return {'status': {'code': 5, 'message': f'NOT_FOUND: {item_id}'}}
+        return {'mediaItem': dict(item, baseUrl=f'{self.url}/content/{item_id}')}
+
+    def _content(self, handler, name):
+        # <id>=d for photos, <id>=dv for videos
+        item_id = name.split('=', 1)[0]
+        time.sleep(self.content_latency)
+        status = self._injected_status()
+        if status is not None:
+            self._send_error(handler, 'content', status, 'injected by FakePhotosServer')
+            return
+        item = self.items.get(item_id)
+        if item is None:
+            self._send_error(handler, 'content', 404, f'no content for {item_id}')
+            return
+        size = self.file_sizes.size_of(item)
+        handler.send_response(200)
+        handler.send_header('Content-Type', item.get('mimeType', 'application/octet-stream'))
+        handler.send_header('Content-Length', str(size))
+        handler.end_headers()
+        remaining = size
+        while remaining > 0:
+            chunk = CONTENT_CHUNK[:min(remaining, len(CONTENT_CHUNK))]
+            handler.wfile.write(chunk)
+            remaining -= len(chunk)
+        self._count('content', 200)
+        with self.lock:
+            self.content_bytes += size
+        logging.debug(f"FAKE SERVER: Served {size} bytes for {item_id}")
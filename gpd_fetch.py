@@ -0,0 +1,209 @@
+# Date-sharded fetching for the Google Photos Downloader.
+# The fetch range is cut into shards of about SHARD_TARGET_ITEMS items, judged by how many items the local index
+# holds per month: busy months are split into runs of days, quiet months are merged, so each shard is a separate
+# mediaItems.search that can be paged through alongside the others without spending calls on empty months.
+# FetchProgress records the shard plan and the shards an interrupted fetch completed, so running the same fetch
+# again skips them.  SyncState is the high-water mark of the sync command: the newest creationTime fetched so far.
+
+import os
+import json
+import math
+import calendar
+import logging
+import threading
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from gpd_records import format_creation_time
+
+SHARD_TARGET_ITEMS = 2000  # about 20 search pages; busier months are split into shards of about this size
+FETCH_WORKERS = 4  # shards paged through at the same time
+SYNC_OVERLAP_DAYS = 7  # sync fetches from the high-water mark minus this, to catch late uploads of older media
+FIRST_SHARDED_YEAR = 2000  # without an index to go by: one shard per year from here, one for everything earlier
+
+DateShard = namedtuple('DateShard', ['start', 'end'])  # datetime.date, both inclusive
+
+
+def shard_key(shard):
+    return f"{shard.start.isoformat()}/{shard.end.isoformat()}"
+
+
+def month_shards(start, end):
+    # [start, end] cut at month boundaries.
+    shards = []
+    shard_start = start
+    while shard_start <= end:
+        month_end = date(shard_start.year, shard_start.month, calendar.monthrange(shard_start.year, shard_start.month)[1])
+        shards.append(DateShard(shard_start, min(month_end, end)))
+        shard_start = month_end + timedelta(days=1)
+    return shards
+
+
+def split_shard(shard, parts):
+    # Up to parts shards of whole days covering shard.
+    days = (shard.end - shard.start).days + 1
+    parts = max(1, min(parts, days))
+    shards = []
+    for index in range(parts):
+        first = shard.start + timedelta(days=index * days // parts)
+        last = shard.start + timedelta(days=(index + 1) * days // parts - 1)
+        shards.append(DateShard(first, last))
+    return shards
+
+
+def year_shards(start, end):
+    # Fallback plan: everything before FIRST_SHARDED_YEAR in one shard, then one shard per year.
+    shards = []
+    shard_start = start
+    while shard_start <= end:
+        year = max(shard_start.year, FIRST_SHARDED_YEAR - 1)
+        shard_end = min(date(year, 12, 31), end)
+        shards.append(DateShard(shard_start, shard_end))
+        shard_start = shard_end + timedelta(days=1)
+    return shards
+
+
+def plan_shards(start, end, count_items=None, target_items=SHARD_TARGET_ITEMS):
+    # Shards covering [start, end].  count_items(shard) estimates the items in a shard (e.g. from the local index).
+    # Months above target_items are split into runs of days; consecutive months are merged while they stay under it.
+    months = month_shards(start, end)
+    counts = [count_items(shard) for shard in months] if count_items is not None else [0] * len(months)
+    if not any(counts):
+        return year_shards(start, end)
+    shards = []
+    group_start, group_end, group_count = None, None, 0
+    for shard, count in zip(months, counts):
+        if group_start is not None and group_count + count > target_items:
+            shards.append(DateShard(group_start, group_end))
+            group_start, group_end, group_count = None, None, 0
+        if count > target_items:
+            shards.extend(split_shard(shard, math.ceil(count / target_items)))
+            continue
+        if group_start is None:
+            group_start = shard.start
+        group_end, group_count = shard.end, group_count + count
+    if group_start is not None:
+        shards.append(DateShard(group_start, group_end))
+    return shards
+
+
+def date_filter(shard):
+    # mediaItems.search filters for one shard.
+    return {
+        "dateFilter": {
+            "ranges": [
+                {
+                    "startDate": {"year": shard.start.year, "month": shard.start.month, "day": shard.start.day},
+                    "endDate": {"year": shard.end.year, "month": shard.end.month, "day": shard.end.day},
+                }
+            ]
+        }
+    }
+
+
+class FetchProgress:
+    # FetchProgress.json in the backup folder: the shard plan of an unfinished fetch of one date range and the shards
+    # that were paged through to the end.  The plan is kept because the index, and with it a new plan, changes as
+    # shards complete.  A fetch of a different range starts over; a finished fetch removes the file, so the next one
+    # asks for every shard again (items can be added to old months at any time).
+    FILENAME = 'FetchProgress.json'
+
+    def __init__(self, backup_path, start, end):
+        self.path = os.path.join(backup_path, self.FILENAME)
+        self.range = [start.isoformat(), end.isoformat()]
+        self.shards = []  # the DateShards of this fetch
+        self.completed = {}  # shard key -> items seen in the shard
+        self.lock = threading.Lock()  # shards complete in several fetch threads
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return self
+        except (OSError, ValueError) as e:
+            logging.warning(f"FETCHER: Ignoring unreadable {self.path}: {e}")
+            return self
+        if saved.get('range') == self.range:
+            self.shards = [DateShard(date.fromisoformat(start), date.fromisoformat(end)) for start, end in saved.get('shards', [])]
+            self.completed = saved.get('completed', {}) if self.shards else {}
+        return self
+
+    def start(self, shards):
+        # Record the plan of a new fetch.
+        with self.lock:
+            self.shards = list(shards)
+            self.completed = {}
+            self._save()
+
+    def is_completed(self, shard):
+        return shard_key(shard) in self.completed
+
+    def complete(self, shard, item_count):
+        # Call only once the shard's items are safely in the journal.
+        with self.lock:
+            self.completed[shard_key(shard)] = item_count
+            self._save()
+
+    def _save(self):
+        # Call with the lock held.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'range': self.range, 'shards': [[shard.start.isoformat(), shard.end.isoformat()] for shard in self.shards],
+                       'completed': self.completed, 'updated': datetime.utcnow().isoformat()}, f)
+        os.replace(tmp_path, self.path)
+
+    def finish(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SyncState:
+    # SyncState.json in the backup folder, written after every successful sync:
+    # newest_creation: newest creationTime (UTC) among the items fetched so far, the high-water mark
+    # last_sync / last_deep_sync: when the last sync, and the last sync over the whole date range, finished (UTC)
+    FILENAME = 'SyncState.json'
+
+    def __init__(self, backup_path):
+        self.path = os.path.join(backup_path, self.FILENAME)
+        self.newest_creation = None  # epoch seconds
+        self.last_sync = None  # aware datetimes
+        self.last_deep_sync = None
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return self
+        except (OSError, ValueError) as e:
+            logging.warning(f"SYNC: Ignoring unreadable {self.path}, the next sync is a deep one: {e}")
+            return self
+        self.newest_creation = saved.get('newest_creation_ts')
+        self.last_sync = datetime.fromisoformat(saved['last_sync']) if saved.get('last_sync') else None
+        self.last_deep_sync = datetime.fromisoformat(saved['last_deep_sync']) if saved.get('last_deep_sync') else None
+        return self
+
+    def deep_sync_due(self, now, deep_every_days=None):
+        # A deep sync is needed without a mark, or when the last one is older than deep_every_days.
+        if self.newest_creation is None or self.last_deep_sync is None:
+            return True
+        return deep_every_days is not None and now - self.last_deep_sync >= timedelta(days=deep_every_days)
+
+    def record(self, now, newest_creation, deep):
+        # Advance the mark after a successful sync.  The mark never moves back.
+        if newest_creation is not None and (self.newest_creation is None or newest_creation > self.newest_creation):
+            self.newest_creation = newest_creation
+        self.last_sync = now
+        if deep:
+            self.last_deep_sync = now
+        saved = {'newest_creation_ts': self.newest_creation,
+                 'newest_creation': format_creation_time(self.newest_creation) if self.newest_creation is not None else None,
+                 'last_sync': self.last_sync.isoformat(),
+                 'last_deep_sync': self.last_deep_sync.isoformat() if self.last_deep_sync else None}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(saved, f, indent=4)
+        os.replace(tmp_path, self.path)
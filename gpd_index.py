@@ -0,0 +1,504 @@
+# Index storage backends for the Google Photos Downloader.
+# The JSON backend keeps the original DownloadItems.json behaviour (whole-file rewrite on every save).
+# The SQLite backend stores one row per media item in DownloadItems.db and only upserts rows that changed.
+# Between saves, item changes are appended to DownloadItems.journal and replayed over the last snapshot on load.
+# Both backends load items as MediaRecords (gpd_records.py) that keep only a compact header in memory and read the
+# rest of the API record back on demand.
+
+import os
+import re
+import sys
+import time
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone, timedelta
+
+from gpd_records import MediaRecord, MediaIndex, as_dict, compact_dimension
+
+JSON_INDEX_FILENAME = 'DownloadItems.json'
+SQLITE_INDEX_FILENAME = 'DownloadItems.db'
+JOURNAL_FILENAME = 'DownloadItems.journal'
+INDEX_BACKENDS = ['json', 'sqlite']
+RECENT_DAYS = 7  # window used by the "recently created media" statistic
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JsonChunkReader:
+    # Incremental tokenizer for the top level of DownloadItems.json.  The file is read in chunks and decoded as
+    # latin-1 so that string offsets are byte offsets; records containing non-ASCII text are re-decoded as UTF-8.
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.base = 0  # file offset of buf[0]
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > self.chunk_size:  # drop text that has already been consumed
+            self.buf = self.buf[self.pos:]
+            self.base += self.pos
+            self.pos = 0
+        self.buf += chunk.decode('latin-1')
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                raise json.JSONDecodeError('Unexpected end of file', self.buf, self.pos)
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buf, self.pos)
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                break
+            except json.JSONDecodeError:
+                if not self.read_more():  # the value may just be cut off at the end of the buffer
+                    raise
+        raw = self.buf[self.pos:end]
+        if not raw.isascii():
+            value = json.loads(raw.encode('latin-1'))
+        start = self.base + self.pos
+        self.pos = end
+        return value, start, self.base + end, raw
+
+
+def iter_json_index(path, chunk_size=1 << 20, with_raw=False):
+    # Stream (id, record, start, end) out of a {id: record} JSON file without loading it whole.
+    # start/end are the byte offsets of the record; with_raw=True also yields its raw text (latin-1 decoded).
+    with open(path, 'rb') as f:
+        reader = _JsonChunkReader(f, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            item_id, _, _, _ = reader.decode()
+            reader.expect(':')
+            record, start, end, raw = reader.decode()
+            yield (item_id, record, start, end, raw) if with_raw else (item_id, record, start, end)
+            if reader.peek() == '}':
+                return
+            reader.expect(',')
+
+
+class JsonRecordSource:
+    # Reads single records back out of a JSON index file by byte offset.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.replaced_by = None  # source of the file that replaced this one, see JsonIndexStore.save
+        self.offsets = None  # id -> (start, end), built on the first lookup by id
+
+    def read_record(self, item_id, start, end):
+        current = self
+        while current.replaced_by is not None:
+            current = current.replaced_by
+        if current is not self:
+            # The file was rewritten by a save of a subset that did not include this record, so its offsets are
+            # stale.  The record was copied unchanged into every later file: look it up by id in the latest one.
+            return current.read_by_id(item_id)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'rb')
+            self.file.seek(start)
+            return json.loads(self.file.read(end - start))
+
+    def read_by_id(self, item_id):
+        with self.lock:
+            if self.offsets is None:
+                self.offsets = {record_id: (start, end) for record_id, _, start, end in iter_json_index(self.path)}
+            start, end = self.offsets[item_id]
+        return self.read_record(item_id, start, end)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class JsonIndexStore:
+    # The original storage format: a single JSON object of {id: item}.  It is streamed in and out record by record,
+    # so neither loading nor saving needs the whole file in memory.
+    name = 'json'
+
+    def __init__(self, backup_path):
+        self.path = os.path.normpath(os.path.join(backup_path, JSON_INDEX_FILENAME))
+        self.source = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        self.close()
+        previous_source = self.source
+        self.source = JsonRecordSource(self.path)
+        if previous_source is not None:
+            previous_source.replaced_by = self.source  # records of an earlier load follow the file from now on
+        return {item_id: MediaRecord(record, self.source, start, end) for item_id, record, start, end in iter_json_index(self.path)}
+
+    def save(self, all_items, dirty_ids=None):
+        # Rewrites the file, copying unchanged records byte for byte.  Records in dirty_ids (every item in all_items
+        # if dirty_ids is None) are merged over the stored copy; items not yet in the file are appended.
+        # Records loaded earlier but left out of all_items (callers save subsets) keep the old source, which forwards
+        # their reads to the new file.
+        if os.path.exists(self.path) and not os.access(self.path, os.W_OK):
+            logging.error(f"INDEX UPDATER: No write access to the file: {self.path}")
+            return False
+        if dirty_ids is not None and not dirty_ids and os.path.exists(self.path):
+            return True  # nothing changed since the last save
+        temp_path = self.path + '.tmp'
+        new_source = JsonRecordSource(self.path)
+        relocated = []
+        written_ids = set()
+        with open(temp_path, 'wb') as out:
+            out.write(b'{')
+
+            def write_record(item_id, data):
+                out.write((',' if written_ids else '').encode('ascii') + b'\n    ' + json.dumps(item_id).encode('ascii') + b': ')
+                start = out.tell()
+                out.write(data)
+                written_ids.add(item_id)
+                item = all_items.get(item_id)
+                if isinstance(item, MediaRecord):
+                    relocated.append((item, start, out.tell()))
+
+            if os.path.exists(self.path):
+                for item_id, record, start, end, raw in iter_json_index(self.path, with_raw=True):
+                    item = all_items.get(item_id)
+                    if item is None or (dirty_ids is not None and item_id not in dirty_ids):
+                        write_record(item_id, raw.encode('latin-1'))  # unchanged, copy as is
+                    else:
+                        if isinstance(item, MediaRecord) and item._extra is None:
+                            record = item.merge_into(record)  # only slot fields can have changed
+                        else:
+                            record.update(as_dict(item))  # Update existing item
+                        for key in MediaRecord.TRANSIENT_KEYS:  # drop baseUrls stored by earlier versions
+                            record.pop(key, None)
+                        write_record(item_id, json.dumps(record, indent=4).encode('ascii'))
+            for item_id, item in all_items.items():
+                if item_id not in written_ids:
+                    write_record(item_id, json.dumps(as_dict(item), indent=4).encode('ascii'))  # Append new item
+            out.write(b'\n}')
+            out.flush()
+            os.fsync(out.fileno())
+        self.close()  # the old file cannot be replaced while it is open on Windows
+        os.replace(temp_path, self.path)
+        for item, start, end in relocated:
+            item.relocate(new_source, start, end)
+        if self.source is not None:
+            self.source.replaced_by = new_source
+        self.source = new_source
+        return True
+
+    def stats(self):
+        return MediaIndex(self.load() if self.exists() else {}).stats(RECENT_DAYS)
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+
+
+class SqliteIndexStore:
+    # One row per media item.  The full API record is kept as JSON in the data column, while the
+    # fields the downloader filters on are kept in their own indexed columns.
+    # Slot fields holding small JSON objects also get their own column, so header-only loads keep them.
+    name = 'sqlite'
+    UPSERT_BATCH_SIZE = 1000
+    JSON_COLUMNS = ('content_hash', 'partial_download')
+    DIMENSION_COLUMNS = ('width', 'height')  # mediaMetadata width/height as integers, for the download scheduler's size estimates
+
+    def __init__(self, backup_path):
+        self.path = os.path.normpath(os.path.join(backup_path, SQLITE_INDEX_FILENAME))
+        self.lock = threading.RLock()  # the connection is shared between download worker threads; lazy items read through it while saving
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS media_items (
+                    id TEXT PRIMARY KEY,
+                    status TEXT,
+                    creationTime TEXT,
+                    file_path TEXT,
+                    filename TEXT,
+                    mimeType TEXT,
+                    file_size INTEGER,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_media_items_status ON media_items(status);
+                CREATE INDEX IF NOT EXISTS idx_media_items_creation_time ON media_items(creationTime);
+                CREATE INDEX IF NOT EXISTS idx_media_items_file_path ON media_items(file_path);
+            ''')
+            columns = {row[1] for row in self.connection.execute('PRAGMA table_info(media_items)')}
+            for column in self.JSON_COLUMNS:
+                if column not in columns:  # new table, or a database from an older version
+                    self.connection.execute(f'ALTER TABLE media_items ADD COLUMN {column} TEXT')
+            if not set(self.DIMENSION_COLUMNS) <= columns:
+                for column in self.DIMENSION_COLUMNS:
+                    if column not in columns:
+                        self.connection.execute(f'ALTER TABLE media_items ADD COLUMN {column} INTEGER')
+                self._backfill_dimensions()
+        return self.connection
+
+    def _backfill_dimensions(self):
+        # Databases from older versions have no width/height columns: fill them in from the stored records, once.
+        connection = self.connection
+        updates = []
+        for item_id, data in connection.execute('SELECT id, data FROM media_items'):
+            media_metadata = json.loads(data).get('mediaMetadata', {})
+            width, height = compact_dimension(media_metadata.get('width')), compact_dimension(media_metadata.get('height'))
+            if width is not None or height is not None:
+                updates.append((width, height, item_id))
+        with connection:
+            connection.executemany('UPDATE media_items SET width = ?, height = ? WHERE id = ?', updates)
+        if updates:
+            logging.info(f"INDEX UPDATER: Added width and height to {len(updates)} rows of {self.path}")
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        # Only the indexed columns are read; the data column is fetched per item on demand.
+        with self.lock:
+            rows = self.connect().execute('SELECT id, status, creationTime, file_path, filename, mimeType, file_size, width, height, '
+                                          + ', '.join(self.JSON_COLUMNS) + ' FROM media_items')
+            return {item_id: MediaRecord.from_header(self, creation_time, id=item_id, status=status, file_path=file_path, filename=filename,
+                                                     mimeType=mime_type and sys.intern(mime_type), file_size=file_size, width=width, height=height,
+                                                     **{column: json.loads(value) for column, value in zip(self.JSON_COLUMNS, json_values) if value is not None})
+                    for item_id, status, creation_time, file_path, filename, mime_type, file_size, width, height, *json_values in rows}
+
+    def read_record(self, item_id, start=None, end=None):
+        with self.lock:
+            row = self.connect().execute('SELECT data FROM media_items WHERE id = ?', (item_id,)).fetchone()
+        return json.loads(row[0])
+
+    @classmethod
+    def _row(cls, record):
+        return (
+            record.id,
+            record.status,
+            record.creationTime,
+            record.file_path,
+            record.filename,
+            record.mimeType,
+            record.file_size,
+            json.dumps(as_dict(record)),
+        ) + tuple(json.dumps(getattr(record, column)) if getattr(record, column) is not None else None for column in cls.JSON_COLUMNS) \
+          + tuple(getattr(record, column) for column in cls.DIMENSION_COLUMNS)
+
+    def save(self, all_items, dirty_ids=None):
+        # Upsert only the rows that changed since the last save.  dirty_ids=None writes every item.
+        if dirty_ids is None:
+            items = all_items.values()
+        else:
+            items = [all_items[item_id] for item_id in dirty_ids if item_id in all_items]
+        return self.upsert(items)
+
+    def upsert(self, items):
+        count = 0
+        with self.lock:
+            connection = self.connect()
+            with connection:  # one transaction per save
+                batch = []
+                for item in items:
+                    batch.append(self._row(item))
+                    if len(batch) >= self.UPSERT_BATCH_SIZE:
+                        self._upsert_batch(connection, batch)
+                        count += len(batch)
+                        batch = []
+                if batch:
+                    self._upsert_batch(connection, batch)
+                    count += len(batch)
+        logging.info(f"INDEX UPDATER: Upserted {count} rows into {self.path}")
+        return True
+
+    @classmethod
+    def _upsert_batch(cls, connection, batch):
+        connection.executemany(f'''
+            INSERT INTO media_items (id, status, creationTime, file_path, filename, mimeType, file_size, data, {', '.join(cls.JSON_COLUMNS + cls.DIMENSION_COLUMNS)})
+            VALUES ({', '.join('?' * (8 + len(cls.JSON_COLUMNS) + len(cls.DIMENSION_COLUMNS)))})
+            ON CONFLICT(id) DO UPDATE SET
+                status=excluded.status,
+                creationTime=excluded.creationTime,
+                file_path=excluded.file_path,
+                filename=excluded.filename,
+                mimeType=excluded.mimeType,
+                file_size=excluded.file_size,
+                data=excluded.data,
+                {', '.join(f'{column}=excluded.{column}' for column in cls.JSON_COLUMNS + cls.DIMENSION_COLUMNS)}
+        ''', batch)
+
+    def stats(self):
+        # Computed in SQL so stats_only does not need to load the index into memory.
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=RECENT_DAYS + 1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self.lock:
+            connection = self.connect()
+            total_size = connection.execute("SELECT COALESCE(SUM(file_size), 0) FROM media_items WHERE status IN ('downloaded', 'verified')").fetchone()[0]
+            total_files = connection.execute('SELECT COUNT(*) FROM media_items').fetchone()[0]
+            total_images = connection.execute("SELECT COUNT(*) FROM media_items WHERE mimeType LIKE '%image%'").fetchone()[0]
+            total_videos = connection.execute("SELECT COUNT(*) FROM media_items WHERE mimeType LIKE '%video%' AND mimeType NOT LIKE '%image%'").fetchone()[0]
+            recent_changes = connection.execute('SELECT COUNT(*) FROM media_items WHERE creationTime > ?', (cutoff,)).fetchone()[0]
+            status_counts = dict(connection.execute('SELECT status, COUNT(*) FROM media_items GROUP BY status').fetchall())
+        return {'total_size': total_size, 'total_files': total_files, 'total_images': total_images,
+                'total_videos': total_videos, 'recent_changes': recent_changes, 'status_counts': status_counts}
+
+    def import_json(self, json_path):
+        # One-shot migration of an existing DownloadItems.json into the SQLite store.
+        logging.info(f"INDEX IMPORTER: Importing {json_path} into {self.path}")
+        count = 0
+
+        def records():
+            nonlocal count
+            for item_id, record, start, end in iter_json_index(json_path):
+                count += 1
+                yield MediaRecord(record)
+
+        self.upsert(records())
+        logging.info(f"INDEX IMPORTER: Imported {count} items.")
+        return count
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+class IndexJournal:
+    # Append-only JSON-lines log of item changes made since the last index snapshot.
+    # Each line is either {"id": ..., "set": {field: value}} for an update or {"id": ..., "item": {...}} for a new item.
+    # Lines are written in small batches and fsynced at most every fsync_interval seconds.
+    def __init__(self, backup_path, batch_size=100, fsync_interval=2.0):
+        self.path = os.path.normpath(os.path.join(backup_path, JOURNAL_FILENAME))
+        self.rotated_path = self.path + '.1'  # changes being folded into a snapshot by a compaction in progress
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.file = None
+        self.last_fsync = time.monotonic()
+        self.appended_count = 0
+
+    def append_update(self, item_id, fields):
+        self._append({'id': item_id, 'set': fields})
+
+    def append_item(self, item):
+        self._append({'id': item['id'], 'item': as_dict(item)})
+
+    def _append(self, entry):
+        line = json.dumps(entry) + '\n'  # serialize outside the lock
+        with self.lock:
+            self.pending.append(line)
+            self.appended_count += 1
+            if len(self.pending) >= self.batch_size:
+                self._write_pending(force_fsync=False)
+
+    def flush(self):
+        with self.lock:
+            self._write_pending(force_fsync=True)
+
+    def _write_pending(self, force_fsync):
+        # Caller holds self.lock
+        if self.pending:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(''.join(self.pending))
+            self.file.flush()
+            self.pending = []
+        now = time.monotonic()
+        if self.file is not None and (force_fsync or now - self.last_fsync >= self.fsync_interval):
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+
+    def rotate(self):
+        # Start a fresh journal before a snapshot is written.  Changes made while the snapshot is being
+        # written land in the new journal, so discarding the rotated one afterwards never loses anything.
+        with self.lock:
+            self._write_pending(force_fsync=True)
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if not os.path.exists(self.path):
+                return
+            if os.path.exists(self.rotated_path):  # a previous compaction failed, keep its entries too
+                with open(self.rotated_path, 'a', encoding='utf-8') as rotated, open(self.path, 'r', encoding='utf-8') as current:
+                    rotated.write(current.read())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+
+    def has_entries(self):
+        return any(os.path.exists(path) and os.path.getsize(path) > 0 for path in [self.rotated_path, self.path]) or bool(self.pending)
+
+    def discard_rotated(self):
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+
+    def replay(self, all_items):
+        # Apply the journal(s) over a freshly loaded snapshot.  Returns the ids that were changed.
+        changed_ids = set()
+        for path in [self.rotated_path, self.path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line_number, line in enumerate(f, 1):
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning(f"JOURNAL: Ignoring unreadable line {line_number} in {path} (interrupted write?)")
+                        continue
+                    if 'item' in entry:
+                        existing = all_items.get(entry['id'])
+                        if existing is None:
+                            all_items[entry['id']] = MediaRecord.from_api(entry['item'])
+                        else:
+                            existing.update((key, value) for key, value in entry['item'].items() if key != 'mediaMetadata')
+                    elif entry['id'] in all_items:
+                        all_items[entry['id']].update(entry['set'])
+                    else:
+                        continue
+                    changed_ids.add(entry['id'])
+        if changed_ids:
+            logging.info(f"JOURNAL: Replayed changes to {len(changed_ids)} items from {self.path}")
+        return changed_ids
+
+    def close(self):
+        with self.lock:
+            self._write_pending(force_fsync=True)
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def open_index_store(backup_path, backend=None):
+    # Pick the index backend.  Without an explicit choice, an existing DownloadItems.db wins over the JSON file.
+    if backend is None:
+        backend = 'sqlite' if os.path.exists(os.path.join(backup_path, SQLITE_INDEX_FILENAME)) else 'json'
+    if backend == 'sqlite':
+        return SqliteIndexStore(backup_path)
+    if backend == 'json':
+        return JsonIndexStore(backup_path)
+    raise ValueError(f"Unknown index backend: {backend}")
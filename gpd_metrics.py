@@ -0,0 +1,271 @@
+# Metrics for the Google Photos Downloader.
+# MetricsRegistry holds counters, gauges and latency histograms that the fetch and download workers update from any
+# thread; every metric has its own lock, so an update never waits on the others.  Collectors registered with
+# add_collector() refresh derived gauges (throughput, queue depths) just before the metrics are read.
+# MetricsExporter rewrites a Prometheus textfile (for node_exporter's textfile collector) every interval seconds, and
+# write_summary() leaves a JSON summary of a whole command behind, to compare runs with each other.
+
+import os
+import json
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# seconds; covers a local disk write (milliseconds) up to a large video over a slow link
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+EXPORT_INTERVAL = 15  # seconds between textfile writes
+SUMMARY_QUANTILES = (0.5, 0.9, 0.99)
+METRICS_DIRNAME = 'Metrics'  # default folder of the run summaries in the backup path; skipped by the scanner
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        # Returns the new value, so callers can act on it (e.g. log every n-th download) without a second read.
+        with self.lock:
+            self.value += amount
+            return self.value
+
+    def sample(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+            return self.value
+
+    def dec(self, amount=1):
+        return self.inc(-amount)
+
+    def sample(self):
+        return self.value
+
+
+class Histogram:
+    # Fixed buckets, as Prometheus histograms.  Quantiles are interpolated within a bucket, so they are estimates.
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def sample(self):
+        with self.lock:
+            return list(self.counts), self.count, self.sum, self.min, self.max
+
+    def quantile(self, q):
+        counts, count, _, low, high = self.sample()
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else high
+                lower, upper = max(lower, low), min(upper, high)
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return high
+
+
+@contextmanager
+def timed(histogram):
+    # histogram.time() that also accepts None, for code that runs with or without metrics.
+    if histogram is None:
+        yield
+    else:
+        with histogram.time():
+            yield
+
+
+def _label_text(labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}' if labels else ''
+
+
+def _number(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, float) and math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    # Families of metrics by name, each with one metric per label set.  counter/gauge/histogram return the existing
+    # metric when called again with the same name and labels, so call sites need not keep references around.
+    def __init__(self):
+        self.families = {}  # name -> [kind, help, {labels tuple: metric}]
+        self.collectors = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def _metric(self, kind, factory, name, help_text, labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = [kind, help_text, {}]
+            elif family[0] != kind:
+                raise ValueError(f"metric {name} is a {family[0]}, not a {kind}")
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+    def counter(self, name, help_text='', **labels):
+        return self._metric('counter', Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text='', **labels):
+        return self._metric('gauge', Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text='', buckets=LATENCY_BUCKETS, **labels):
+        return self._metric('histogram', lambda: Histogram(buckets), name, help_text, labels)
+
+    def add_collector(self, collect):
+        # collect() is called before every export and summary, to set gauges derived from other state.
+        with self.lock:
+            self.collectors.append(collect)
+
+    def collect(self):
+        with self.lock:
+            collectors = list(self.collectors)
+        for collect in collectors:
+            try:
+                collect()
+            except Exception as e:  # a broken gauge must not stop the export of the others
+                logging.warning(f"METRICS: Collector {collect!r} failed: {e!r}")
+
+    def _families(self):
+        with self.lock:
+            return [(name, kind, help_text, list(metrics.items())) for name, (kind, help_text, metrics) in sorted(self.families.items())]
+
+    def to_prometheus(self):
+        # The Prometheus text exposition format.
+        self.collect()
+        lines = []
+        for name, kind, help_text, metrics in self._families():
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                if kind != 'histogram':
+                    lines.append(f"{name}{_label_text(labels)} {_number(metric.sample())}")
+                    continue
+                counts, count, total, _, _ = metric.sample()
+                cumulative = 0
+                for bound, bucket_count in zip(metric.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{_label_text(labels + (('le', _number(float(bound))),))} {cumulative}")
+                lines.append(f"{name}_sum{_label_text(labels)} {_number(total)}")
+                lines.append(f"{name}_count{_label_text(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # {name: value} for counters and gauges and {name: {count, sum, mean, min, max, p50, p90, p99}} for
+        # histograms; names carry their labels as in the textfile.
+        self.collect()
+        summary = {}
+        for name, kind, _, metrics in self._families():
+            for labels, metric in metrics:
+                key = name + _label_text(labels)
+                if kind != 'histogram':
+                    summary[key] = metric.sample()
+                    continue
+                _, count, total, low, high = metric.sample()
+                entry = {'count': count, 'sum': round(total, 6), 'mean': round(total / count, 6) if count else None,
+                         'min': round(low, 6) if low is not None else None, 'max': round(high, 6) if high is not None else None}
+                for q in SUMMARY_QUANTILES:
+                    value = metric.quantile(q)
+                    entry[f'p{int(q * 100)}'] = round(value, 6) if value is not None else None
+                summary[key] = entry
+        return summary
+
+    def write_textfile(self, path):
+        # Written to a temporary file and renamed, so the collector never reads half a file.
+        _write_atomically(path, self.to_prometheus())
+
+    def write_summary(self, path, **context):
+        # JSON summary of a run.  context (command, options, ...) is stored alongside the metrics.
+        finished = time.time()
+        document = dict(context, started=datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                        finished=datetime.fromtimestamp(finished, timezone.utc).isoformat(),
+                        seconds=round(finished - self.started, 3), metrics=self.summary())
+        _write_atomically(path, json.dumps(document, indent=4, default=str))
+
+
+def _write_atomically(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class MetricsExporter:
+    # Rewrites registry's Prometheus textfile every interval seconds in a daemon thread, and once more on stop().
+    def __init__(self, registry, path, interval=EXPORT_INTERVAL):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='metrics-exporter', daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def export(self):
+        try:
+            self.registry.write_textfile(self.path)
+        except OSError as e:
+            logging.warning(f"METRICS: Could not write {self.path}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.export()
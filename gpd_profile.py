@@ -0,0 +1,144 @@
+# Per-phase profiling for the Google Photos Downloader (--profile).
+# PhaseProfiler.instrument(downloader) wraps the downloader's phase methods: index load and save, scan, fetch,
+# download, validate and stats.  Every call of a phase is timed in wall and process CPU time.  The outermost phase on
+# a thread also runs under cProfile, and when no other phase is running its tracemalloc peak and the allocations it
+# left behind are recorded too.  Nested phases (the scanner saving the index) are timed on their own, while their
+# profile is part of their caller's.  Each profiled call leaves <n>_<phase>.pstats and <n>_<phase>_allocations.txt
+# in output_dir as soon as it ends, so an interrupted run keeps what it measured.
+# cProfile only follows the thread that called the phase: the CPU time of the download workers shows up in the
+# summary, but not in the .pstats files.
+
+import os
+import time
+import cProfile
+import logging
+import functools
+import threading
+import tracemalloc
+
+PHASES = ('load_index_from_file', 'scandisk_and_get_filepaths_and_filenames', 'get_all_media_items', 'download_photos',
+          'fetch_and_download_photos', 'validate_repository', 'verify_content', 'report_stats', 'save_index_to_file')
+TOP_ALLOCATIONS = 25  # lines in each allocations report
+TRACEMALLOC_FRAMES = 1  # frames kept per allocation; more makes reports richer and tracing slower
+PROFILES_DIRNAME = 'Profiles'  # folder of the --profile output in the backup path; skipped by the scanner
+
+
+class PhaseProfiler:
+    def __init__(self, output_dir, phases=PHASES, memory=True):
+        self.output_dir = output_dir
+        self.phases = phases
+        self.memory = memory  # tracemalloc peaks and allocation reports; slows allocation-heavy phases down considerably
+        self.calls = []  # {'sequence', 'phase', 'depth', 'wall', 'cpu', 'peak'} per finished call, in the order they ended
+        self.lock = threading.Lock()
+        self.local = threading.local()  # phases running on this thread
+        self.active = 0  # phases running on any thread
+        self.sequence = 0
+        self.started_tracing = False
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.started_tracing = True
+        return self
+
+    def instrument(self, target):
+        # Replace target's phase methods with profiled ones.  Only this instance is affected, and calls between its
+        # methods (self.save_index_to_file() in the scanner) go through the wrappers as well.
+        for phase in self.phases:
+            method = getattr(target, phase, None)
+            if method is not None:
+                setattr(target, phase, self.wrap(phase, method))
+        return target
+
+    def wrap(self, phase, function):
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            return self.run(phase, function, args, kwargs)
+        return profiled
+
+    def run(self, phase, function, args, kwargs):
+        depth = getattr(self.local, 'depth', 0)
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+            owns_memory = self.memory and self.active == 0 and tracemalloc.is_tracing()  # the peak is process-wide; finish() stops tracing
+            self.active += 1
+        profile = None
+        if depth == 0:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:  # Python 3.12+ allows one active profiler, e.g. while a fetch thread is being profiled
+                profile = None
+        if owns_memory:
+            tracemalloc.reset_peak()
+        self.local.depth = depth + 1
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            if profile is not None:
+                profile.disable()
+            self.local.depth = depth
+            peak = tracemalloc.get_traced_memory()[1] if owns_memory else None
+            snapshot = tracemalloc.take_snapshot() if owns_memory and depth == 0 else None
+            with self.lock:
+                self.active -= 1
+            call = {'sequence': sequence, 'phase': phase, 'depth': depth, 'wall': wall, 'cpu': cpu, 'peak': peak}
+            self.write_call(call, profile, snapshot)
+            with self.lock:
+                self.calls.append(call)
+
+    def write_call(self, call, profile, snapshot):
+        if profile is None and snapshot is None:
+            return
+        prefix = os.path.join(self.output_dir, f"{call['sequence']:03d}_{call['phase']}")
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            if profile is not None:
+                profile.dump_stats(prefix + '.pstats')
+            if snapshot is not None:
+                snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap>')])
+                with open(prefix + '_allocations.txt', 'w') as f:
+                    f.write(f"Largest allocations still held when {call['phase']} returned (peak during the phase: {call['peak'] / 1024 / 1024:.1f} MB)\n")
+                    for statistic in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                        f.write(f"{statistic}\n")
+        except OSError as e:
+            logging.error(f"PROFILER: Could not write {prefix}: {e}")
+
+    def summary(self):
+        # One row per phase, in the order the phases first ended.  Nested phases are also included in their callers' times,
+        # and CPU time is the whole process's, so phases that ran at the same time share theirs.
+        with self.lock:
+            calls = list(self.calls)
+        phases = {}
+        for call in calls:
+            row = phases.setdefault(call['phase'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak': None})
+            row['calls'] += 1
+            row['wall'] += call['wall']
+            row['cpu'] += call['cpu']
+            if call['peak'] is not None:
+                row['peak'] = max(row['peak'] or 0, call['peak'])
+        width = max([len(phase) for phase in phases] + [5])
+        lines = [f"{'phase':<{width}}  {'calls':>5}  {'wall s':>9}  {'cpu s':>9}  {'peak MB':>9}"]
+        for phase, row in phases.items():
+            peak = f"{row['peak'] / 1024 / 1024:9.1f}" if row['peak'] is not None else f"{'-':>9}"
+            lines.append(f"{phase:<{width}}  {row['calls']:>5}  {row['wall']:9.2f}  {row['cpu']:9.2f}  {peak}")
+        return '\n'.join(lines)
+
+    def finish(self):
+        # Stop tracing, write summary.txt next to the profiles and return the table.
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        table = self.summary()
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(os.path.join(self.output_dir, 'summary.txt'), 'w') as f:
+                f.write(table + '\n')
+        except OSError as e:
+            logging.error(f"PROFILER: Could not write the summary to {self.output_dir}: {e}")
+        return table
@@ -0,0 +1,166 @@
+# Rate limiting for the Google Photos Downloader.
+# RateLimiter holds one TokenBucket per endpoint: the Library API (search, batchGet) and the content host the files
+# are downloaded from.  acquire() blocks on a condition variable until a token is due instead of polling, and each
+# bucket adapts its rate AIMD style: it halves on HTTP 429 or 5xx and grows a little after every run of successes.
+
+import time
+import threading
+
+from gpd_metrics import timed
+
+THROTTLE_STATUSES = {429, 500, 502, 503, 504}  # answers that mean "slow down"
+THROTTLE_COOLDOWN = 1.0  # seconds after a cut in which further throttled answers do not cut again
+
+
+def http_status(error):
+    # Status code carried by a googleapiclient HttpError (e.resp.status) or a requests HTTPError, else None.
+    resp = getattr(error, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None) is not None:
+        return int(resp.status)
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+class TokenBucket:
+    # Token bucket with a blocking acquire() and AIMD rate adaptation.  With min_rate == max_rate == rate (the default)
+    # the rate is fixed.  Otherwise record() moves the rate between min_rate and max_rate: a throttled answer
+    # multiplies it by decrease_factor and empties the bucket, and every success_window successes add increase.
+    def __init__(self, rate, capacity, name='bucket', min_rate=None, max_rate=None, increase=None, decrease_factor=0.5,
+                 success_window=None):
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.min_rate = float(min_rate if min_rate is not None else rate)
+        self.max_rate = float(max_rate if max_rate is not None else rate)
+        self.increase = increase if increase is not None else max(self.min_rate, 0.1)
+        self.decrease_factor = decrease_factor
+        self.success_window = success_window or max(10, capacity)
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.condition = threading.Condition()
+        self.success_streak = 0
+        self.last_decrease = float('-inf')
+        # stats
+        self.acquired = 0
+        self.throttled = 0
+        self.decreases = 0
+        self.increases = 0
+        self.wait_seconds = 0.0
+        self.lowest_rate = self.rate
+
+    def refill(self):
+        # Call with the condition held.
+        now = time.monotonic()
+        self.tokens = min(self.tokens + self.rate * (now - self.last_refill), self.capacity)
+        self.last_refill = now
+
+    def try_acquire(self):
+        # Takes a token and returns 0.0, or returns the seconds until the next token is due.  Never blocks; this is
+        # what the asyncio engine sleeps on.
+        with self.condition:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.acquired += 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        # Non-blocking: True if a token was taken.
+        return self.try_acquire() == 0.0
+
+    def acquire(self, timeout=None):
+        # Blocks until a token is taken (True) or timeout seconds have passed (False).  The wait is timed to the next
+        # token; a change of rate wakes the waiters so they recompute it.
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self.condition:
+            while True:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.acquired += 1
+                    self.wait_seconds += time.monotonic() - start
+                    return True
+                wait = (1 - self.tokens) / self.rate
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.wait_seconds += time.monotonic() - start
+                        return False
+                    wait = min(wait, remaining)
+                self.condition.wait(wait)
+
+    def record(self, status):
+        # Feed back the HTTP status of a request made with a token.  None (no answer, e.g. a dropped connection)
+        # counts neither way.
+        if status is None:
+            return
+        with self.condition:
+            self.refill()
+            if status in THROTTLE_STATUSES:
+                self.throttled += 1
+                self.success_streak = 0
+                now = time.monotonic()
+                # one cut per burst: requests already in flight come back throttled too
+                if now - self.last_decrease >= THROTTLE_COOLDOWN and self.rate > self.min_rate:
+                    self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                    self.lowest_rate = min(self.lowest_rate, self.rate)
+                    self.decreases += 1
+                    self.last_decrease = now
+                self.tokens = min(self.tokens, 0)  # pause everyone for about one token
+                self.condition.notify_all()
+            elif status < 400:
+                self.success_streak += 1
+                if self.success_streak >= self.success_window and self.rate < self.max_rate:
+                    self.rate = min(self.max_rate, self.rate + self.increase)
+                    self.increases += 1
+                    self.success_streak = 0
+                    self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {'name': self.name, 'rate': round(self.rate, 3), 'lowest_rate': round(self.lowest_rate, 3),
+                    'acquired': self.acquired, 'throttled': self.throttled, 'decreases': self.decreases,
+                    'increases': self.increases, 'wait_seconds': round(self.wait_seconds, 2)}
+
+    def __repr__(self):
+        stats = self.stats()
+        return (f"{self.name}: {stats['acquired']} requests at {stats['rate']}/s (lowest {stats['lowest_rate']}/s), "
+                f"{stats['throttled']} throttled, {stats['wait_seconds']} s waiting")
+
+
+class RateLimiter:
+    # The buckets of one downloader, one per endpoint.  Passed to GooglePhotosDownloader(rate_limiter=...).
+    def __init__(self, api_rate=1, api_capacity=2, api_max_rate=5, content_rate=20, content_capacity=20, content_max_rate=200):
+        # The Library API starts at the old fixed 1 request/s and may ramp up to api_max_rate; the content host is
+        # not quota limited, so its bucket mostly matters when it starts answering 429.
+        self.api = TokenBucket(api_rate, api_capacity, name='api', min_rate=min(api_rate, 0.1), max_rate=max(api_rate, api_max_rate),
+                               increase=0.1)
+        self.content = TokenBucket(content_rate, content_capacity, name='content', min_rate=min(content_rate, 1),
+                                   max_rate=max(content_rate, content_max_rate), increase=1)
+
+    def stats(self):
+        return {'api': self.api.stats(), 'content': self.content.stats()}
+
+    def __repr__(self):
+        return f"{self.api!r}; {self.content!r}"
+
+
+def execute_with_limiter(request, bucket, retries=3, latency=None):
+    # request.execute() for a googleapiclient request, after a token from bucket.  Throttled answers are fed back to
+    # the bucket and retried (the bucket has slowed down by then); other errors are raised at once.
+    # latency: gpd_metrics.Histogram of the calls themselves, without the time spent waiting for a token.
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            with timed(latency):
+                response = request.execute()
+        except Exception as e:
+            status = http_status(e)
+            bucket.record(status)
+            if status not in THROTTLE_STATUSES or attempt == retries:
+                raise
+            continue
+        bucket.record(200)
+        return response
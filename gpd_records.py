@@ -0,0 +1,362 @@
+# In-memory model for media items in the Google Photos Downloader index.
+# A MediaRecord replaces the raw mediaItems().search dicts: the fields the downloader works with are kept in
+# __slots__ (status as a shared MediaStatus member, creationTime as epoch seconds, width/height as ints) and the
+# rest of the API record is either kept in a small extras dict or read back from the index file when first needed.
+# MediaIndex keeps secondary indexes (status, creation time, mimeType, filename) over a dict of MediaRecords.
+
+import re
+import sys
+import time
+import bisect
+import calendar
+import threading
+from enum import Enum
+from datetime import datetime, timezone, timedelta
+from collections import defaultdict
+from collections.abc import MutableMapping
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+CANONICAL_CREATION_TIME = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})Z$')
+
+
+class MediaStatus(str, Enum):
+    # Compares equal to the plain strings used in DownloadItems.json, so item['status'] == 'verified' keeps working.
+    FETCHED = 'fetched'
+    DOWNLOADED = 'downloaded'
+    VERIFIED = 'verified'
+    MISSING = 'missing'
+    FAILED = 'failed'
+
+    def __str__(self):
+        return self.value
+
+    __format__ = str.__format__
+
+    @classmethod
+    def parse(cls, value):
+        # Statuses written by other tools are kept as interned strings.
+        if value is None or isinstance(value, cls):
+            return value
+        member = cls._value2member_map_.get(value)
+        return member if member is not None else sys.intern(value)
+
+
+def parse_creation_time(text):
+    # Returns (epoch seconds, original text or None).  The text is only kept when it cannot be regenerated
+    # exactly from the epoch value, e.g. when it carries fractional seconds.
+    match = CANONICAL_CREATION_TIME.match(text)
+    if match:
+        return calendar.timegm(tuple(int(part) for part in match.groups())), None
+    try:
+        created = datetime.fromisoformat(text.replace('Z', '+00:00'))
+        if created.tzinfo is None:
+            created = created.replace(tzinfo=timezone.utc)
+        return int((created - EPOCH) // timedelta(seconds=1)), text
+    except ValueError:
+        return None, text
+
+
+def format_creation_time(timestamp):
+    # timedelta arithmetic rather than time.gmtime so pre-1970 photos also work on Windows
+    return (EPOCH + timedelta(seconds=timestamp)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def compact_dimension(value):
+    # API dimensions are decimal strings; keep them as ints only if the string can be rebuilt exactly.
+    if isinstance(value, str) and value.isdigit() and str(int(value)) == value:
+        return int(value)
+    return None
+
+
+class MediaRecord(MutableMapping):
+    # Top-level record keys that live in slots.  None means the key is absent from the record.
+    # content_hash is {"sha256", "path", "size", "mtime"} from the last verify_content run.
+    # partial_download is the resume state of an interrupted download (see gpd_download.stream_to_file).
+    SLOT_KEYS = ('id', 'filename', 'mimeType', 'status', 'file_path', 'file_size', 'date_fetched', 'date_downloaded', 'content_hash',
+                 'partial_download')
+    # Keys of the API record that are only valid for a while and are never stored: baseUrl expires after about an hour
+    # (gpd_download.BaseUrlResolver caches it in memory instead), baseURL is how earlier versions misspelled it.
+    TRANSIENT_KEYS = ('baseUrl', 'baseURL')
+    __slots__ = SLOT_KEYS + ('creation_ts', 'width', 'height', '_creation_text', '_extra', '_source', '_start', '_end')
+
+    def __init__(self, record, source=None, start=None, end=None):
+        # With a source, the record was read from the index and everything not in slots is dropped from memory
+        # (reloaded through source.read_record on demand).  Without one, the leftovers are kept in _extra.
+        for key in self.SLOT_KEYS:
+            setattr(self, key, record.get(key))
+        self.status = MediaStatus.parse(self.status)
+        if self.mimeType is not None:
+            self.mimeType = sys.intern(self.mimeType)
+        media_metadata = record.get('mediaMetadata', {})
+        creation_time = media_metadata.get('creationTime')
+        self.creation_ts, self._creation_text = parse_creation_time(creation_time) if creation_time is not None else (None, None)
+        self.width = compact_dimension(media_metadata.get('width'))
+        self.height = compact_dimension(media_metadata.get('height'))
+        self._source = source
+        self._start = start
+        self._end = end
+        self._extra = None if source is not None else self._extract_extra(record)
+
+    @classmethod
+    def from_api(cls, item):
+        # Ingest a dict returned by mediaItems().search / get.
+        return item if isinstance(item, cls) else cls(item)
+
+    @classmethod
+    def from_header(cls, source, creation_time, **header):
+        # Build a record straight from stored index columns, without decoding the full record.
+        record = cls.__new__(cls)
+        for key in cls.SLOT_KEYS:
+            setattr(record, key, header.get(key))
+        record.status = MediaStatus.parse(record.status)
+        record.creation_ts, record._creation_text = parse_creation_time(creation_time) if creation_time is not None else (None, None)
+        record.width, record.height = header.get('width'), header.get('height')
+        record._extra = None
+        record._source = source
+        record._start = record._end = None
+        return record
+
+    def _extract_extra(self, record):
+        # Everything in the API record that is not represented by a slot.
+        extra = {key: value for key, value in record.items()
+                 if key not in self.SLOT_KEYS and key not in self.TRANSIENT_KEYS and key != 'mediaMetadata'}
+        media_metadata = record.get('mediaMetadata')
+        if media_metadata is not None:
+            compacted = {'creationTime'} if self.creation_ts is not None or self._creation_text is not None else set()
+            if self.width is not None:
+                compacted.add('width')
+            if self.height is not None:
+                compacted.add('height')
+            extra['mediaMetadata'] = {key: value for key, value in media_metadata.items() if key not in compacted}
+        return extra
+
+    def _materialize(self):
+        if self._extra is None:
+            self._extra = self._extract_extra(self._source.read_record(self.id, self._start, self._end))
+        return self._extra
+
+    def relocate(self, source, start, end):
+        # Point the record at a freshly written copy in the index file and release the extras held in memory.
+        self._source, self._start, self._end = source, start, end
+        self._extra = None
+
+    @property
+    def creationTime(self):
+        if self._creation_text is not None:
+            return self._creation_text
+        return format_creation_time(self.creation_ts) if self.creation_ts is not None else None
+
+    def creation_datetime(self):
+        # Timezone-aware UTC datetime of mediaMetadata.creationTime
+        return EPOCH + timedelta(seconds=self.creation_ts)
+
+    @property
+    def is_video(self):
+        return self.mimeType is not None and 'video' in self.mimeType
+
+    def media_metadata(self):
+        media_metadata = {}
+        if self.creation_ts is not None or self._creation_text is not None:
+            media_metadata['creationTime'] = self.creationTime
+        if self.width is not None:
+            media_metadata['width'] = str(self.width)
+        if self.height is not None:
+            media_metadata['height'] = str(self.height)
+        extra = self._extra if self._extra is not None or self._source is None else self._materialize()
+        media_metadata.update(extra.get('mediaMetadata', {}) if extra else {})
+        return media_metadata
+
+    # Mapping interface, so a record can be used wherever an API item dict was used before.
+    # item['mediaMetadata'] returns a rebuilt copy; use the attributes to read or change its fields.
+    def __getitem__(self, key):
+        if key in self.SLOT_KEYS:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        if key == 'mediaMetadata':
+            return self.media_metadata()
+        return self._materialize()[key]
+
+    def __setitem__(self, key, value):
+        if key == 'status':
+            self.status = MediaStatus.parse(value)
+        elif key in self.SLOT_KEYS:
+            setattr(self, key, value)
+        elif key == 'mediaMetadata':
+            raise KeyError('mediaMetadata cannot be replaced on a MediaRecord')
+        else:
+            self._materialize()[key] = value
+
+    def __delitem__(self, key):
+        if key in self.SLOT_KEYS:
+            if getattr(self, key) is None:
+                raise KeyError(key)
+            setattr(self, key, None)
+        else:
+            del self._materialize()[key]
+
+    def __contains__(self, key):
+        if key in self.SLOT_KEYS:
+            return getattr(self, key) is not None
+        if key == 'mediaMetadata':
+            return True
+        return key in self._materialize()
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    def merge_into(self, record):
+        # Overlay the slot fields onto a decoded copy of this record from the index file.
+        # mediaMetadata is not touched: it never changes after ingest.
+        for key in self.SLOT_KEYS:
+            value = getattr(self, key)
+            if value is None:
+                record.pop(key, None)
+            else:
+                record[key] = value
+        return record
+
+    def to_dict(self):
+        # The record in the JSON shape of DownloadItems.json
+        record = {key: getattr(self, key) for key in self.SLOT_KEYS if getattr(self, key) is not None}
+        extra = self._materialize() if self._source is not None else self._extra
+        record.update((key, value) for key, value in extra.items() if key != 'mediaMetadata')
+        record['mediaMetadata'] = self.media_metadata()
+        return record
+
+    def __repr__(self):
+        return f"MediaRecord(id={self.id!r}, filename={self.filename!r}, status={self.status and str(self.status)!r})"
+
+
+def as_dict(item):
+    # Plain dict copy of an item, suitable for json.dumps.
+    return item.to_dict() if isinstance(item, MediaRecord) else item
+
+
+class MediaIndex:
+    # Secondary indexes over the downloader's {id: MediaRecord} dict, kept current through add/update/remove so that
+    # status, date, mime and filename lookups do not need a scan of the whole library.
+    INDEXED_FIELDS = ('status', 'filename')  # fields that can change after ingest and need their buckets moved
+
+    def __init__(self, records=None):
+        self.lock = threading.RLock()
+        self.rebuild(records if records is not None else {})
+
+    def rebuild(self, records):
+        # (Re)index a records dict.  The dict itself is referenced, not copied.
+        with self.lock:
+            self.records = records
+            self.by_status = defaultdict(set)
+            self.by_mime = defaultdict(set)
+            self.by_filename = defaultdict(set)
+            self.undated = set()
+            dated = []
+            for item_id, record in records.items():
+                self.by_status[record.status].add(item_id)
+                self.by_mime[record.mimeType].add(item_id)
+                self.by_filename[record.filename].add(item_id)
+                if record.creation_ts is None:
+                    self.undated.add(item_id)
+                else:
+                    dated.append((record.creation_ts, item_id))
+            dated.sort()
+            self.created_ts = [timestamp for timestamp, _ in dated]  # sorted creation times
+            self.created_ids = [item_id for _, item_id in dated]  # ids in the same order
+
+    def add(self, record):
+        with self.lock:
+            self.by_status[record.status].add(record.id)
+            self.by_mime[record.mimeType].add(record.id)
+            self.by_filename[record.filename].add(record.id)
+            if record.creation_ts is None:
+                self.undated.add(record.id)
+            else:
+                position = bisect.bisect_right(self.created_ts, record.creation_ts)
+                self.created_ts.insert(position, record.creation_ts)
+                self.created_ids.insert(position, record.id)
+
+    def remove(self, record):
+        with self.lock:
+            self._discard(self.by_status, record.status, record.id)
+            self._discard(self.by_mime, record.mimeType, record.id)
+            self._discard(self.by_filename, record.filename, record.id)
+            if record.creation_ts is None:
+                self.undated.discard(record.id)
+            else:
+                position = bisect.bisect_left(self.created_ts, record.creation_ts)
+                while position < len(self.created_ts) and self.created_ts[position] == record.creation_ts:
+                    if self.created_ids[position] == record.id:
+                        del self.created_ts[position]
+                        del self.created_ids[position]
+                        break
+                    position += 1
+
+    def update(self, record, changed):
+        # Call before the changed fields are applied to the record.
+        with self.lock:
+            if 'status' in changed:
+                self._discard(self.by_status, record.status, record.id)
+                self.by_status[MediaStatus.parse(changed['status'])].add(record.id)
+            if 'filename' in changed:
+                self._discard(self.by_filename, record.filename, record.id)
+                self.by_filename[changed['filename']].add(record.id)
+
+    @staticmethod
+    def _discard(buckets, key, item_id):
+        bucket = buckets.get(key)
+        if bucket is not None:
+            bucket.discard(item_id)
+            if not bucket:
+                del buckets[key]
+
+    def ids(self, status_in=None, status_not_in=None, created_between=None, mime=None, filename=None):
+        # Set of ids matching every given criterion.  created_between is an inclusive (start, end) pair of epoch
+        # seconds (either may be None); mime matches a full mimeType or a prefix such as 'video' or 'image/'.
+        with self.lock:
+            candidates = []
+            if status_in is not None:
+                candidates.append(set().union(*(self.by_status.get(MediaStatus.parse(status), ()) for status in status_in)))
+            if filename is not None:
+                candidates.append(set(self.by_filename.get(filename, ())))
+            if mime is not None:
+                candidates.append(set().union(*(ids for mime_type, ids in self.by_mime.items() if mime_type is not None and mime_type.startswith(mime))))
+            if created_between is not None:
+                start, end = created_between
+                low = 0 if start is None else bisect.bisect_left(self.created_ts, start)
+                high = len(self.created_ts) if end is None else bisect.bisect_right(self.created_ts, end)
+                candidates.append(set(self.created_ids[low:high]))
+            if candidates:
+                candidates.sort(key=len)
+                result = candidates[0].intersection(*candidates[1:])
+            else:
+                result = set(self.records)
+            if status_not_in is not None:
+                for status in status_not_in:
+                    result -= self.by_status.get(MediaStatus.parse(status), set())
+            return result
+
+    def items(self, **criteria):
+        # {id: record} for the matching records, oldest first.
+        ids = self.ids(**criteria)
+        records = self.records
+        return {item_id: records[item_id] for item_id in sorted(ids, key=lambda item_id: records[item_id].creation_ts or 0)}
+
+    def count(self, **criteria):
+        return len(self.ids(**criteria))
+
+    def stats(self, recent_days=7):
+        # The report_stats figures, computed from the buckets rather than by visiting every record.
+        with self.lock:
+            sized_ids = self.ids(status_in=['downloaded', 'verified'])
+            total_size = sum(self.records[item_id].file_size or 0 for item_id in sized_ids)
+            images = self.ids(mime='image')
+            videos = self.ids(mime='video') - images
+            recent_cutoff = time.time() - (recent_days + 1) * 86400
+            recent_changes = len(self.created_ts) - bisect.bisect_right(self.created_ts, recent_cutoff)
+            status_counts = {str(status) if status is not None else None: len(ids) for status, ids in self.by_status.items()}
+        return {'total_size': total_size, 'total_files': len(self.records), 'total_images': len(images),
+                'total_videos': len(videos), 'recent_changes': recent_changes, 'status_counts': status_counts}
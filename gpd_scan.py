@@ -0,0 +1,317 @@
+# Repository scanning for the Google Photos Downloader.
+# plan_reconciliation() matches the index against the files found on disk in a single pass using hash lookups
+# (filename -> paths, path -> item) and returns a plan that the scanner then executes.
+# walk_repository() lists the backup tree once with os.scandir, in parallel across subtrees, and captures the stat data
+# the scanner and validator need so neither has to touch the filesystem per item.
+# ScanCache persists each directory's mtime and listing, so later walks only re-list directories that changed.
+# validate_snapshot() checks the index against one snapshot with set lookups, and apply_extraneous_policy() deals
+# with the files nothing in the index accounts for.
+
+import os
+import json
+import time
+import shutil
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from gpd_download import PART_SUFFIX
+
+FileEntry = namedtuple('FileEntry', ['name', 'size', 'mtime', 'inode'])
+
+
+class RepositorySnapshot:
+    # Result of one walk of the backup tree.
+    def __init__(self, root):
+        self.root = root
+        self.files = {}  # normalized path -> FileEntry
+        self.dir_mtimes = {}  # normalized directory path -> mtime
+        self.errors = []  # (path, error) for directories that could not be listed
+        self.listed_count = 0  # directories listed from disk
+        self.cached_count = 0  # directories taken from the scan cache
+
+    def filepaths_and_filenames(self):
+        # {path: filename}, the shape the scanner has always worked with
+        return {path: entry.name for path, entry in self.files.items()}
+
+    def add(self, path, entry):
+        self.files[path] = entry
+
+    def move(self, old_path, new_path):
+        entry = self.files.pop(old_path)
+        self.files[new_path] = entry._replace(name=os.path.basename(new_path))
+
+
+def list_directory(path):
+    # One scandir pass over a directory.  Returns ({file path: FileEntry}, [subdirectory paths], directory mtime).
+    files = {}
+    subdirectories = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(os.path.normpath(entry.path))
+            elif entry.is_file():
+                if entry.name.endswith(PART_SUFFIX):
+                    continue  # an interrupted download, kept for resuming; not part of the repository
+                stat = entry.stat()  # served from the directory listing on Windows, one lstat elsewhere
+                filename = entry.name.replace('\\', '-').replace('/', '-') #some weird filenames contain slashes.  Replace them with dashes.
+                files[os.path.normpath(os.path.join(path, filename))] = FileEntry(filename, stat.st_size, stat.st_mtime, entry.inode())
+    return files, subdirectories, os.stat(path).st_mtime
+
+
+class ScanCache:
+    # Directory listings from the last walk, stored next to the index as ScanCache.json:
+    # {relative dir: {"mtime": ..., "scanned_at": ..., "files": {name: [size, mtime, inode]}, "subdirs": [names]}}.
+    # A directory's mtime changes when entries are added, removed or renamed in it, so an unchanged mtime means the
+    # cached listing is still right.  In-place rewrites of a file do not change the directory mtime; use a full
+    # rescan (or verify_content) after editing files by hand.
+    FILENAME = 'ScanCache.json'
+    MTIME_GRANULARITY = 2.0  # seconds; FAT/exFAT and some network shares store mtimes this coarsely
+
+    def __init__(self, backup_path):
+        self.root = os.path.normpath(backup_path)
+        self.path = os.path.join(self.root, self.FILENAME)
+        self.directories = {}
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.directories = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logging.warning(f"SCANNER: Ignoring unreadable scan cache {self.path}: {e}")
+                self.directories = {}
+
+    def lookup(self, path, mtime):
+        # Cached (files, subdirectories, scanned_at) for a directory whose mtime is unchanged, else None.
+        entry = self.directories.get(os.path.relpath(path, self.root))
+        if entry is None or entry['mtime'] != mtime:
+            return None
+        if mtime >= entry['scanned_at'] - self.MTIME_GRANULARITY:
+            return None  # modified too close to the last scan to be sure the listing caught the change
+        files = {os.path.join(path, name): FileEntry(name, *values) for name, values in entry['files'].items()}
+        return files, [os.path.join(path, name) for name in entry['subdirs']], entry['scanned_at']
+
+    def update(self, listings):
+        # Replace the cache with the directories seen in this walk; vanished directories drop out.
+        self.directories = {
+            os.path.relpath(path, self.root): {
+                'mtime': mtime,
+                'scanned_at': scanned_at,
+                'files': {entry.name: [entry.size, entry.mtime, entry.inode] for entry in files.values()},
+                'subdirs': [os.path.basename(subdirectory) for subdirectory in subdirectories],
+            }
+            for path, (files, subdirectories, mtime, scanned_at) in listings.items()
+        }
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.directories, f)
+        os.replace(temp_path, self.path)
+
+
+def _visit_directory(path, cache):
+    # Returns (files, subdirectories, mtime, scanned_at, from_cache)
+    scanned_at = time.time()
+    if cache is not None:
+        mtime = os.stat(path).st_mtime
+        cached = cache.lookup(path, mtime)
+        if cached is not None:
+            files, subdirectories, cached_at = cached
+            return files, subdirectories, mtime, cached_at, True
+    files, subdirectories, mtime = list_directory(path)
+    return files, subdirectories, mtime, scanned_at, False
+
+
+def walk_repository(backup_path, num_workers=8, include_root_files=False, cache=None, use_cache=True, exclude_dirs=()):
+    # Walk every subdirectory of backup_path in a thread pool.  Each directory is one task, so the year/month folders
+    # are listed concurrently, which hides most of the per-call latency of OneDrive and network mounts.
+    # Files directly in backup_path (the index, the log) are left out unless include_root_files is set.
+    # With a ScanCache, unchanged directories cost one stat instead of a listing (use_cache=False forces a full
+    # listing but still refreshes the cache).  Directories in exclude_dirs (e.g. the quarantine folder) are skipped.
+    root = os.path.normpath(backup_path)
+    excluded = {os.path.normpath(path) for path in exclude_dirs}
+    snapshot = RepositorySnapshot(root)
+    lookup_cache = cache if use_cache else None
+    listings = {}  # path -> (files, subdirectories, mtime, scanned_at) for the cache
+    root_files, pending_dirs, root_mtime = list_directory(root)
+    pending_dirs = [path for path in pending_dirs if path not in excluded]
+    snapshot.dir_mtimes[root] = root_mtime
+    if include_root_files:
+        snapshot.files.update(root_files)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(_visit_directory, path, lookup_cache): path for path in pending_dirs}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = futures.pop(future)
+                try:
+                    files, subdirectories, mtime, scanned_at, from_cache = future.result()
+                except OSError as e:
+                    logging.error(f"SCANNER: Could not list {path}: {e}")
+                    snapshot.errors.append((path, e))
+                    continue
+                snapshot.files.update(files)
+                snapshot.dir_mtimes[path] = mtime
+                listings[path] = (files, subdirectories, mtime, scanned_at)
+                if from_cache:
+                    snapshot.cached_count += 1
+                else:
+                    snapshot.listed_count += 1
+                for subdirectory in subdirectories:
+                    if subdirectory in excluded:
+                        continue
+                    futures[executor.submit(_visit_directory, subdirectory, lookup_cache)] = subdirectory
+    if cache is not None and not snapshot.errors:
+        cache.update(listings)
+        cache.save()
+    return snapshot
+
+
+class ReconciliationPlan:
+    # Outcome of matching index items against the files on disk.
+    def __init__(self):
+        self.verified = []  # (record, path): file is at its convention path
+        self.misplaced = []  # (record, current_path, convention_path): correctly named file in the wrong place
+        self.misnamed = []  # (record, current_path, convention_path): file found under the item's old name
+        self.missing = []  # records that were downloaded or verified but have no file on disk
+        self.orphans = []  # paths on disk that no index item accounts for
+        self.duplicates = []  # (record, path): further copies of a file that was already matched
+
+    def moves(self):
+        return self.misplaced + self.misnamed
+
+    def summary(self):
+        return (f"{len(self.verified)} verified, {len(self.misplaced)} misplaced, {len(self.misnamed)} misnamed, "
+                f"{len(self.missing)} missing, {len(self.orphans)} orphan files, {len(self.duplicates)} duplicate copies")
+
+
+def plan_reconciliation(records, filepaths_and_filenames, construct_file_path):
+    # records: iterable of MediaRecords.  filepaths_and_filenames: {normalized path: filename} from the disk scan.
+    # construct_file_path(record) -> (convention_filename, convention_filepath).
+    # Every item is classified with O(1) lookups, so the whole plan is O(items + files).
+    plan = ReconciliationPlan()
+    paths_by_filename = {}
+    for path, filename in filepaths_and_filenames.items():
+        paths_by_filename.setdefault(filename, []).append(path)
+    claimed = set()  # paths already matched to an item
+    verified_ids = set()
+
+    conventions = []
+    for record in records:
+        convention_filename, convention_filepath = construct_file_path(record)
+        conventions.append((record, convention_filename, convention_filepath))
+        if convention_filepath in filepaths_and_filenames and convention_filepath not in claimed:
+            # Claim exact matches first so they are never taken as the source of a move for another item.
+            claimed.add(convention_filepath)
+            verified_ids.add(record.id)
+            plan.verified.append((record, convention_filepath))
+
+    # Old-name candidates are only trusted inside the item's own year/month folder, and only if no other item
+    # in that folder has the same original name (camera filenames like IMG_0001.jpg repeat).
+    old_name_counts = {}
+    for record, convention_filename, convention_filepath in conventions:
+        if record.filename and record.filename != convention_filename:
+            key = (os.path.dirname(convention_filepath), record.filename)
+            old_name_counts[key] = old_name_counts.get(key, 0) + 1
+
+    for record, convention_filename, convention_filepath in conventions:
+        if record.id in verified_ids:
+            # further copies of the same convention filename elsewhere are duplicates
+            for path in paths_by_filename.get(convention_filename, ()):
+                if path != convention_filepath and path not in claimed:
+                    claimed.add(path)
+                    plan.duplicates.append((record, path))
+            continue
+
+        source = None
+        # 1. the path recorded in the index, if the file is still there
+        recorded_path = os.path.normpath(record.file_path) if record.file_path else None
+        if recorded_path and recorded_path in filepaths_and_filenames and recorded_path not in claimed:
+            source = recorded_path
+        # 2. a correctly named file anywhere in the repository
+        if source is None:
+            for path in paths_by_filename.get(convention_filename, ()):
+                if path not in claimed:
+                    source = path
+                    break
+        if source is not None:
+            claimed.add(source)
+            plan.misplaced.append((record, source, convention_filepath))
+            continue
+        # 3. the item's original (pre-convention) name in its own folder
+        if record.filename and record.filename != convention_filename:
+            convention_dir = os.path.dirname(convention_filepath)
+            if old_name_counts.get((convention_dir, record.filename)) == 1:
+                candidate = os.path.join(convention_dir, record.filename)
+                if candidate in filepaths_and_filenames and candidate not in claimed:
+                    claimed.add(candidate)
+                    plan.misnamed.append((record, candidate, convention_filepath))
+                    continue
+        if record.status in ['downloaded', 'verified'] or record.file_path:
+            plan.missing.append(record)
+
+    plan.orphans = [path for path in filepaths_and_filenames if path not in claimed]
+    return plan
+
+
+class ValidationReport:
+    # Outcome of checking the index against one snapshot of the backup tree.
+    def __init__(self):
+        self.verified = []  # (record, path): the recorded file_path exists
+        self.missing = []  # records whose recorded file_path is not on disk
+        self.extraneous = []  # paths on disk that no record points to
+
+    def summary(self):
+        return f"{len(self.verified)} verified, {len(self.missing)} missing, {len(self.extraneous)} extraneous files"
+
+
+def validate_snapshot(records, snapshot):
+    # One pass over the records and one over the files, each membership test a set/dict lookup: O(items + files).
+    report = ValidationReport()
+    verified_paths = set()
+    for record in records:
+        if record.file_path is None:
+            continue
+        path = os.path.normpath(record.file_path)
+        if path in snapshot.files:
+            verified_paths.add(path)
+            report.verified.append((record, path))
+        else:
+            report.missing.append(record)
+    report.extraneous = [path for path in snapshot.files if path not in verified_paths]
+    return report
+
+
+EXTRANEOUS_POLICIES = ['ask', 'leave', 'quarantine', 'delete']
+QUARANTINE_DIRNAME = '_extraneous'  # default quarantine folder inside the backup path; skipped by walk_repository
+
+
+def apply_extraneous_policy(extraneous_files, backup_path, policy, quarantine_dir):
+    # Deal with files that are not in the index.  'leave' does nothing, 'delete' removes them, and 'quarantine' moves
+    # them under quarantine_dir keeping their path relative to backup_path.  Returns the number of files handled.
+    if policy == 'leave':
+        logging.info("VALIDATOR: Leaving extraneous files alone")
+        return 0
+    handled = 0
+    for path in extraneous_files:
+        try:
+            if policy == 'delete':
+                os.remove(path)
+            elif policy == 'quarantine':
+                new_path = os.path.join(quarantine_dir, os.path.relpath(path, backup_path))
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                if os.path.exists(new_path):
+                    logging.warning(f"VALIDATOR: {new_path} already exists, leaving {path} in place")
+                    continue
+                shutil.move(path, new_path)  # the quarantine folder may be on another drive
+            else:
+                raise ValueError(f"Unknown extraneous file policy: {policy}")
+            handled += 1
+        except OSError as e:
+            logging.error(f"VALIDATOR: Could not {policy} {path}: {e}")
+    logging.info(f"VALIDATOR: {'Deleted' if policy == 'delete' else 'Quarantined'} {handled} of {len(extraneous_files)} extraneous files"
+                 + (f" to {quarantine_dir}" if policy == 'quarantine' else ''))
+    return handled
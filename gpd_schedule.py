@@ -0,0 +1,206 @@
+# Download scheduling for the Google Photos Downloader.
+# Items are split into a photo lane and a video lane, each with its own share of the workers, so a run of large
+# videos cannot hold every worker while thousands of small photos wait.  Within a lane the smallest estimated files go
+# first (sizes are guessed from mediaMetadata width/height and the mimeType), then the oldest.  A worker whose lane is
+# empty takes from the other lane, so no worker idles while there is work.
+# A streaming scheduler is fed while it runs (put/close), e.g. by the fetcher in the pipelined download mode; put()
+# blocks while capacity items are waiting, so a fast fetcher cannot queue the whole library ahead of the downloads.
+# It keeps arrival order within a lane, which is the order BaseUrlResolver batches the ids in.
+
+import math
+import heapq
+import itertools
+import time
+import logging
+import threading
+
+LANES = ('photo', 'video')
+VIDEO_SHARE = 0.25  # default share of the workers reserved for the video lane
+
+# Rough compressed bytes per pixel, to rank files by size before anything is downloaded.
+PHOTO_BYTES_PER_PIXEL = {'image/jpeg': 0.35, 'image/heif': 0.2, 'image/heic': 0.2, 'image/png': 1.5, 'image/gif': 0.5, 'image/webp': 0.2}
+RAW_BYTES_PER_PIXEL = 1.5  # image/x-* (camera raw formats)
+VIDEO_BYTES_PER_PIXEL = 8  # mediaMetadata has no duration; this puts a 1080p clip at about 16 MB
+DEFAULT_PHOTO_SIZE = 3 << 20  # when width/height are missing
+DEFAULT_VIDEO_SIZE = 50 << 20
+
+
+def lane_of(item):
+    # Same test media_url uses to ask for the video stream.
+    return 'video' if item.is_video or '.mov' in (item.filename or '') else 'photo'
+
+
+def estimate_size(item):
+    # Estimated download size in bytes.
+    pixels = item.width * item.height if item.width and item.height else None
+    if lane_of(item) == 'video':
+        return pixels * VIDEO_BYTES_PER_PIXEL if pixels else DEFAULT_VIDEO_SIZE
+    if not pixels:
+        return DEFAULT_PHOTO_SIZE
+    mime = item.mimeType or ''
+    bytes_per_pixel = PHOTO_BYTES_PER_PIXEL.get(mime, RAW_BYTES_PER_PIXEL if mime.startswith('image/x-') else 0.5)
+    return int(pixels * bytes_per_pixel)
+
+
+def priority(item):
+    # Sort key within a lane: size class (powers of two, so similar sizes keep date order), then creation time.
+    return int(math.log2(max(estimate_size(item), 1))), item.creation_ts if item.creation_ts is not None else 0
+
+
+def split_workers(total, video_share=VIDEO_SHARE):
+    # {'photo': n, 'video': m} with m + n == total.  At least one photo worker whenever there are two or more.
+    video = 0 if total < 2 else min(total - 1, max(1 if video_share > 0 else 0, round(total * video_share)))
+    return {'photo': total - video, 'video': video}
+
+
+class LaneStats:
+    def __init__(self, lane, queued):
+        self.lane = lane
+        self.queued = queued
+        self.files = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0  # summed over workers
+        self.first_start = None
+        self.last_end = None
+
+    def wall_seconds(self):
+        return self.last_end - self.first_start if self.first_start is not None and self.last_end is not None else 0.0
+
+    def summary(self):
+        wall = self.wall_seconds()
+        files_rate = self.files / wall if wall else 0.0
+        mb_rate = self.bytes / wall / 1024 / 1024 if wall else 0.0
+        return (f"{self.lane}: {self.files}/{self.queued} files, {self.bytes / 1024 / 1024:.1f} MB in {wall:.1f} s, "
+                f"{files_rate:.2f} files/s, {mb_rate:.2f} MB/s")
+
+
+class DownloadScheduler:
+    # Hands items to download workers lane by lane.  next_item() and record() are thread safe, so the threaded engine
+    # (run) and the asyncio engine can both drive it.  Without streaming=True the items are all known up front and
+    # the scheduler is closed from the start.
+    def __init__(self, items, num_workers, video_share=VIDEO_SHARE, streaming=False, capacity=None):
+        self.workers = split_workers(num_workers, video_share)
+        self.sequence = itertools.count()  # tie breaker, so the heaps never compare items
+        self.queues = {lane: [] for lane in LANES}  # heaps of (priority, sequence, item)
+        for item in items:
+            self.queues[lane_of(item)].append((priority(item), next(self.sequence), item))
+        for queue in self.queues.values():
+            heapq.heapify(queue)
+        self.stats = {lane: LaneStats(lane, len(queue)) for lane, queue in self.queues.items()}
+        self.capacity = capacity  # most items waiting in a streaming scheduler, None for no limit
+        self.closed = not streaming  # no more items will be put
+        self.cancelled = False  # put() discards items, e.g. after the download engine stopped
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    def waiting(self):
+        # Call with the lock held.
+        return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, items):
+        # Streaming: queue more items, blocking while capacity items are already waiting.
+        with self.condition:
+            for item in items:
+                while self.capacity is not None and self.waiting() >= self.capacity and not self.cancelled:
+                    self.condition.wait()
+                if self.cancelled:
+                    return
+                lane = lane_of(item)
+                heapq.heappush(self.queues[lane], ((), next(self.sequence), item))  # first in, first out
+                self.stats[lane].queued += 1
+                self.condition.notify_all()
+
+    def close(self):
+        # Streaming: no more items.  Workers finish what is queued and then stop.
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def cancel(self):
+        # Stop accepting items and release a producer blocked in put().  Items already queued are still handed out.
+        with self.condition:
+            self.closed = True
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def depths(self):
+        # {lane: items waiting}, for the queue depth metrics.
+        with self.lock:
+            return {lane: len(queue) for lane, queue in self.queues.items()}
+
+    def finished(self):
+        # True once the scheduler is closed and every item has been handed out.
+        with self.lock:
+            return self.closed and not self.waiting()
+
+    def worker_lanes(self):
+        # One lane per worker, in the proportions of self.workers.
+        return [lane for lane in LANES for _ in range(self.workers[lane])]
+
+    def planned_order(self):
+        # Expected order in which items will be taken: the lanes interleaved by worker share, weighted by the estimated
+        # size of what each lane is working on.  Only a hint, for BaseUrlResolver to batch ids that will be needed soon.
+        queues = {lane: [item for _, _, item in sorted(queue)] for lane, queue in self.queues.items()}
+        positions = {lane: 0 for lane in LANES}
+        clocks = {lane: 0.0 for lane in LANES}  # estimated bytes per worker the lane has been given so far
+        order = []
+        while any(positions[lane] < len(queues[lane]) for lane in LANES):
+            open_lanes = [lane for lane in LANES if positions[lane] < len(queues[lane])]
+            lane = min(open_lanes, key=lambda name: clocks[name])
+            item = queues[lane][positions[lane]]
+            positions[lane] += 1
+            clocks[lane] += estimate_size(item) / max(self.workers[lane], 1)
+            order.append(item)
+        return order
+
+    def next_item(self, lane, wait=True):
+        # Next item of the lane, or of the other lane when this one is empty.  None when the scheduler is finished,
+        # or, with wait=False, when nothing is queued right now (check finished() to tell the two apart).
+        with self.condition:
+            while True:
+                for name in (lane,) + tuple(other for other in LANES if other != lane):
+                    if self.queues[name]:
+                        _, _, item = heapq.heappop(self.queues[name])
+                        stats = self.stats[name]
+                        if stats.first_start is None:
+                            stats.first_start = time.monotonic()
+                        self.condition.notify_all()  # room for a producer blocked in put()
+                        return item
+                if self.closed or not wait:
+                    return None
+                self.condition.wait()
+
+    def record(self, item, seconds):
+        # Account a finished attempt.  Downloaded bytes come from the index (file_size), so failures count as 0.
+        with self.lock:
+            stats = self.stats[lane_of(item)]
+            stats.busy_seconds += seconds
+            stats.last_end = time.monotonic()
+            if item.status == 'downloaded':
+                stats.files += 1
+                stats.bytes += item.file_size or 0
+
+    def run(self, download):
+        # Threaded engine: one thread per worker, each pulling from its own lane first.
+        threads = [threading.Thread(target=self._worker, args=(lane, download), name=f'download-{lane}-{index}')
+                   for index, lane in enumerate(self.worker_lanes())]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _worker(self, lane, download):
+        while True:
+            item = self.next_item(lane)
+            if item is None:
+                return
+            start = time.monotonic()
+            try:
+                download(item)
+            except Exception as e:  # keep the worker going, as ThreadPoolExecutor.map did
+                logging.error(f"DOWNLOADER: Unexpected error downloading {item.id}: {e!r}")
+            finally:
+                self.record(item, time.monotonic() - start)
+
+    def summary(self):
+        return '; '.join(f"{self.stats[lane].summary()} ({self.workers[lane]} workers)" for lane in LANES)
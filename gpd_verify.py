@@ -0,0 +1,113 @@
+# Content verification for the Google Photos Downloader.
+# hash_file() runs in worker processes and streams each file through SHA-256 in fixed-size chunks, so memory stays flat
+# whatever the file size.  check_content() compares the files on disk with the sizes recorded in the index and only
+# hashes files whose (path, size, mtime) differs from the content_hash stored with the item.
+
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+HASH_CHUNK_SIZE = 1 << 20  # 1 MiB reads
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE):
+    # Returns (path, sha256 hex digest, bytes read, seconds spent).  Runs in a worker process.
+    start = time.perf_counter()
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    total = 0
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            digest.update(view[:count])
+            total += count
+    return path, digest.hexdigest(), total, time.perf_counter() - start
+
+
+class ContentReport:
+    # Outcome of one verify_content run.
+    def __init__(self):
+        self.hashed = []  # (record, content_hash) for files hashed in this run
+        self.cached = 0  # files whose stored hash was still valid
+        self.zero_byte = []  # (record, path)
+        self.truncated = []  # (record, path, size on disk, recorded size): smaller than recorded
+        self.size_mismatch = []  # (record, path, size on disk, recorded size): larger than recorded
+        self.changed = []  # (record, path): same size as last time but different content
+        self.missing = []  # (record, path): recorded file not on disk
+        self.errors = []  # (record, path, error)
+        self.bytes_hashed = 0
+        self.hash_seconds = 0.0  # summed over worker processes
+        self.elapsed = 0.0
+
+    def problems(self):
+        return ([('zero-byte', record, path) for record, path in self.zero_byte]
+                + [('truncated', record, f"{path} ({size} of {expected} bytes)") for record, path, size, expected in self.truncated]
+                + [('size mismatch', record, f"{path} ({size} bytes, {expected} recorded)") for record, path, size, expected in self.size_mismatch]
+                + [('content changed', record, path) for record, path in self.changed]
+                + [('unreadable', record, f"{path}: {error}") for record, path, error in self.errors])
+
+    def summary(self):
+        per_core = self.bytes_hashed / self.hash_seconds / 1024 / 1024 if self.hash_seconds else 0.0
+        overall = self.bytes_hashed / self.elapsed / 1024 / 1024 if self.elapsed else 0.0
+        return (f"{len(self.hashed)} files hashed ({self.bytes_hashed / 1024 / 1024:.1f} MB), {self.cached} unchanged files skipped, "
+                f"{len(self.zero_byte)} zero-byte, {len(self.truncated)} truncated, {len(self.size_mismatch)} size mismatches, "
+                f"{len(self.changed)} changed, {len(self.missing)} missing, {len(self.errors)} unreadable. "
+                f"{overall:.1f} MB/s overall, {per_core:.1f} MB/s per core")
+
+
+def check_content(records, snapshot, num_workers=None, rehash=False, on_hashed=None):
+    # records: MediaRecords with a file_path.  snapshot: RepositorySnapshot giving size and mtime of every file.
+    # on_hashed(record, content_hash) is called in the parent process for every file hashed, e.g. to store the hash.
+    report = ContentReport()
+    start = time.perf_counter()
+    to_hash = []
+    for record in records:
+        path = os.path.normpath(record.file_path)
+        entry = snapshot.files.get(path)
+        if entry is None:
+            report.missing.append((record, path))
+            continue
+        if entry.size == 0:
+            report.zero_byte.append((record, path))
+            continue
+        if record.file_size is not None and entry.size != record.file_size:
+            (report.truncated if entry.size < record.file_size else report.size_mismatch).append((record, path, entry.size, record.file_size))
+        previous = record.content_hash
+        if not rehash and previous and previous.get('path') == path and previous.get('size') == entry.size and previous.get('mtime') == entry.mtime:
+            report.cached += 1
+            continue
+        to_hash.append((record, path, entry))
+
+    if to_hash:
+        logging.info(f"VERIFIER: Hashing {len(to_hash)} files with {num_workers or os.cpu_count()} processes...")
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # Small batches keep the workers busy without a round trip per file; results come back in order.
+            results = executor.map(_hash_file_safely, [path for _, path, _ in to_hash], chunksize=8)
+            for (record, path, entry), (_, digest, size, seconds, error) in zip(to_hash, results):
+                if error is not None:
+                    report.errors.append((record, path, error))
+                    continue
+                previous = record.content_hash
+                if previous and previous.get('path') == path and previous.get('size') == size and previous.get('sha256') != digest:
+                    report.changed.append((record, path))
+                content_hash = {'sha256': digest, 'path': path, 'size': size, 'mtime': entry.mtime}
+                report.hashed.append((record, content_hash))
+                report.bytes_hashed += size
+                report.hash_seconds += seconds
+                if on_hashed is not None:
+                    on_hashed(record, content_hash)
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def _hash_file_safely(path):
+    # hash_file, with OSErrors returned rather than raised so one unreadable file does not stop the pool.
+    try:
+        return hash_file(path) + (None,)
+    except OSError as e:
+        return path, None, 0, 0.0, str(e)
@@ -0,0 +1,128 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from gpd_benchmark import FakePhotosApi, make_fake_library
+from gpd_download import BaseUrlResolver, MediaItemUnavailableError, BATCH_GET_SIZE
+from gpd_fakeserver import FakePhotosServer
+
+ITEM_IDS = [f'ID{index:06d}' for index in range(120)]
+
+
+def test_resolver_batches_ids_in_download_order():
+    api = FakePhotosApi()
+    resolver = BaseUrlResolver(api, ITEM_IDS)
+
+    urls = [resolver.base_url(item_id) for item_id in ITEM_IDS]
+
+    assert all(url.endswith('/' + item_id) for url, item_id in zip(urls, ITEM_IDS))
+    assert api.calls['batchGet'] == -(-len(ITEM_IDS) // BATCH_GET_SIZE)
+    assert api.calls['get'] == 0
+
+
+def test_concurrent_workers_share_batches():
+    api = FakePhotosApi(latency=0.01)
+    resolver = BaseUrlResolver(api, ITEM_IDS)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        urls = list(executor.map(resolver.base_url, ITEM_IDS))
+
+    assert all(url.endswith('/' + item_id) for url, item_id in zip(urls, ITEM_IDS))
+    assert api.calls['batchGet'] == -(-len(ITEM_IDS) // BATCH_GET_SIZE)
+
+
+def test_unavailable_items_raise_without_further_calls():
+    missing_ids = set(ITEM_IDS[::7])
+    api = FakePhotosApi(missing_ids=missing_ids)
+    resolver = BaseUrlResolver(api, ITEM_IDS)
+
+    unavailable = set()
+    for item_id in ITEM_IDS:
+        try:
+            resolver.base_url(item_id)
+        except MediaItemUnavailableError:
+            unavailable.add(item_id)
+    calls = api.calls['batchGet']
+    with pytest.raises(MediaItemUnavailableError):
+        resolver.base_url(ITEM_IDS[0])
+
+    assert unavailable == missing_ids
+    assert api.calls['batchGet'] == calls
+
+
+def test_cached_urls_are_reused():
+    api = FakePhotosApi()
+    resolver = BaseUrlResolver(api, ITEM_IDS)
+    resolver.store(ITEM_IDS[0], 'https://example.com/from-search')
+
+    assert resolver.base_url(ITEM_IDS[0]) == 'https://example.com/from-search'
+    assert api.calls['batchGet'] == 0
+    resolver.base_url(ITEM_IDS[1])
+    resolver.base_url(ITEM_IDS[1])
+    assert api.calls['batchGet'] == 1
+    assert (resolver.hits, resolver.search_hits, resolver.misses) == (2, 1, 1)
+
+
+def test_invalidated_and_expired_urls_are_fetched_again():
+    api = FakePhotosApi()
+    resolver = BaseUrlResolver(api, ITEM_IDS[:1])
+    resolver.base_url(ITEM_IDS[0])
+
+    resolver.invalidate(ITEM_IDS[0])
+    resolver.base_url(ITEM_IDS[0])
+    assert api.calls['batchGet'] == 2
+    assert resolver.invalidated == 1
+
+    expiring = BaseUrlResolver(api, ITEM_IDS[:1], lifetime=0)
+    expiring.base_url(ITEM_IDS[0])
+    expiring.base_url(ITEM_IDS[0])
+    assert api.calls['batchGet'] == 4
+    assert expiring.expired == 1
+
+
+def test_resolver_through_the_api_client():
+    pytest.importorskip('googleapiclient')
+    from google_photos_downloader import GooglePhotosDownloader
+    library = make_fake_library(120, random.Random(0))
+    item_ids = sorted(item['id'] for item in library)
+    missing_ids = set(item_ids[:3])
+    server = FakePhotosServer(library, missing_ids=missing_ids).start()
+    try:
+        photos_api = GooglePhotosDownloader.build_photos_api(type('Downloader', (), {'api_base_url': server.url})())
+        resolver = BaseUrlResolver(photos_api, item_ids)
+        unavailable = set()
+        for item_id in item_ids:
+            try:
+                assert resolver.base_url(item_id) == f'{server.url}/content/{item_id}'
+            except MediaItemUnavailableError:
+                unavailable.add(item_id)
+        assert unavailable == missing_ids
+        assert server.calls('batchGet') == -(-len(item_ids) // BATCH_GET_SIZE)
+    finally:
+        server.shutdown()
+
+
+def test_failed_batch_get_marks_items_failed(tmp_path):
+    pytest.importorskip('googleapiclient')
+    from google_photos_downloader import GooglePhotosDownloader
+    from gpd_fakeserver import FileSizes
+    from gpd_ratelimit import RateLimiter
+    items = 3
+    server = FakePhotosServer(make_fake_library(items, random.Random(0)), file_sizes=FileSizes(8, 32)).start()
+    rate_limiter = RateLimiter(api_rate=100, api_capacity=100, content_rate=1000, content_capacity=100)
+    downloader = GooglePhotosDownloader(None, None, str(tmp_path), num_workers=items, rate_limiter=rate_limiter, api_base_url=server.url)
+    try:
+        downloader.get_all_media_items()
+        downloader.url_resolver.urls.clear()  # forget the search results' URLs, so every download needs a batchGet
+        server.error_ratio = 1.0
+        downloader.download_photos(downloader.missing_media_items())
+    finally:
+        downloader.journal.close()
+        downloader.index_store.close()
+        downloader.session.close()
+        server.shutdown()
+
+    assert [str(item.status) for item in downloader.all_media_items.values()] == ['failed'] * items
+    assert (downloader.downloaded_count.value, downloader.failed_count.value) == (0, items)
+    assert server.calls('batchGet', 500) > 0 and server.calls('content') == 0
@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+from google_photos_downloader import GooglePhotosDownloader
+from gpd_benchmark import make_fake_library
+from gpd_fakeserver import FakePhotosServer, FileSizes
+from gpd_ratelimit import RateLimiter
+
+ITEMS = 4
+
+
+def download_with(engine, backup_path, error_ratio, resolve=False):
+    # Fetch with a healthy server (the search results seed the baseUrl cache), then download with error_ratio.
+    # resolve=True empties the cache first, so the downloads need batchGet calls, which then fail as well.
+    backup_path.mkdir()
+    server = FakePhotosServer(make_fake_library(ITEMS, random.Random(0)), file_sizes=FileSizes(8, 32)).start()
+    rate_limiter = RateLimiter(api_rate=100, api_capacity=100, content_rate=1000, content_capacity=100)
+    downloader = GooglePhotosDownloader(None, None, str(backup_path), num_workers=ITEMS, engine=engine, transfer_concurrency=ITEMS,
+                                        rate_limiter=rate_limiter, api_base_url=server.url)
+    try:
+        downloader.get_all_media_items()
+        if resolve:
+            downloader.url_resolver.urls.clear()
+        server.error_ratio = error_ratio
+        downloader.download_photos(downloader.missing_media_items())
+        statuses = sorted(str(item.status) for item in downloader.all_media_items.values())
+        return downloader.downloaded_count.value, downloader.failed_count.value, statuses
+    finally:
+        downloader.journal.close()
+        downloader.index_store.close()
+        downloader.session.close()
+        server.shutdown()
+
+
+@pytest.mark.parametrize('error_ratio, expected', [(0.0, (ITEMS, 0, ['downloaded'] * ITEMS)), (1.0, (0, ITEMS, ['failed'] * ITEMS))])
+def test_engines_report_the_same_outcome(tmp_path, error_ratio, expected):
+    pytest.importorskip('aiohttp')
+    threads = download_with('threads', tmp_path / 'threads', error_ratio)
+    async_ = download_with('async', tmp_path / 'async', error_ratio)
+    assert threads == async_ == expected
+
+
+def test_engines_fail_items_when_batch_get_fails(tmp_path):
+    pytest.importorskip('aiohttp')
+    threads = download_with('threads', tmp_path / 'threads', 1.0, resolve=True)
+    async_ = download_with('async', tmp_path / 'async', 1.0, resolve=True)
+    assert threads == async_ == (0, ITEMS, ['failed'] * ITEMS)
@@ -0,0 +1,59 @@
+import json
+
+from gpd_index import JsonIndexStore
+from gpd_records import MediaRecord
+
+
+def make_item(index):
+    return {'id': f'item{index:04d}', 'filename': f'IMG_{index:04d}.jpg', 'mimeType': 'image/jpeg', 'status': 'fetched',
+            'productUrl': f'https://photos.google.com/lr/photo/item{index:04d}',
+            'mediaMetadata': {'creationTime': f'2023-01-{index % 28 + 1:02d}T10:00:00Z', 'width': '4032', 'height': '3024'}}
+
+
+def write_index(store, count):
+    store.save({item['id']: MediaRecord(item) for item in map(make_item, range(count))})
+    return store.load()
+
+
+def test_records_outside_a_saved_subset_stay_readable(tmp_path):
+    store = JsonIndexStore(str(tmp_path))
+    records = write_index(store, 5)
+    ids = sorted(records)
+    records[ids[0]]['status'] = 'downloaded'
+    records[ids[0]]['filename'] = 'IMG_0000_renamed.jpg'  # grows the first record, shifting every later one
+
+    store.save({ids[0]: records[ids[0]]}, {ids[0]})
+
+    for index, item_id in enumerate(ids):
+        assert records[item_id]['productUrl'] == make_item(index)['productUrl']
+    assert store.load()[ids[0]]['filename'] == 'IMG_0000_renamed.jpg'
+    store.close()
+
+
+def test_unsaved_extras_outside_a_saved_subset_are_kept(tmp_path):
+    store = JsonIndexStore(str(tmp_path))
+    records = write_index(store, 3)
+    ids = sorted(records)
+    records[ids[2]]['productUrl'] = 'changed in memory'
+
+    store.save({ids[0]: records[ids[0]]}, {ids[0]})
+    store.save({ids[1]: records[ids[1]]}, {ids[1]})
+
+    assert records[ids[2]]['productUrl'] == 'changed in memory'
+    assert records[ids[1]]['productUrl'] == make_item(1)['productUrl']
+    store.close()
+    with open(store.path) as f:
+        assert json.load(f)[ids[2]]['productUrl'] == make_item(2)['productUrl']
+
+
+def test_records_of_an_earlier_load_follow_later_saves(tmp_path):
+    store = JsonIndexStore(str(tmp_path))
+    first = write_index(store, 3)
+    second = store.load()
+    ids = sorted(second)
+    second[ids[0]]['filename'] = 'IMG_0000_renamed.jpg'
+
+    store.save(second, {ids[0]})
+
+    assert first[ids[2]]['productUrl'] == make_item(2)['productUrl']
+    store.close()
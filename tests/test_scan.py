@@ -0,0 +1,96 @@
+import os
+
+from google_photos_downloader import GooglePhotosDownloader
+from gpd_metrics import MetricsRegistry, METRICS_DIRNAME
+
+
+def offline_downloader(backup_path, **options):
+    downloader = GooglePhotosDownloader(None, None, str(backup_path), offline=True, **options)
+    downloader.load_index_from_file()
+    return downloader
+
+
+def close(downloader):
+    downloader.journal.close()
+    downloader.index_store.close()
+    downloader.session.close()
+
+
+def test_validate_leaves_metrics_summaries_alone(tmp_path):
+    summary_path = os.path.join(tmp_path, METRICS_DIRNAME, 'scan_only_20240101T000000Z.json')
+    MetricsRegistry().write_summary(summary_path, command='scan_only')
+    extraneous_path = os.path.join(tmp_path, '2023', '1', 'stray.jpg')
+    os.makedirs(os.path.dirname(extraneous_path))
+    open(extraneous_path, 'wb').close()
+
+    downloader = offline_downloader(tmp_path, extraneous_policy='delete')
+    downloader.validate_repository()
+    close(downloader)
+
+    assert os.path.exists(summary_path)
+    assert not os.path.exists(extraneous_path)
+    with open(os.path.join(tmp_path, 'extraneous_files.txt')) as f:
+        assert METRICS_DIRNAME not in f.read()
+
+
+def test_scan_does_not_count_metrics_summaries_as_orphans(tmp_path):
+    summary_path = os.path.join(tmp_path, METRICS_DIRNAME, 'scan_only_20240101T000000Z.json')
+    MetricsRegistry().write_summary(summary_path, command='scan_only')
+
+    downloader = offline_downloader(tmp_path)
+    snapshot = downloader.scan_repository()
+    close(downloader)
+
+    assert os.path.normpath(summary_path) not in snapshot.files
+
+
+def test_validate_leaves_profiles_alone(tmp_path):
+    from gpd_profile import PhaseProfiler, PROFILES_DIRNAME
+    profiler = PhaseProfiler(os.path.join(tmp_path, PROFILES_DIRNAME, 'scan_only_20240101T000000Z')).start()
+    downloader = offline_downloader(tmp_path, extraneous_policy='delete', profiler=profiler)
+    downloader.validate_repository()
+    profiler.finish()
+    profiles = sorted(os.listdir(profiler.output_dir))
+    assert any(name.endswith('.pstats') for name in profiles) and 'summary.txt' in profiles
+
+    downloader.validate_repository()
+    close(downloader)
+
+    assert set(profiles) <= set(os.listdir(profiler.output_dir))
+
+
+def run_all(backup_path, server, start_date, extraneous_policy):
+    from gpd_ratelimit import RateLimiter
+    rate_limiter = RateLimiter(api_rate=100, api_capacity=100, content_rate=1000, content_capacity=100)
+    downloader = GooglePhotosDownloader(start_date, None, str(backup_path), num_workers=2, extraneous_policy=extraneous_policy,
+                                        rate_limiter=rate_limiter, api_base_url=server.url)
+    try:
+        downloader.run_all()
+    finally:
+        close(downloader)
+
+
+def test_date_limited_run_all_keeps_files_outside_the_range(tmp_path):
+    import random
+    from gpd_benchmark import make_fake_library
+    from gpd_fakeserver import FakePhotosServer, FileSizes
+    library = make_fake_library(6, random.Random(0))
+    for year, item in enumerate(library, 2010):
+        item['mediaMetadata']['creationTime'] = f'{year}-06-15T12:00:00Z'
+    server = FakePhotosServer(library, file_sizes=FileSizes(8, 32)).start()
+    try:
+        run_all(tmp_path, server, None, 'leave')
+        library_files = [os.path.join(root, name) for root, _, names in os.walk(tmp_path) for name in names if root != str(tmp_path)]
+        assert len(library_files) == len(library)
+        extraneous_path = os.path.join(tmp_path, '2010', '1', 'stray.jpg')
+        os.makedirs(os.path.dirname(extraneous_path))
+        open(extraneous_path, 'wb').close()
+
+        run_all(tmp_path, server, '2014-01-01', 'delete')
+    finally:
+        server.shutdown()
+
+    assert all(os.path.exists(path) for path in library_files)
+    assert os.path.exists(extraneous_path)  # deleting is refused after a date-limited fetch
+    with open(os.path.join(tmp_path, 'extraneous_files.txt')) as f:
+        assert f.read().split() == [os.path.normpath(extraneous_path)]
@@ -0,0 +1,47 @@
+import sqlite3
+
+import pytest
+
+from gpd_index import JsonIndexStore, SqliteIndexStore
+from gpd_records import MediaRecord
+from gpd_schedule import DownloadScheduler, estimate_size, DEFAULT_PHOTO_SIZE
+
+# (id, width, height): a 12 MP photo, a thumbnail-sized one and a 2 MP one, created in that order
+PHOTOS = [('large', '4032', '3024'), ('small', '640', '480'), ('medium', '1920', '1080')]
+
+
+def photo(item_id, width, height, day):
+    return {'id': item_id, 'filename': f'{item_id}.jpg', 'mimeType': 'image/jpeg', 'status': 'fetched',
+            'mediaMetadata': {'creationTime': f'2023-01-{day:02d}T10:00:00Z', 'width': width, 'height': height}}
+
+
+def saved_and_loaded(store):
+    store.save({item_id: MediaRecord(photo(item_id, width, height, day)) for day, (item_id, width, height) in enumerate(PHOTOS, 1)})
+    return store.load()
+
+
+@pytest.mark.parametrize('store_class', [JsonIndexStore, SqliteIndexStore])
+def test_photo_lane_is_smallest_first_on_every_backend(tmp_path, store_class):
+    store = store_class(str(tmp_path))
+    items = saved_and_loaded(store)
+
+    assert all(estimate_size(item) != DEFAULT_PHOTO_SIZE for item in items.values())
+    scheduler = DownloadScheduler(list(items.values()), num_workers=1, video_share=0)
+    assert [item.id for item in scheduler.planned_order()] == ['small', 'medium', 'large']
+    store.close()
+
+
+def test_sqlite_index_from_an_older_version_gets_dimensions(tmp_path):
+    store = SqliteIndexStore(str(tmp_path))
+    saved_and_loaded(store)
+    store.close()
+    connection = sqlite3.connect(store.path)  # drop the columns, as in a database written before they existed
+    connection.execute('ALTER TABLE media_items DROP COLUMN width')
+    connection.execute('ALTER TABLE media_items DROP COLUMN height')
+    connection.commit()
+    connection.close()
+
+    items = SqliteIndexStore(str(tmp_path)).load()
+
+    assert (items['large'].width, items['large'].height) == (4032, 3024)
+    assert items['small']['mediaMetadata']['width'] == '640'